@@ -0,0 +1,204 @@
+import asyncio
+import logging
+import time
+import weakref
+
+from telethon.errors import FloodWaitError
+
+# Приоритеты: действия пользователя в боте > живой мониторинг > фоновые сканы.
+INTERACTIVE, MONITORING, BACKGROUND = 0, 1, 2
+
+# Классы методов и лимиты на аккаунт: (запросов в секунду, размер пачки).
+DEFAULT_LIMITS = {
+    'auth': (0.2, 2),       # send_code_request, sign_in
+    'resolve': (1.0, 5),    # get_entity по ссылке/username
+    'entity': (5.0, 10),    # get_sender/get_chat, когда их нет в кэше
+    'history': (2.0, 4),    # get_messages пачками
+    'default': (5.0, 10),
+}
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def delay(self, now: float) -> float:
+        """Сколько секунд ждать до свободного токена (0 — можно сейчас)."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self):
+        self.tokens -= 1
+
+
+class _Job:
+    __slots__ = ('kind', 'priority', 'func', 'args', 'kwargs', 'future', 'retry', 'attempts')
+
+    def __init__(self, kind, priority, func, args, kwargs, future, retry):
+        self.kind = kind
+        self.priority = priority
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.future = future
+        self.retry = retry
+        self.attempts = 0
+
+
+class AccountScheduler:
+    """Очередь запросов к Telegram API одного аккаунта.
+
+    Каждый класс методов ограничен своим token bucket, одновременно
+    выполняется не более ``max_inflight`` запросов, причём фоновые задачи
+    не занимают последний слот. FloodWait на любом запросе ставит на паузу
+    весь аккаунт; сам запрос повторяется после паузы, если ожидание не
+    длиннее ``max_flood_wait`` и вызывающий не отключил повтор.
+
+    Задача-диспетчер живёт, только пока есть работа: на пустой очереди она
+    завершается, а ``call`` запускает её снова. ``close`` останавливает её
+    и отклоняет недождавшиеся запросы (клиент отключён).
+    """
+
+    def __init__(self, name: str = '', limits: dict | None = None, max_inflight: int = 4,
+                 max_flood_wait: int = 60, max_attempts: int = 3):
+        self.name = name
+        self.limits = {**DEFAULT_LIMITS, **(limits or {})}
+        self.max_inflight = max(2, max_inflight)
+        self.max_flood_wait = max_flood_wait
+        self.max_attempts = max_attempts
+        self.paused_until = 0.0
+        self.stats = {'calls': 0, 'flood_waits': 0, 'flood_seconds': 0}
+        self._buckets = {}
+        self._queues = ([], [], [])
+        self._inflight = 0
+        self._wakeup = None
+        self._task = None
+
+    def _bucket(self, kind: str) -> TokenBucket:
+        bucket = self._buckets.get(kind)
+        if bucket is None:
+            rate, burst = self.limits.get(kind, self.limits['default'])
+            bucket = self._buckets[kind] = TokenBucket(rate, burst)
+        return bucket
+
+    async def call(self, kind: str, func, *args, priority: int = BACKGROUND, retry: bool = True, **kwargs):
+        """Поставить ``func(*args, **kwargs)`` в очередь и дождаться результата."""
+        job = _Job(kind, priority, func, args, kwargs, asyncio.get_running_loop().create_future(), retry)
+        self._queues[priority].append(job)
+        self._kick()
+        return await job.future
+
+    def pending(self) -> int:
+        return sum(len(q) for q in self._queues)
+
+    def _kick(self):
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        self._wakeup.set()
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for queue in self._queues:
+            for job in queue:
+                if not job.future.done():
+                    job.future.set_exception(ConnectionError(f"client {self.name} disconnected"))
+            queue.clear()
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            wait = self._dispatch()
+            if wait is None:
+                if not self.pending():
+                    # Очередной call или завершение запроса запустят задачу заново.
+                    self._task = None
+                    return
+                await self._wakeup.wait()
+            else:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+
+    def _dispatch(self) -> float | None:
+        """Запустить всё, что можно; вернуть время до следующей попытки."""
+        now = time.monotonic()
+        if self.paused_until > now:
+            return self.paused_until - now if self.pending() else None
+        wait = None
+        for queue in self._queues:
+            i = 0
+            while i < len(queue):
+                job = queue[i]
+                if job.future.done():
+                    del queue[i]
+                    continue
+                limit = self.max_inflight - 1 if job.priority == BACKGROUND else self.max_inflight
+                if self._inflight >= limit:
+                    break
+                bucket = self._bucket(job.kind)
+                delay = bucket.delay(now)
+                if delay:
+                    wait = delay if wait is None else min(wait, delay)
+                    i += 1
+                    continue
+                bucket.consume()
+                del queue[i]
+                self._inflight += 1
+                asyncio.create_task(self._execute(job))
+        return wait
+
+    async def _execute(self, job: _Job):
+        try:
+            self.stats['calls'] += 1
+            result = await job.func(*job.args, **job.kwargs)
+        except FloodWaitError as e:
+            self.stats['flood_waits'] += 1
+            self.stats['flood_seconds'] += e.seconds
+            self.paused_until = max(self.paused_until, time.monotonic() + e.seconds + 1)
+            logging.warning("FloodWait %ss on %s (%s), account paused", e.seconds, self.name, job.kind)
+            job.attempts += 1
+            if job.retry and e.seconds <= self.max_flood_wait and job.attempts < self.max_attempts:
+                self._queues[job.priority].insert(0, job)
+            elif not job.future.done():
+                job.future.set_exception(e)
+        except Exception as e:
+            if not job.future.done():
+                job.future.set_exception(e)
+        else:
+            if not job.future.done():
+                job.future.set_result(result)
+        finally:
+            self._inflight -= 1
+            self._kick()
+
+
+_schedulers = weakref.WeakKeyDictionary()
+
+
+def scheduler_for(client) -> AccountScheduler:
+    sched = _schedulers.get(client)
+    if sched is None:
+        name = str(getattr(getattr(client, 'session', None), 'filename', '') or id(client))
+        sched = _schedulers[client] = AccountScheduler(name)
+    return sched
+
+
+def release_scheduler(client):
+    """Остановить планировщик клиента перед отключением (спящий режим, смена сессии)."""
+    sched = _schedulers.pop(client, None)
+    if sched is not None:
+        sched.close()
+
+
+async def api_call(client, kind: str, func, *args, priority: int = BACKGROUND, retry: bool = True, **kwargs):
+    """Выполнить вызов Telethon через планировщик аккаунта ``client``."""
+    return await scheduler_for(client).call(kind, func, *args, priority=priority, retry=retry, **kwargs)
@@ -0,0 +1,192 @@
+import contextlib
+import gzip
+import json
+import logging
+import os
+import shutil
+from bisect import bisect_right
+from datetime import datetime, timedelta
+
+from .models import Result, parser_key
+
+
+class ResultArchive:
+    """Холодное хранилище старых результатов парсеров.
+
+    В памяти (``parser['results']``) держатся последние ``hot_limit``
+    результатов не старше ``hot_days`` дней. Всё, что старше, сбрасывается
+    в сжатые сегменты ``<dir>/<key>/seg_<seq>.jsonl.gz``; список
+    сегментов с диапазонами дат лежит в ``index.json`` рядом.
+    Сквозная нумерация: ``parser['archived']`` — сколько записей уже ушло
+    в архив, поэтому номер горячей записи ``i`` равен ``archived + i``.
+    Записи идут в порядке сохранения, а не по времени: найденное в истории
+    чатов дописывается в конец, поэтому даты сегмента — его минимум и
+    максимум.
+    """
+
+    def __init__(self, root: str, hot_limit: int, hot_days: int):
+        self.root = root
+        self.hot_limit = max(1, hot_limit)
+        self.hot_days = hot_days
+        # Не пишем сегмент на каждое новое сообщение — ждём пачку.
+        self.slack = max(50, self.hot_limit // 10)
+        # Последний прочитанный сегмент: листание страниц обычно идёт подряд.
+        self._seg_cache = (None, None)
+
+    def _dir(self, parser: dict) -> str:
+        return os.path.join(self.root, parser_key(parser))
+
+    def _index(self, parser: dict) -> list:
+        if not parser.get('key'):
+            return []
+        path = os.path.join(self.root, parser['key'], 'index.json')
+        if not os.path.exists(path):
+            return []
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception:
+            logging.exception("Failed to read archive index %s", path)
+            return []
+
+    def _write_index(self, parser: dict, index: list):
+        path = os.path.join(self._dir(parser), 'index.json')
+        tmp = path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(index, f, ensure_ascii=False)
+        os.replace(tmp, path)
+
+    def _cutoff(self, now: datetime | None = None) -> str:
+        now = now or datetime.utcnow()
+        return (now - timedelta(days=self.hot_days)).strftime('%Y-%m-%d %H:%M:%S')
+
+    def enforce(self, parser: dict, force: bool = False) -> int:
+        """Перенести в архив лишние горячие результаты. Возвращает их число."""
+        results = parser.get('results') or []
+        excess = len(results) - self.hot_limit
+        stale = 0
+        if self.hot_days > 0:
+            cutoff = self._cutoff()
+            while stale < len(results) and results[stale].datetime < cutoff:
+                stale += 1
+        count = max(excess, stale)
+        if count <= 0 or (not force and count < self.slack):
+            return 0
+        self._append_segment(parser, results[:count])
+        del results[:count]
+        return count
+
+    def _append_segment(self, parser: dict, batch: list):
+        """Записать сегмент с номера ``parser['archived']``.
+
+        Повтор безопасен: если бот упал после записи сегмента, но до
+        сохранения обрезанного ``parser['results']``, те же записи придут
+        сюда снова с тем же номером. Записи индекса с этого номера и дальше
+        тогда заменяются новой, а сегмент и индекс пишутся во временный
+        файл и подменяются целиком.
+        """
+        first_seq = parser.get('archived', 0)
+        directory = self._dir(parser)
+        os.makedirs(directory, exist_ok=True)
+        name = f"seg_{first_seq:010d}.jsonl.gz"
+        path = os.path.join(directory, name)
+        with gzip.open(path + '.tmp', 'wt', encoding='utf-8') as f:
+            for r in batch:
+                f.write(json.dumps(r.to_dict(), ensure_ascii=False))
+                f.write('\n')
+        os.replace(path + '.tmp', path)
+        index = []
+        for seg in self._index(parser):
+            if seg['first_seq'] < first_seq:
+                index.append(seg)
+            elif seg['file'] != name:
+                # Хвост от прогона, который не дошёл до сохранения user_data.
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(os.path.join(directory, seg['file']))
+        self._seg_cache = (None, None)
+        index.append({
+            'file': name,
+            'first_seq': first_seq,
+            'count': len(batch),
+            'first_dt': min(r.datetime for r in batch),
+            'last_dt': max(r.datetime for r in batch),
+        })
+        self._write_index(parser, index)
+        parser['archived'] = first_seq + len(batch)
+
+    def _read_segment(self, parser: dict, seg: dict) -> list:
+        path = os.path.join(self.root, parser['key'], seg['file'])
+        if self._seg_cache[0] == path:
+            return self._seg_cache[1]
+        try:
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                items = [Result.from_dict(json.loads(line)) for line in f if line.strip()]
+        except Exception:
+            logging.exception("Failed to read archive segment %s", path)
+            return []
+        self._seg_cache = (path, items)
+        return items
+
+    def iter_results(self, parser: dict, since: str | None = None):
+        """Все результаты парсера по порядку, начиная с ``since``.
+
+        Сегменты, целиком лежащие раньше ``since``, не открываются.
+        """
+        for seg in self._index(parser):
+            if since and seg['last_dt'] < since:
+                continue
+            for r in self._read_segment(parser, seg):
+                if not since or r.datetime >= since:
+                    yield r
+        for r in parser.get('results') or []:
+            if not since or r.datetime >= since:
+                yield r
+
+    def page(self, parser: dict, before: int | None, size: int) -> tuple[list, int]:
+        """Страница результатов от последних поступивших к ранним по курсору.
+
+        ``before`` — сквозной номер, до которого (не включительно) берутся
+        записи; ``None`` — с самого свежего. Возвращает ``(items, lo)``,
+        где ``items`` — список ``(seq, Result)``, а ``lo`` — курсор
+        следующей (более старой) страницы. Читается только нужный срез
+        горячего списка и не более двух сегментов архива.
+        """
+        archived = parser.get('archived', 0)
+        hot = parser.get('results') or []
+        total = archived + len(hot)
+        hi = total if before is None else max(0, min(before, total))
+        lo = max(0, hi - size)
+        items = []
+        if hi > archived:
+            start = max(lo, archived)
+            items.extend((archived + i, hot[i]) for i in range(start - archived, hi - archived))
+        if lo < archived:
+            index = self._index(parser)
+            starts = [seg['first_seq'] for seg in index]
+            cold = []
+            seq = lo
+            end = min(hi, archived)
+            while seq < end:
+                pos = bisect_right(starts, seq) - 1
+                if pos < 0:
+                    break
+                seg = index[pos]
+                rows = self._read_segment(parser, seg)
+                upto = min(end, seg['first_seq'] + len(rows))
+                cold.extend((s, rows[s - seg['first_seq']]) for s in range(seq, upto))
+                if upto <= seq:
+                    break
+                seq = upto
+            items = cold + items
+        items.reverse()
+        return items, lo
+
+    def total(self, parser: dict) -> int:
+        return parser.get('archived', 0) + len(parser.get('results') or [])
+
+    def drop(self, parser: dict):
+        """Удалить архив парсера (при очистке результатов или удалении)."""
+        if parser.get('key'):
+            shutil.rmtree(os.path.join(self.root, parser['key']), ignore_errors=True)
+        parser['archived'] = 0
+        self._seg_cache = (None, None)
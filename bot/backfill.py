@@ -0,0 +1,113 @@
+import asyncio
+import logging
+import time
+import weakref
+from datetime import datetime, timedelta, timezone
+
+from .api_scheduler import api_call, BACKGROUND
+
+# Ограничение одновременных сканирований на один Telethon-клиент
+# (несколько парсеров одного аккаунта делят общий лимит).
+_client_semaphores = weakref.WeakKeyDictionary()
+
+
+def _semaphore(client, concurrency: int) -> asyncio.Semaphore:
+    sem = _client_semaphores.get(client)
+    if sem is None:
+        sem = asyncio.Semaphore(max(1, concurrency))
+        _client_semaphores[client] = sem
+    return sem
+
+
+async def iter_history(client, chat, limit: int, since: datetime, before: datetime | None = None):
+    """Сообщения чата от новых к старым, не старше ``since`` и не более ``limit``.
+
+    История забирается пачками по 100 через планировщик аккаунта с фоновым
+    приоритетом; FloodWait и лимиты обрабатываются там.
+    """
+    offset_id = 0
+    remaining = limit
+    while remaining > 0:
+        batch = await api_call(
+            client, 'history', client.get_messages, chat,
+            limit=min(100, remaining), offset_id=offset_id, priority=BACKGROUND,
+        )
+        if not batch:
+            return
+        for msg in batch:
+            offset_id = msg.id
+            if msg.date < since:
+                return
+            remaining -= 1
+            if before and msg.date >= before:
+                continue
+            yield msg
+
+
+def _legacy_key(msg) -> tuple:
+    # Как Result.dedupe_key у записей без msg_id (см. build_result).
+    title = getattr(getattr(msg, 'chat', None), 'title', str(msg.chat_id))
+    return (title, msg.date.strftime('%Y-%m-%d %H:%M:%S'), msg.raw_text or '')
+
+
+async def backfill_parser(
+    client,
+    parser: dict,
+    handle,
+    limit: int,
+    days: int,
+    concurrency: int = 2,
+    known=None,
+    progress=None,
+) -> dict:
+    """Просканировать историю чатов парсера.
+
+    ``handle(msg)`` — корутина, которая прогоняет сообщение через тот же
+    матчер, что и живой мониторинг, и возвращает True, если результат
+    сохранён. Уже сохранённые сообщения (по ``Result.dedupe_key``: у
+    записей с ``msg_id`` — по чату и id, у старых — по чату, времени и
+    тексту) и сообщения, пришедшие после старта (их ловит монитор),
+    пропускаются. ``known`` — сохранённые результаты за окно сканирования
+    вместе с архивными (по умолчанию только ``parser['results']``).
+    ``progress(stats)`` вызывается не чаще раза в несколько секунд.
+    """
+    started = datetime.now(timezone.utc)
+    since = started - timedelta(days=days)
+    seen = set()
+    legacy = False
+    for r in parser.get('results') or [] if known is None else known:
+        seen.add(r.dedupe_key)
+        legacy = legacy or not r.ident
+    chats = list(parser.get('chats') or [])
+    stats = {'chats': len(chats), 'done': 0, 'scanned': 0, 'found': 0}
+    last_report = 0.0
+
+    async def report(force: bool = False):
+        nonlocal last_report
+        if progress and (force or time.monotonic() - last_report >= 3):
+            last_report = time.monotonic()
+            try:
+                await progress(stats)
+            except Exception:
+                logging.exception("Backfill progress callback failed")
+
+    async def scan(chat):
+        async with _semaphore(client, concurrency):
+            try:
+                async for msg in iter_history(client, chat, limit, since, before=started):
+                    stats['scanned'] += 1
+                    ident = (msg.chat_id, msg.id)
+                    if ident in seen or (legacy and _legacy_key(msg) in seen):
+                        continue
+                    seen.add(ident)
+                    if await handle(msg):
+                        stats['found'] += 1
+                    await report()
+            except Exception:
+                logging.exception("Backfill failed for chat %s", chat)
+            stats['done'] += 1
+            await report()
+
+    await asyncio.gather(*(scan(chat) for chat in chats))
+    await report(force=True)
+    return stats
@@ -1,11 +1,17 @@
 import asyncio
+import logging
+import time
 from datetime import datetime, timedelta
 
-from .config import PRO_MONTHLY_RUB, EXTRA_CHAT_MONTHLY_RUB, DAYS_IN_MONTH, bot
-from .data import get_user_data_entry, user_data, save_user_data
+from .config import PRO_MONTHLY_RUB, EXTRA_CHAT_MONTHLY_RUB, DAYS_IN_MONTH, BILLING_MODE, bot
+from .data import get_user_data_entry, user_data, save_user_data, billing_ledger
 from .utils import safe_send_message
 from .parsers import send_all_results
 from .text_utils import t
+from .billing_engine import plan_daily_debits
+from .costs import CostAggregate
+from .subscriptions import SubscriptionTimers, SENT_FLAGS
+from .prorate import accrue_parser, settle_batch
 
 
 def _round2(x: float) -> float:
@@ -19,13 +25,22 @@ def calc_parser_daily_cost(parser: dict) -> float:
     return _round2(base + extras)
 
 
+def _parser_cost(parser: dict) -> float:
+    return parser.get('daily_price') or calc_parser_daily_cost(parser)
+
+
+def track_active_time(parser: dict):
+    """Отметить смену статуса или цены парсера для почасового режима биллинга."""
+    if BILLING_MODE == 'prorated':
+        accrue_parser(parser, _parser_cost)
+
+
+# Суточная стоимость по пользователям; обновляется при смене статуса или чатов парсера.
+cost_aggregate = CostAggregate(user_data, _parser_cost)
+
+
 def total_daily_cost(user_id: int) -> float:
-    data = user_data.get(str(user_id), {})
-    total = 0.0
-    for p in data.get('parsers', []):
-        if p.get('status', 'paused') == 'active':
-            total += p.get('daily_price') or calc_parser_daily_cost(p)
-    return _round2(total)
+    return cost_aggregate.total(user_id)
 
 
 def predict_block_date(user_id: int) -> tuple[str, int]:
@@ -38,6 +53,13 @@ def predict_block_date(user_id: int) -> tuple[str, int]:
         return dt, days
     bal = float(data.get('balance', 0))
     per_day = total_daily_cost(user_id)
+    # Прогноз зависит только от баланса, стоимости и даты — по ним и кэшируем.
+    return cost_aggregate.block_date(
+        user_id, (bal, per_day, datetime.utcnow().date()), lambda: _block_date(bal, per_day),
+    )
+
+
+def _block_date(bal: float, per_day: float) -> tuple[str, int]:
     if per_day <= 0 or bal <= 0:
         return "—", 0
     days = int(bal // per_day)
@@ -45,43 +67,135 @@ def predict_block_date(user_id: int) -> tuple[str, int]:
     return dt, days
 
 
-async def bill_user_daily(user_id: int):
-    data = user_data.get(str(user_id), {})
-    if not data:
-        return
-    per_day = total_daily_cost(user_id)
-    if per_day <= 0:
-        return
-    bal = float(data.get('balance', 0))
-    if bal >= per_day:
-        data['balance'] = _round2(bal - per_day)
-        save_user_data(user_data)
-    else:
-        paused_any = False
-        from .parsers import pause_parser
-        for p in data.get('parsers', []):
-            if p.get('status') == 'active':
-                pause_parser(user_id, p)
-                paused_any = True
+# Итоги последнего прогона суточного биллинга.
+billing_stats = {'runs': 0, 'last_run': 0, 'duration': 0.0, 'users': 0, 'charged': 0, 'blocked': 0, 'total': 0.0}
+
+
+def billing_day(now: datetime | None = None) -> str:
+    """Расчётный день: прогон в 03:00 UTC и рестарты до следующих 03:00 — один день."""
+    return ((now or datetime.utcnow()) - timedelta(hours=3)).strftime('%Y-%m-%d')
+
+
+async def run_daily_billing(day: str | None = None) -> dict:
+    """Суточное списание по всем пользователям за один проход.
+
+    Списания считаются векторно (``plan_daily_debits``) и применяются к
+    ``user_data`` без await посередине, так что остальные корутины не видят
+    половины прогона. На диск всё уходит одним сбросом.
+
+    Прогон идемпотентен: списание сначала пишется в ``billing_ledger``
+    (одна запись на пользователя и день), а в записи пользователя
+    отмечается ``billed_day``. Если бот упал между журналом и сохранением
+    ``user_data``, записи журнала доприменяются при следующем запуске.
+    """
+    day = day or billing_day()
+    if billing_ledger.run_status(day) == 'done':
+        return billing_stats
+    started = time.perf_counter()
+    billing_ledger.start_run(day)
+    billing_ledger.replay(day, user_data)
+    pending = {uid: u for uid, u in user_data.items() if u.get('billed_day') != day}
+    plan = plan_daily_debits(pending, cost_aggregate.total)
+    debits = plan.debits()
+    added = billing_ledger.record(day, debits)
+    for uid, _, balance in debits:
+        if uid in added:
+            user_data[uid]['balance'] = balance
+            user_data[uid]['billed_day'] = day
+    blocked = [int(uid) for uid in plan.blocked() if _block_user(uid)]
+    save_user_data(user_data)
+    billing_stats.update({
+        'runs': billing_stats['runs'] + 1,
+        'last_run': int(time.time()),
+        'duration': time.perf_counter() - started,
+        'users': len(plan.uids),
+        'charged': len(added),
+        'blocked': len(blocked),
+        'total': _round2(sum(amount for uid, amount, _ in debits if uid in added)),
+    })
+    billing_ledger.finish_run(day, billing_stats)
+    logging.info(
+        "Billing run %s: %s users, %s charged for %.2f RUB, %s blocked, %.3fs",
+        day, billing_stats['users'], billing_stats['charged'], billing_stats['total'],
+        billing_stats['blocked'], billing_stats['duration'],
+    )
+    await _notify_blocked(blocked)
+    return billing_stats
+
+
+def _block_user(uid: str) -> bool:
+    """Поставить активные парсеры на паузу без сохранения (его делает вызывающий)."""
+    from .parsers import stop_monitor
+    paused_any = False
+    for p in user_data[uid].get('parsers', []):
+        if p.get('status') == 'active':
+            p['status'] = 'paused'
+            stop_monitor(int(uid), p)
+            track_active_time(p)
+            cost_aggregate.update(uid, p)
+            paused_any = True
+    return paused_any
+
+
+async def _notify_blocked(blocked: list):
+    for user_id in blocked:
+        await safe_send_message(
+            bot,
+            user_id,
+            "⏸ Недостаточно средств. Все парсеры поставлены на паузу. Пополните баланс командой /topup."
+        )
+
+
+def settle_prorated_batch(batch: int, now: int | None = None) -> list:
+    """Списать накопленное за активные минуты у одной группы пользователей.
+
+    Ключ журнала — час расчёта, так что повтор в том же часу не спишет
+    дважды, а начисления сбрасываются только после записи в журнал (см.
+    ``settle_batch``). Кому не хватает денег, тем парсеры ставятся на паузу,
+    а долг остаётся в ``accrued`` до следующего расчёта. Возвращает
+    заблокированных.
+    """
+    changed, blocked = settle_batch(user_data, batch, billing_ledger, _parser_cost, _block_user, now)
+    if changed:
         save_user_data(user_data)
-        if paused_any:
-            await safe_send_message(
-                bot,
-                user_id,
-                "⏸ Недостаточно средств. Все парсеры поставлены на паузу. Пополните баланс командой /topup.",
-            )
+    return [int(uid) for uid in blocked]
+
+
+async def prorated_billing_loop():
+    """Почасовое списание за фактически активные минуты парсеров.
+
+    Пользователи разбиты на 60 групп по id; каждую минуту часа
+    рассчитывается своя группа, так что за час проходят все, а нагрузка
+    ровная, без пика в 03:00.
+    """
+    while True:
+        now = int(time.time())
+        batch = now // 60 % 60
+        try:
+            started = time.perf_counter()
+            blocked = settle_prorated_batch(batch, now)
+            logging.debug("Prorated batch %s settled in %.3fs", batch, time.perf_counter() - started)
+            await _notify_blocked(blocked)
+        except Exception:
+            logging.exception("Prorated billing failed for batch %s", batch)
+        await asyncio.sleep(60 - time.time() % 60)
 
 
 async def daily_billing_loop():
+    # При старте доводим прогон текущего расчётного дня (если он не завершён),
+    # затем — ежедневно в 03:00 UTC
     while True:
-        for uid in list(user_data.keys()):
-            try:
-                await bill_user_daily(int(uid))
-            except Exception:
-                pass
+        # 1) Списание
+        try:
+            await run_daily_billing()
+        except Exception:
+            logging.exception("Billing run failed")
+        # 2) Ждём до ближайших 03:00 UTC
         now = datetime.utcnow()
-        tomorrow = (now + timedelta(days=1)).replace(hour=3, minute=0, second=0, microsecond=0)
-        sleep_seconds = (tomorrow - now).total_seconds()
+        next_run = now.replace(hour=3, minute=0, second=0, microsecond=0)
+        if next_run <= now:
+            next_run += timedelta(days=1)
+        sleep_seconds = (next_run - now).total_seconds()
         await asyncio.sleep(max(60, sleep_seconds))
 
 
@@ -106,3 +220,38 @@ def check_subscription(user_id: int):
             data['reminder1_sent'] = True
         if data.get('reminder3_sent') or data.get('reminder1_sent'):
             save_user_data(user_data)
+
+
+async def subscription_event(user_id: int, kind: str):
+    """Событие подписки из ``subscription_timers``: напоминание или окончание."""
+    data = user_data.get(str(user_id))
+    if not data:
+        return
+    exp = data.get('subscription_expiry', 0)
+    now = int(datetime.utcnow().timestamp())
+    if kind == 'expiry':
+        if not exp or exp > now or data.get('inactive_notified'):
+            return
+        asyncio.create_task(send_all_results(user_id))
+        await safe_send_message(bot, user_id, t('subscription_inactive'))
+        data['inactive_notified'] = True
+    else:
+        days = 3 if kind == 'reminder3' else 1
+        flag = f'reminder{days}_sent'
+        # Опоздавшее напоминание (бот был выключен) не шлём, если уже пора следующее.
+        if data.get('recurring') or data.get(flag) or exp - now <= (days - 1) * 86400:
+            return
+        await safe_send_message(bot, user_id, t('subscription_reminder', days=days))
+        data[flag] = True
+    save_user_data(user_data)
+
+
+subscription_timers = SubscriptionTimers(subscription_event)
+
+
+def subscription_changed(user_id: int):
+    """Новый срок подписки: сбросить отметки напоминаний и поставить события."""
+    data = get_user_data_entry(user_id)
+    for flag in SENT_FLAGS.values():
+        data[flag] = False
+    subscription_timers.schedule(user_id, data.get('subscription_expiry', 0))
@@ -0,0 +1,53 @@
+from dataclasses import dataclass
+
+import numpy as np
+
+
+@dataclass(slots=True)
+class BillingPlan:
+    """Результат расчёта суточных списаний по всем пользователям.
+
+    Массивы выровнены по ``uids``: ``charge`` — списать ``cost`` (баланс
+    станет ``after``), ``block`` — денег не хватает, парсеры на паузу.
+    """
+
+    uids: list
+    balance: np.ndarray
+    cost: np.ndarray
+    after: np.ndarray
+    charge: np.ndarray
+    block: np.ndarray
+
+    @property
+    def total(self) -> float:
+        return float(self.cost[self.charge].sum())
+
+    def debits(self) -> list:
+        """Тройки (uid, сумма, новый баланс) для списанных пользователей."""
+        return [(self.uids[i], float(self.cost[i]), float(self.after[i])) for i in np.flatnonzero(self.charge)]
+
+    def blocked(self) -> list:
+        return [self.uids[i] for i in np.flatnonzero(self.block)]
+
+
+def user_daily_cost(user: dict, parser_cost) -> float:
+    return sum(parser_cost(p) for p in user.get('parsers', []) if p.get('status', 'paused') == 'active')
+
+
+def plan_daily_debits(users: dict, user_cost) -> BillingPlan:
+    """Посчитать списания за один проход.
+
+    Из записей собираются два столбца — баланс и суточная стоимость
+    активных парсеров (``user_cost(uid)``), дальше всё считается
+    векторно. Данные пользователей не меняются.
+    """
+    uids = list(users)
+    n = len(uids)
+    balance = np.fromiter((float(users[u].get('balance', 0) or 0) for u in uids), dtype=np.float64, count=n)
+    cost = np.fromiter((user_cost(u) for u in uids), dtype=np.float64, count=n)
+    cost = np.round(cost, 2)
+    billable = cost > 0
+    charge = billable & (balance >= cost)
+    block = billable & ~charge
+    after = np.where(charge, np.round(balance - cost, 2), balance)
+    return BillingPlan(uids, balance, cost, after, charge, block)
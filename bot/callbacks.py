@@ -0,0 +1,108 @@
+import inspect
+from dataclasses import dataclass
+
+# Разделитель в callback_data новых кнопок: "parser_pause:3", "leads:2:140".
+SEP = ":"
+
+
+def callback_key(prefix: str, *args) -> str:
+    """Собрать callback_data кнопки из префикса маршрута и аргументов."""
+    return SEP.join((prefix, *map(str, args)))
+
+
+@dataclass(slots=True)
+class Route:
+    handler: object
+    types: tuple
+    required: int
+    state: object
+    wants_state: bool
+
+
+class CallbackRouter:
+    """Один обработчик callback-запросов с таблицей маршрутов по префиксу.
+
+    ``route(prefix, *types)`` регистрирует хендлер; он вызывается как
+    ``handler(call, *args)`` с уже приведёнными аргументами (и ``state=``,
+    если он его принимает). Новые кнопки собираются через ``callback_key``
+    и разбираются одним ``split`` и поиском в словаре. Кнопки старого вида
+    (``parser_pause_3`` в уже отправленных сообщениях) тоже работают:
+    префикс ищется отрезанием хвостовых ``_частей`` — проб не больше, чем
+    подчёркиваний в строке, от числа маршрутов это не зависит.
+
+    ``state`` маршрута — как у aiogram: ``None`` — только вне состояний,
+    ``'*'`` — в любом, иначе состояние (или их список), в котором кнопка
+    действует. Последние ``optional`` типов можно не передавать.
+    """
+
+    def __init__(self):
+        self.routes = {}
+        self.stats = {'calls': 0, 'legacy': 0, 'unknown': 0, 'wrong_state': 0}
+
+    def route(self, prefix: str, *types, optional: int = 0, state=None):
+        def decorator(handler):
+            wants_state = 'state' in inspect.signature(handler).parameters
+            self.routes[prefix] = Route(handler, types, len(types) - optional, state, wants_state)
+            return handler
+        return decorator
+
+    def _parse(self, route: Route, parts: list):
+        if not route.required <= len(parts) <= len(route.types):
+            return None
+        try:
+            return [conv(p) for conv, p in zip(route.types, parts)]
+        except ValueError:
+            return None
+
+    def resolve(self, data: str):
+        """Найти маршрут для callback_data: (Route, аргументы) или None."""
+        if SEP in data:
+            prefix, *parts = data.split(SEP)
+            route = self.routes.get(prefix)
+            if route is not None:
+                args = self._parse(route, parts)
+                if args is not None:
+                    return route, args
+            return None
+        route = self.routes.get(data)
+        if route is not None and route.required == 0:
+            return route, []
+        parts = data.split('_')
+        for cut in range(len(parts) - 1, 0, -1):
+            route = self.routes.get('_'.join(parts[:cut]))
+            if route is not None:
+                args = self._parse(route, parts[cut:])
+                if args is not None:
+                    self.stats['legacy'] += 1
+                    return route, args
+        return None
+
+    @staticmethod
+    def _state_ok(route: Route, current) -> bool:
+        if route.state == '*':
+            return True
+        if route.state is None:
+            return current is None
+        allowed = route.state if isinstance(route.state, (list, tuple, set)) else (route.state,)
+        return any(current == getattr(s, 'state', s) for s in allowed)
+
+    async def dispatch(self, call, state):
+        found = self.resolve(call.data or '')
+        if found is None:
+            self.stats['unknown'] += 1
+            await call.answer()
+            return
+        route, args = found
+        if not self._state_ok(route, await state.get_state()):
+            self.stats['wrong_state'] += 1
+            await call.answer()
+            return
+        self.stats['calls'] += 1
+        if route.wants_state:
+            await route.handler(call, *args, state=state)
+        else:
+            await route.handler(call, *args)
+
+    def install(self, dp):
+        """Повесить маршрутизатор на диспетчер единственным callback-хендлером."""
+        dp.register_callback_query_handler(self.dispatch, state='*')
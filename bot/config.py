@@ -1,9 +1,9 @@
 import logging
 import os
+import secrets
 from dotenv import load_dotenv
 from aiogram import Bot, Dispatcher
 from aiogram.contrib.fsm_storage.memory import MemoryStorage
-from yookassa import Configuration
 
 load_dotenv()
 logging.basicConfig(level=logging.INFO)
@@ -15,6 +15,13 @@ if not API_TOKEN:
 bot = Bot(token=API_TOKEN)
 storage = MemoryStorage()
 dp = Dispatcher(bot, storage=storage)
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
 
 API_TOKEN2 = os.getenv("API_TOKEN2")
 if API_TOKEN2:
@@ -25,19 +32,59 @@ else:
 
 YOOKASSA_SHOP_ID = os.getenv("YOOKASSA_SHOP_ID")
 YOOKASSA_TOKEN = os.getenv("YOOKASSA_TOKEN")
-if YOOKASSA_SHOP_ID and YOOKASSA_TOKEN:
-    Configuration.account_id = YOOKASSA_SHOP_ID
-    Configuration.secret_key = YOOKASSA_TOKEN
-else:
+if not (YOOKASSA_SHOP_ID and YOOKASSA_TOKEN):
     logging.warning("YOOKASSA credentials are missing; payment features may not work")
+YOOKASSA_TIMEOUT = float(os.getenv("YOOKASSA_TIMEOUT", "15"))
+YOOKASSA_RETRIES = int(os.getenv("YOOKASSA_RETRIES", "3"))
+PAYMENT_POLL_FIRST = float(os.getenv("PAYMENT_POLL_FIRST", "3"))
+PAYMENT_POLL_MAX = float(os.getenv("PAYMENT_POLL_MAX", "60"))
+PAYMENT_POLL_TTL = int(os.getenv("PAYMENT_POLL_TTL", "3600"))
+PAYMENT_POLL_BATCH = int(os.getenv("PAYMENT_POLL_BATCH", "20"))
+YOOKASSA_WEBHOOK_PORT = int(os.getenv("YOOKASSA_WEBHOOK_PORT", "0"))
+YOOKASSA_WEBHOOK_HOST = os.getenv("YOOKASSA_WEBHOOK_HOST", "0.0.0.0")
+YOOKASSA_WEBHOOK_PATH = os.getenv("YOOKASSA_WEBHOOK_PATH", "/yookassa/webhook")
+YOOKASSA_WEBHOOK_TRUST_PROXY = os.getenv("YOOKASSA_WEBHOOK_TRUST_PROXY", "0") == "1"
 
 PRO_MONTHLY_RUB = 1490.00
 EXTRA_CHAT_MONTHLY_RUB = 490.00
 DAYS_IN_MONTH = 30
+BILLING_MODE = os.getenv("BILLING_MODE", "daily")
 
 RETURN_URL = "https://t.me/TOPGrabber_bot"
 
 DATA_FILE = "user_data.json"
 TEXT_FILE = "texts.json"
 
+RESULTS_HOT_LIMIT = int(os.getenv("RESULTS_HOT_LIMIT", "1000"))
+RESULTS_HOT_DAYS = int(os.getenv("RESULTS_HOT_DAYS", "30"))
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")
+
+DB_FILE = os.getenv("DB_FILE", "topgrabber.db")
+SEARCH_PAGE_SIZE = 5
+LEADS_PAGE_SIZE = 5
+
+BACKFILL_LIMIT = int(os.getenv("BACKFILL_LIMIT", "500"))
+BACKFILL_DAYS = int(os.getenv("BACKFILL_DAYS", "3"))
+BACKFILL_CONCURRENCY = int(os.getenv("BACKFILL_CONCURRENCY", "2"))
+
+GAP_MAX_MESSAGES = int(os.getenv("GAP_MAX_MESSAGES", "2000"))
+GAP_CHECK_INTERVAL = int(os.getenv("GAP_CHECK_INTERVAL", "30"))
+SESSION_FLUSH_INTERVAL = int(os.getenv("SESSION_FLUSH_INTERVAL", "600"))
+HIBERNATE_AFTER = int(os.getenv("HIBERNATE_AFTER", "900"))
+
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "5000"))
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "8"))
+INGEST_POLICY = os.getenv("INGEST_POLICY", "drop_oldest")
+INGEST_FLOOD_RATE = int(os.getenv("INGEST_FLOOD_RATE", "300"))
+TENANT_CPU_BUDGET = float(os.getenv("TENANT_CPU_BUDGET", "2.0"))
+TENANT_MATCH_BUDGET = int(os.getenv("TENANT_MATCH_BUDGET", "30"))
+DIGEST_INTERVAL = int(os.getenv("DIGEST_INTERVAL", "60"))
+
+POLL_INTERVAL = int(os.getenv("POLL_INTERVAL", "600"))
+POLL_MAX_MESSAGES = int(os.getenv("POLL_MAX_MESSAGES", "1000"))
+POLL_CONCURRENCY = int(os.getenv("POLL_CONCURRENCY", "2"))
+
+EDIT_CACHE_TTL = int(os.getenv("EDIT_CACHE_TTL", "3600"))
+EDIT_CACHE_PER_CHAT = int(os.getenv("EDIT_CACHE_PER_CHAT", "500"))
+
 CHAT_LIMIT = 5
@@ -0,0 +1,65 @@
+from .billing_engine import user_daily_cost
+from .models import parser_key
+
+
+class CostAggregate:
+    """Суточная стоимость активных парсеров по пользователям без пересканирования.
+
+    Вклад каждого парсера (``parser_cost(parser)``, если он активен, иначе 0)
+    запоминается по ``parser_key``, и ``update`` меняет сумму пользователя
+    на разницу. Запись пользователя строится целиком один раз — при первом
+    обращении. Вызывать ``update`` нужно после смены статуса или чатов
+    парсера, ``remove`` — после удаления.
+
+    Здесь же кэшируется прогноз даты блокировки: он пересчитывается, только
+    если изменились баланс, стоимость или дата.
+    """
+
+    def __init__(self, users: dict, parser_cost):
+        self.users = users
+        self.parser_cost = parser_cost
+        self._totals = {}   # uid -> сумма в сутки
+        self._parts = {}    # uid -> {parser_key: вклад}
+        self._blocks = {}   # uid -> (ключ, прогноз)
+
+    def _contribution(self, parser: dict) -> float:
+        return self.parser_cost(parser) if parser.get('status', 'paused') == 'active' else 0.0
+
+    def _build(self, uid: str):
+        parsers = self.users.get(uid, {}).get('parsers', [])
+        self._parts[uid] = {parser_key(p): self._contribution(p) for p in parsers}
+        self._totals[uid] = round(user_daily_cost(self.users.get(uid, {}), self.parser_cost), 2)
+
+    def total(self, user_id) -> float:
+        uid = str(user_id)
+        if uid not in self._totals:
+            self._build(uid)
+        return self._totals[uid]
+
+    def update(self, user_id, parser: dict):
+        uid = str(user_id)
+        if uid not in self._totals:
+            self._build(uid)
+            return
+        parts = self._parts[uid]
+        key = parser_key(parser)
+        new = self._contribution(parser)
+        self._totals[uid] = round(self._totals[uid] + new - parts.get(key, 0.0), 2)
+        parts[key] = new
+
+    def remove(self, user_id, parser: dict):
+        uid = str(user_id)
+        if uid not in self._totals:
+            return
+        old = self._parts[uid].pop(parser_key(parser), 0.0)
+        self._totals[uid] = round(self._totals[uid] - old, 2)
+
+    def block_date(self, user_id, key, compute):
+        """Прогноз блокировки из кэша, если ``key`` (баланс, стоимость, дата) не менялся."""
+        uid = str(user_id)
+        hit = self._blocks.get(uid)
+        if hit and hit[0] == key:
+            return hit[1]
+        value = compute()
+        self._blocks[uid] = (key, value)
+        return value
@@ -1,9 +1,17 @@
 import json
 import os
-import copy
 import logging
 
-from .config import DATA_FILE, CHAT_LIMIT
+from .config import DATA_FILE, CHAT_LIMIT, RESULTS_HOT_LIMIT, RESULTS_HOT_DAYS, ARCHIVE_DIR, DB_FILE, YOOKASSA_TIMEOUT, YOOKASSA_RETRIES
+from .models import user_from_json, user_to_json, json_default
+from .archive import ResultArchive
+from .search import LeadIndex
+from .resolver import ChatResolver
+from .sessions import SessionStore
+from .ledger import BillingLedger
+from .yookassa_client import YooKassaClient
+from .pending import PendingPayments
+from .text_utils import normalize_word
 
 
 def load_user_data():
@@ -12,23 +20,9 @@ def load_user_data():
             with open(DATA_FILE, "r", encoding="utf-8") as f:
                 data = json.load(f)
             from .billing import calc_parser_daily_cost  # local import to avoid circular
+            data = {uid: user_from_json(u, CHAT_LIMIT) for uid, u in data.items()}
             for u in data.values():
-                u.setdefault('subscription_expiry', 0)
-                u.setdefault('recurring', False)
-                u.setdefault('reminder3_sent', False)
-                u.setdefault('reminder1_sent', False)
-                u.setdefault('inactive_notified', False)
-                u.setdefault('used_promos', [])
-                u.setdefault('chat_limit', CHAT_LIMIT)
-                u.setdefault('balance', 0.0)
-                u.setdefault('billing_enabled', True)
                 for p in u.get('parsers', []):
-                    p.setdefault('results', [])
-                    p.setdefault('name', 'Без названия')
-                    p.setdefault('api_id', '')
-                    p.setdefault('api_hash', '')
-                    p.setdefault('status', 'paused')
-                    p.setdefault('daily_price', 0.0)
                     if not p.get('daily_price'):
                         p['daily_price'] = calc_parser_daily_cost(p)
             return data
@@ -39,18 +33,23 @@ def load_user_data():
 
 def save_user_data(data):
     try:
-        data_copy = copy.deepcopy(data)
-        for u in data_copy.values():
-            for p in u.get('parsers', []):
-                p.pop('handler', None)
-                p.pop('event', None)
+        data_copy = {uid: user_to_json(u) for uid, u in data.items()}
         with open(DATA_FILE, "w", encoding="utf-8") as f:
-            json.dump(data_copy, f, ensure_ascii=False, indent=2)
+            json.dump(data_copy, f, ensure_ascii=False, indent=2, default=json_default)
     except Exception:
         logging.exception("Failed to save user data")
 
 
 user_data = load_user_data()
+result_archive = ResultArchive(ARCHIVE_DIR, RESULTS_HOT_LIMIT, RESULTS_HOT_DAYS)
+lead_index = LeadIndex(DB_FILE, normalize_word)
+chat_resolver = ChatResolver(DB_FILE)
+billing_ledger = BillingLedger(DB_FILE)
+payment_client = YooKassaClient(DB_FILE, YOOKASSA_TIMEOUT, YOOKASSA_RETRIES)
+pending_payments = PendingPayments(DB_FILE)
+session_store = SessionStore(DB_FILE)
+session_store.migrate_files()
+session_store.load_all()
 
 
 def get_user_data_entry(user_id: int):
@@ -0,0 +1,50 @@
+import time
+from collections import OrderedDict
+
+
+class TokenCache:
+    """Нормализованные слова недавних сообщений — для разбора правок.
+
+    На каждый чат (``scope``) хранится не больше ``per_chat`` последних
+    сообщений не дольше ``ttl`` секунд. При правке сравнивается новый
+    набор слов со старым, и ключевые слова ищутся только среди
+    появившихся: совпавшее до правки повторно не уведомляется.
+    """
+
+    def __init__(self, ttl: int = 3600, per_chat: int = 500):
+        self.ttl = ttl
+        self.per_chat = max(1, per_chat)
+        self._chats = {}    # scope -> OrderedDict(msg_id -> (истекает, hash текста, слова))
+
+    def _bucket(self, scope) -> OrderedDict:
+        bucket = self._chats.get(scope)
+        if bucket is None:
+            bucket = self._chats[scope] = OrderedDict()
+        now = time.monotonic()
+        while bucket and next(iter(bucket.values()))[0] < now:
+            bucket.popitem(last=False)
+        return bucket
+
+    def unchanged(self, scope, msg_id: int, text: str) -> bool:
+        """Текст тот же, что уже разобран (правка реакций, кнопок и т. п.)."""
+        entry = self._bucket(scope).get(msg_id)
+        return entry is not None and entry[1] == hash(text)
+
+    def update(self, scope, msg_id: int, text: str, words) -> frozenset:
+        """Запомнить слова сообщения; вернуть те, которых раньше не было.
+
+        Для неизвестного сообщения (старше ``ttl`` или пришедшего до старта)
+        новыми считаются все слова.
+        """
+        bucket = self._bucket(scope)
+        tokens = frozenset(words)
+        old = bucket.pop(msg_id, None)
+        bucket[msg_id] = (time.monotonic() + self.ttl, hash(text), tokens)
+        if len(bucket) > self.per_chat:
+            bucket.popitem(last=False)
+        return tokens - old[2] if old else tokens
+
+    def forget(self, scope_prefix):
+        """Удалить кэш всех чатов парсера (scope вида ``(prefix, chat_id)``)."""
+        for scope in [s for s in self._chats if s[0] == scope_prefix]:
+            del self._chats[scope]
@@ -0,0 +1,90 @@
+import html
+import logging
+import time
+from collections import defaultdict
+
+
+class TenantUsage:
+    """Поминутный учёт нагрузки пользователей: CPU на матчинг и число совпадений.
+
+    ``charge_cpu`` получает процессорное время (``time.process_time``)
+    синхронной части матчинга, между замерами которой нет ``await``, —
+    ожидание API и чужие корутины в него не попадают. Пользователь,
+    превысивший ``cpu_budget`` секунд CPU за минуту, получает пониженный вес
+    в очереди обработки (его сообщения ждут дольше); превысивший
+    ``match_budget`` совпадений — уведомления сводкой.
+    """
+
+    def __init__(self, cpu_budget: float = 2.0, match_budget: int = 30):
+        self.cpu_budget = cpu_budget
+        self.match_budget = match_budget
+        self._usage = {}    # user -> [window, cpu, matches]
+
+    def _row(self, user_id) -> list:
+        window = int(time.monotonic() // 60)
+        row = self._usage.get(user_id)
+        if row is None or row[0] != window:
+            row = self._usage[user_id] = [window, 0.0, 0]
+        return row
+
+    def charge_cpu(self, user_id, seconds: float):
+        self._row(user_id)[1] += seconds
+
+    def charge_match(self, user_id):
+        self._row(user_id)[2] += 1
+
+    def over_cpu(self, user_id) -> bool:
+        return self._row(user_id)[1] > self.cpu_budget
+
+    def over_matches(self, user_id) -> bool:
+        return self._row(user_id)[2] > self.match_budget
+
+    def weight(self, user_id) -> float:
+        return 0.25 if self.over_cpu(user_id) else 1.0
+
+    def heavy(self) -> list:
+        """Пользователи, превысившие любой из бюджетов в текущей минуте."""
+        window = int(time.monotonic() // 60)
+        return [
+            (uid, round(cpu, 3), matches)
+            for uid, (w, cpu, matches) in self._usage.items()
+            if w == window and (cpu > self.cpu_budget or matches > self.match_budget)
+        ]
+
+
+class DigestBuffer:
+    """Отложенные уведомления для пользователей, ушедших в режим сводки."""
+
+    def __init__(self):
+        self._items = defaultdict(list)
+
+    def add(self, user_id, result):
+        self._items[user_id].append(result)
+
+    def drain(self) -> dict:
+        items, self._items = self._items, defaultdict(list)
+        return items
+
+
+def digest_text(results: list, limit: int = 15) -> str:
+    lines = [f"📦 Сводка: {len(results)} новых совпадений за последние минуты"]
+    for r in results[-limit:]:
+        lines.append(f"• '{html.escape(r.keyword)}' — {html.escape(r.chat)} — {html.escape(r.link)}")
+    if len(results) > limit:
+        lines.append(f"…и ещё {len(results) - limit}. Все результаты — в меню парсера.")
+    return "\n".join(lines)
+
+
+async def deliver_digest(user_id, results: list, senders, send) -> bool:
+    """Отправить сводку первым ботом из ``senders``, который её доставит.
+
+    ``send(sender, user_id, text)`` возвращает сообщение или None, как
+    ``safe_send_message``; пустые ``senders`` (бот не настроен) пропускаются.
+    False — сводку не доставил ни один бот.
+    """
+    text = digest_text(results)
+    for sender in senders:
+        if sender and await send(sender, user_id, text) is not None:
+            return True
+    logging.warning("Failed to deliver digest of %s results to %s", len(results), user_id)
+    return False
@@ -16,13 +16,25 @@ from telethon.errors import (
 
 from .config import dp, bot
 from .states import PromoStates, ParserStates, EditParserStates, ExpandProStates, TopUpStates, PartnerTransferStates
-from .utils import ui_send_new, ui_from_callback_edit, safe_send_message, get_or_create_user_entry
-from .data import user_data, get_user_data_entry, save_user_data
+from .utils import ui_send_new, ui_from_callback_edit, get_or_create_user_entry
+from .data import user_data, get_user_data_entry, save_user_data, result_archive, lead_index, chat_resolver, session_store
+from .config import SEARCH_PAGE_SIZE, LEADS_PAGE_SIZE, POLL_INTERVAL, BILLING_MODE, YOOKASSA_WEBHOOK_HOST, YOOKASSA_WEBHOOK_PORT, PRO_MONTHLY_RUB, CHAT_LIMIT
 from .text_utils import t, INFO_TEXT, HELP_TEXT, normalize_word
-from .payments import create_topup_payment, wait_topup_and_credit, create_pro_payment, wait_payment_and_activate, check_payment
-from .billing import total_daily_cost, predict_block_date, _round2, check_subscription
-from .keyboards import main_menu_keyboard, parser_settings_keyboard
-from .parsers import pause_parser, resume_parser, parser_info_text, start_monitor, send_all_results, send_parser_results, user_clients
+from .pending import mark_applied
+from .payments import create_topup_payment, create_pro_payment, action_op, check_payment, payment_poller, yookassa_webhook, reconcile_pending_payments
+from .billing import (
+    total_daily_cost, predict_block_date, _round2, check_subscription, daily_billing_loop, cost_aggregate,
+    subscription_changed, subscription_timers, prorated_billing_loop, track_active_time, calc_parser_daily_cost,
+)
+from .keyboards import main_menu_keyboard, parser_settings_keyboard, backfill_keyboard
+from .models import CSV_HEADER, parser_key
+from .callbacks import CallbackRouter, callback_key
+from .api_scheduler import api_call, release_scheduler, INTERACTIVE
+from .parsers import is_monitoring, pause_parser, resume_parser, parser_info_text, start_monitor, send_all_results, send_parser_results, user_clients, run_backfill, _backfills_running, restore_clients, connection_watchdog, recover_gaps, wake_client, client_supervisor, digest_loop, stop_monitor
+
+callbacks = CallbackRouter()
+callbacks.install(dp)
+
 
 @dp.message_handler(commands=["help"])
 async def cmd_help(message: types.Message):
@@ -90,19 +102,23 @@ def main_menu_keyboard() -> types.InlineKeyboardMarkup:
 def parser_settings_keyboard(idx: int) -> types.InlineKeyboardMarkup:
     kb = types.InlineKeyboardMarkup(row_width=2)
     kb.add(
-        types.InlineKeyboardButton("▶️ Запустить", callback_data=f"parser_resume_{idx}"),
-        types.InlineKeyboardButton("⏸ Пауза", callback_data=f"parser_pause_{idx}"),
+        types.InlineKeyboardButton("▶️ Запустить", callback_data=callback_key('parser_resume', idx)),
+        types.InlineKeyboardButton("⏸ Пауза", callback_data=callback_key('parser_pause', idx)),
     )
     kb.add(
-        types.InlineKeyboardButton("🛠 Изменить название", callback_data=f"edit_name_{idx}"),
-        types.InlineKeyboardButton("📂 Изменить чаты", callback_data=f"edit_chats_{idx}"),
+        types.InlineKeyboardButton("🛠 Изменить название", callback_data=callback_key('edit_name', idx)),
+        types.InlineKeyboardButton("📂 Изменить чаты", callback_data=callback_key('edit_chats', idx)),
     )
     kb.add(
-        types.InlineKeyboardButton("📂 Изменить слова", callback_data=f"edit_keywords_{idx}"),
-        types.InlineKeyboardButton("📂 Изменить искл-слова", callback_data=f"edit_exclude_{idx}"),
+        types.InlineKeyboardButton("📂 Изменить слова", callback_data=callback_key('edit_keywords', idx)),
+        types.InlineKeyboardButton("📂 Изменить искл-слова", callback_data=callback_key('edit_exclude', idx)),
     )
     kb.add(
-        types.InlineKeyboardButton("🗑 Удалить (только на паузе)", callback_data=f"parser_delete_{idx}"),
+        types.InlineKeyboardButton("📋 Последние лиды", callback_data=callback_key('leads', idx)),
+        types.InlineKeyboardButton("🔄 Онлайн / опрос", callback_data=callback_key('parser_mode', idx)),
+    )
+    kb.add(
+        types.InlineKeyboardButton("🗑 Удалить (только на паузе)", callback_data=callback_key('parser_delete', idx)),
     )
     kb.add(types.InlineKeyboardButton("🔙 Назад", callback_data="back_main"))
     return kb
@@ -116,9 +132,9 @@ class PartnerTransferStates(StatesGroup):
     waiting_amount = State()
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith('parser_pause_'))
-async def cb_parser_pause(call: types.CallbackQuery):
-    idx = int(call.data.split('_')[2]) - 1
+@callbacks.route('parser_pause', int)
+async def cb_parser_pause(call: types.CallbackQuery, num: int):
+    idx = num - 1
     user_id = call.from_user.id
     data = user_data.get(str(user_id), {})
     if not data or idx < 0 or idx >= len(data.get('parsers', [])):
@@ -132,9 +148,9 @@ async def cb_parser_pause(call: types.CallbackQuery):
     await ui_from_callback_edit(call, "⏸ Парсер поставлен на паузу.")
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith('parser_resume_'))
-async def cb_parser_resume(call: types.CallbackQuery):
-    idx = int(call.data.split('_')[2]) - 1
+@callbacks.route('parser_resume', int)
+async def cb_parser_resume(call: types.CallbackQuery, num: int):
+    idx = num - 1
     user_id = call.from_user.id
     data = user_data.get(str(user_id), {})
     if not data or idx < 0 or idx >= len(data.get('parsers', [])):
@@ -147,9 +163,38 @@ async def cb_parser_resume(call: types.CallbackQuery):
     await ui_from_callback_edit(call, "▶️ Парсер запущен.")
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith('parser_delete_'))
-async def cb_parser_delete(call: types.CallbackQuery):
-    idx = int(call.data.split('_')[2]) - 1
+@callbacks.route('parser_mode', int)
+async def cb_parser_mode(call: types.CallbackQuery, num: int):
+    idx = num - 1
+    user_id = call.from_user.id
+    data = user_data.get(str(user_id), {})
+    if not data or idx < 0 or idx >= len(data.get('parsers', [])):
+        await call.answer("Не найдено", show_alert=True)
+        return
+    p = data['parsers'][idx]
+    p['mode'] = 'realtime' if p.get('mode') == 'poll' else 'poll'
+    save_user_data(user_data)
+    if p.get('status') == 'active':
+        stop_monitor(user_id, p)
+        await wake_client(user_id)
+        await start_monitor(user_id, p)
+        if p['mode'] == 'realtime':
+            # Догоняем сообщения с последнего опроса.
+            asyncio.create_task(recover_gaps(user_id))
+    if p['mode'] == 'poll':
+        interval = (p.get('poll_interval') or POLL_INTERVAL) // 60
+        text = (
+            f"⏱ Парсер переведён в режим опроса: чаты проверяются раз в {interval} мин, "
+            "найденное приходит одной сводкой."
+        )
+    else:
+        text = "⚡️ Парсер переведён в режим реального времени."
+    await ui_from_callback_edit(call, text, reply_markup=parser_settings_keyboard(idx + 1))
+
+
+@callbacks.route('parser_delete', int)
+async def cb_parser_delete(call: types.CallbackQuery, num: int):
+    idx = num - 1
     user_id = call.from_user.id
     data = user_data.get(str(user_id), {})
     if not data or idx < 0 or idx >= len(data.get('parsers', [])):
@@ -162,7 +207,10 @@ async def cb_parser_delete(call: types.CallbackQuery):
         return
     stop_monitor(user_id, p)
     await send_parser_results(user_id, idx)  # как и раньше — отдадим CSV перед удалением
-    data['parsers'].pop(idx)
+    removed = data['parsers'].pop(idx)
+    cost_aggregate.remove(user_id, removed)
+    result_archive.drop(removed)
+    lead_index.drop_parser(removed)
     save_user_data(user_data)
     await ui_from_callback_edit(call, "🗑 Парсер удалён.")
     await call.answer()
@@ -186,7 +234,7 @@ async def topup_amount(message: types.Message, state: FSMContext):
         await ui_send_new(message.from_user.id, "Минимальная сумма пополнения — 300 ₽. Введите другую сумму:")
         return
     user_id = message.from_user.id
-    payment_id, url = create_topup_payment(user_id, amount)
+    payment_id, url = await create_topup_payment(user_id, amount, op=await action_op(state, 'topup'))
     if not payment_id:
         await ui_send_new(message.from_user.id, "Не удалось создать платёж. Попробуйте позже.")
     else:
@@ -196,51 +244,10 @@ async def topup_amount(message: types.Message, state: FSMContext):
         kb = types.InlineKeyboardMarkup()
         kb.add(types.InlineKeyboardButton("Оплатить сейчас", url=url))
         await ui_send_new(message.from_user.id, "Нажмите кнопку для оплаты.", reply_markup=kb)
-        asyncio.create_task(wait_topup_and_credit(user_id, payment_id, amount))
+        payment_poller.add('topup', payment_id, user_id, amount=amount)
     await state.finish()
 
 
-async def bill_user_daily(user_id: int):
-    data = user_data.get(str(user_id), {})
-    if not data:
-        return
-    per_day = total_daily_cost(user_id)
-    if per_day <= 0:
-        return
-    bal = float(data.get('balance', 0))
-    if bal >= per_day:
-        data['balance'] = _round2(bal - per_day)
-        save_user_data(user_data)
-    else:
-        paused_any = False
-        for p in data.get('parsers', []):
-            if p.get('status') == 'active':
-                pause_parser(user_id, p)
-                paused_any = True
-        save_user_data(user_data)
-        if paused_any:
-            await safe_send_message(
-                bot,
-                user_id,
-                "⏸ Недостаточно средств. Все парсеры поставлены на паузу. Пополните баланс командой /topup."
-            )
-
-async def daily_billing_loop():
-    # Списываем сразу при старте и затем — ежедневно в 03:00 UTC (пример)
-    while True:
-        # 1) Списание
-        for uid in list(user_data.keys()):
-            try:
-                await bill_user_daily(int(uid))
-            except Exception:
-                logging.exception("Billing error for %s", uid)
-        # 2) Ждём до следующего дня 03:00 UTC
-        now = datetime.utcnow()
-        tomorrow = (now + timedelta(days=1)).replace(hour=3, minute=0, second=0, microsecond=0)
-        sleep_seconds = (tomorrow - now).total_seconds()
-        await asyncio.sleep(max(60, sleep_seconds))
-
-
 def parser_info_text(user_id: int, parser: dict, created: bool = False) -> str:
     idx = parser.get('id') or 1
     name = parser.get('name', f'Парсер_{idx}')
@@ -255,8 +262,8 @@ def parser_info_text(user_id: int, parser: dict, created: bool = False) -> str:
     else:
         paid_to = '—'
     chat_limit = f"/{data.get('chat_limit', CHAT_LIMIT)}" if plan_name == 'PRO' else ''
-    status_emoji = '🟢' if parser.get('handler') else '⏸'
-    status_text = 'Активен' if parser.get('handler') else 'Остановлен'
+    status_emoji = '🟢' if is_monitoring(parser) else '⏸'
+    status_text = 'Активен' if is_monitoring(parser) else 'Остановлен'
     if created:
         return t('parser_created', id=idx)
     return t(
@@ -308,6 +315,8 @@ async def cmd_clear_result(message: types.Message):
     if data:
         for parser in data.get('parsers', []):
             parser['results'] = []
+            result_archive.drop(parser)
+            lead_index.drop_parser(parser)
         save_user_data(user_data)
 
 
@@ -339,33 +348,31 @@ async def cmd_delete_parser(message: types.Message):
     kb = types.InlineKeyboardMarkup(row_width=1)
     for idx, p in parsers:
         name = p.get('name', f'Парсер {idx + 1}')
-        kb.add(types.InlineKeyboardButton(name, callback_data=f'delp_select_{idx}'))
+        kb.add(types.InlineKeyboardButton(name, callback_data=callback_key('delp_select', idx)))
     kb.add(types.InlineKeyboardButton("🔙 Назад", callback_data="back_main"))
     await ui_send_new(message.from_user.id, "Выберите парсер для удаления:", reply_markup=kb)
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith('delp_select_'))
-async def cb_delp_select(call: types.CallbackQuery):
-    idx = int(call.data.split('_')[2])
+@callbacks.route('delp_select', int)
+async def cb_delp_select(call: types.CallbackQuery, idx: int):
     kb = types.InlineKeyboardMarkup(row_width=2)
     kb.add(
         types.InlineKeyboardButton("Нет", callback_data='delp_cancel'),
-        types.InlineKeyboardButton("Да", callback_data=f'delp_confirm_{idx}')
+        types.InlineKeyboardButton("Да", callback_data=callback_key('delp_confirm', idx))
     )
     await ui_from_callback_edit(call, "Удалить парсер?", reply_markup=kb)
     await call.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data == 'delp_cancel')
+@callbacks.route('delp_cancel')
 async def cb_delp_cancel(call: types.CallbackQuery):
     await ui_from_callback_edit(call, "Удаление отменено.")
     await ui_from_callback_edit(call, t('menu_main'), reply_markup=main_menu_keyboard())
     await call.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith('delp_confirm_'))
-async def cb_delp_confirm(call: types.CallbackQuery):
-    idx = int(call.data.split('_')[2])
+@callbacks.route('delp_confirm', int)
+async def cb_delp_confirm(call: types.CallbackQuery, idx: int):
     user_id = call.from_user.id
     await send_parser_results(user_id, idx)
     data = user_data.get(str(user_id))
@@ -376,20 +383,23 @@ async def cb_delp_confirm(call: types.CallbackQuery):
             await call.answer()
             return
         stop_monitor(user_id, parser)
-        data['parsers'].pop(idx)
+        removed = data['parsers'].pop(idx)
+        cost_aggregate.remove(user_id, removed)
+        result_archive.drop(removed)
+        lead_index.drop_parser(removed)
         save_user_data(user_data)
         await ui_from_callback_edit(call, "Парсер удалён.")
     await ui_from_callback_edit(call, t('menu_main'), reply_markup=main_menu_keyboard())
     await call.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data == 'back_main')
+@callbacks.route('back_main')
 async def cb_back_main(call: types.CallbackQuery):
     await ui_from_callback_edit(call, t('menu_main'), reply_markup=main_menu_keyboard())
     await call.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data == 'menu_setup')
+@callbacks.route('menu_setup')
 async def cb_menu_setup(call: types.CallbackQuery):
     kb = types.InlineKeyboardMarkup(row_width=1)
     kb.add(
@@ -402,18 +412,18 @@ async def cb_menu_setup(call: types.CallbackQuery):
     await call.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data == 'setup_new')
+@callbacks.route('setup_new')
 async def cb_setup_new(call: types.CallbackQuery, state: FSMContext):
     await call.answer()
     await cmd_add_parser(call.message, state)
 
 
-@dp.callback_query_handler(lambda c: c.data == 'setup_list')
+@callbacks.route('setup_list')
 async def cb_setup_list(call: types.CallbackQuery):
     await cb_active_parsers(call)
 
 
-@dp.callback_query_handler(lambda c: c.data == 'setup_pay')
+@callbacks.route('setup_pay')
 async def cb_setup_pay(call: types.CallbackQuery, state: FSMContext):
     """Show list of parsers for payment actions."""
     data = user_data.get(str(call.from_user.id))
@@ -424,46 +434,44 @@ async def cb_setup_pay(call: types.CallbackQuery, state: FSMContext):
     kb = types.InlineKeyboardMarkup(row_width=1)
     for idx, p in enumerate(data.get('parsers'), 1):
         name = p.get('name', f'Парсер {idx}')
-        kb.add(types.InlineKeyboardButton(name, callback_data=f'pay_select_{idx - 1}'))
+        kb.add(types.InlineKeyboardButton(name, callback_data=callback_key('pay_select', idx - 1)))
     kb.add(types.InlineKeyboardButton("🔙 Назад", callback_data="menu_setup"))
     await ui_from_callback_edit(call, "Выберите парсер:", reply_markup=kb)
     await call.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith('pay_select_'))
-async def cb_pay_select(call: types.CallbackQuery):
+@callbacks.route('pay_select', int)
+async def cb_pay_select(call: types.CallbackQuery, idx: int):
     """Show payment options for selected parser."""
-    idx = int(call.data.split('_')[2])
     kb = types.InlineKeyboardMarkup(row_width=1)
     kb.add(
-        types.InlineKeyboardButton("Продлить подписку", callback_data=f'pay_renew_{idx}'),
-        types.InlineKeyboardButton("Расширить Pro", callback_data=f'pay_expand_{idx}'),
-        types.InlineKeyboardButton("Перейти на Infinity", callback_data=f'pay_infinity_{idx}'),
+        types.InlineKeyboardButton("Продлить подписку", callback_data=callback_key('pay_renew', idx)),
+        types.InlineKeyboardButton("Расширить Pro", callback_data=callback_key('pay_expand', idx)),
+        types.InlineKeyboardButton("Перейти на Infinity", callback_data=callback_key('pay_infinity', idx)),
         types.InlineKeyboardButton("🔙 Назад", callback_data='setup_pay'),
     )
     await ui_from_callback_edit(call, "Выберите действие:", reply_markup=kb)
     await call.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith('pay_renew_'))
-async def cb_pay_renew(call: types.CallbackQuery, state: FSMContext):
+@callbacks.route('pay_renew', int)
+async def cb_pay_renew(call: types.CallbackQuery, idx: int, state: FSMContext):
     """Renew PRO subscription."""
     await _process_tariff_pro(call.message, state)
     await call.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith('pay_expand_'))
-async def cb_pay_expand(call: types.CallbackQuery, state: FSMContext):
+@callbacks.route('pay_expand', int)
+async def cb_pay_expand(call: types.CallbackQuery, idx: int, state: FSMContext):
     """Start process to expand PRO plan chats."""
-    idx = int(call.data.split('_')[2])
     await state.update_data(expand_idx=idx)
     await ui_from_callback_edit(call, "Сколько чатов вам нужно?")
     await ExpandProStates.waiting_chats.set()
     await call.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith('pay_infinity_'))
-async def cb_pay_infinity(call: types.CallbackQuery):
+@callbacks.route('pay_infinity', int)
+async def cb_pay_infinity(call: types.CallbackQuery, idx: int):
     """Inform about INFINITY plan."""
     keyboard111 = types.InlineKeyboardMarkup()
     keyboard111.add(types.InlineKeyboardButton(text="Подключить", url="https://t.me/antufev2025"))
@@ -498,16 +506,17 @@ async def expand_pro_chats(message: types.Message, state: FSMContext):
     await ExpandProStates.waiting_confirm.set()
 
 
-@dp.callback_query_handler(lambda c: c.data == 'expand_confirm', state=ExpandProStates.waiting_confirm)
+@callbacks.route('expand_confirm', state=ExpandProStates.waiting_confirm)
 async def cb_expand_confirm(call: types.CallbackQuery, state: FSMContext):
     data = await state.get_data()
     price = data.get('price')
     chats = data.get('chats')
     user_id = call.from_user.id
-    payment_id, url = create_payment(
+    payment_id, url = await create_payment(
         user_id,
         f"{price:.2f}",
         f"Расширение PRO до {chats} чатов для пользователя {user_id}",
+        op=await action_op(state, 'expand'),
     )
     if not payment_id:
         await ui_from_callback_edit(call, "Не удалось создать платёж. Попробуйте позже.")
@@ -518,26 +527,26 @@ async def cb_expand_confirm(call: types.CallbackQuery, state: FSMContext):
         kb = types.InlineKeyboardMarkup()
         kb.add(types.InlineKeyboardButton("Оплатить сейчас", url=url))
         await ui_from_callback_edit(call, "Нажмите кнопку для оплаты.", reply_markup=kb)
-        asyncio.create_task(wait_payment_and_activate(user_id, payment_id, chats))
+        payment_poller.add('expand', payment_id, user_id, amount=price, chats=chats)
     await state.finish()
     await call.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data == 'expand_cancel', state=ExpandProStates.waiting_confirm)
+@callbacks.route('expand_cancel', state=ExpandProStates.waiting_confirm)
 async def cb_expand_cancel(call: types.CallbackQuery, state: FSMContext):
     await ui_from_callback_edit(call, "Действие отменено.")
     await state.finish()
     await call.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data == 'expand_back', state=ExpandProStates.waiting_confirm)
+@callbacks.route('expand_back', state=ExpandProStates.waiting_confirm)
 async def cb_expand_back(call: types.CallbackQuery, state: FSMContext):
     await ui_from_callback_edit(call, "Сколько чатов вам нужно?")
     await ExpandProStates.waiting_chats.set()
     await call.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data == 'menu_export')
+@callbacks.route('menu_export')
 async def cb_menu_export(call: types.CallbackQuery):
     kb = types.InlineKeyboardMarkup(row_width=1)
     kb.add(
@@ -550,19 +559,19 @@ async def cb_menu_export(call: types.CallbackQuery):
     await call.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data == 'export_all')
+@callbacks.route('export_all')
 async def cb_export_all(call: types.CallbackQuery):
     await send_all_results(call.from_user.id)
     await ui_from_callback_edit(call, t('menu_main'), reply_markup=main_menu_keyboard())
     await call.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data == 'export_choose')
+@callbacks.route('export_choose')
 async def cb_export_choose(call: types.CallbackQuery):
     await cb_result(call)
 
 
-@dp.callback_query_handler(lambda c: c.data == 'export_alert')
+@callbacks.route('export_alert')
 async def cb_export_alert(call: types.CallbackQuery):
     link = f"https://t.me/topgraber_yved_bot"
     await ui_from_callback_edit(call, 
@@ -572,7 +581,7 @@ async def cb_export_alert(call: types.CallbackQuery):
     await call.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data == 'menu_help')
+@callbacks.route('menu_help')
 async def cb_menu_help(call: types.CallbackQuery):
     kb = types.InlineKeyboardMarkup(row_width=1)
     kb.add(
@@ -586,24 +595,24 @@ async def cb_menu_help(call: types.CallbackQuery):
     await call.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data == 'help_start')
+@callbacks.route('help_start')
 async def cb_help_start(call: types.CallbackQuery):
     await cmd_help(call.message)
     await call.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data == 'help_support')
+@callbacks.route('help_support')
 async def cb_help_support(call: types.CallbackQuery):
     await ui_from_callback_edit(call, "Свяжитесь с поддержкой: https://t.me/TopGrabberSupport")
     await call.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data == 'help_about')
+@callbacks.route('help_about')
 async def cb_help_about(call: types.CallbackQuery):
     await cb_info(call)
 
 
-@dp.callback_query_handler(lambda c: c.data == 'menu_profile')
+@callbacks.route('menu_profile')
 async def cb_menu_profile(call: types.CallbackQuery):
     data = user_data.get(str(call.from_user.id), {})
     now = int(datetime.utcnow().timestamp())
@@ -657,14 +666,14 @@ async def cb_menu_profile(call: types.CallbackQuery):
     await call.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data == 'profile_topup')
+@callbacks.route('profile_topup')
 async def cb_profile_topup(call: types.CallbackQuery):
     await ui_from_callback_edit(call, "Введите сумму пополнения (минимум 300 ₽):")
     await TopUpStates.waiting_amount.set()
     await call.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data == 'profile_paybalance')
+@callbacks.route('profile_paybalance')
 async def cb_profile_paybalance(call: types.CallbackQuery, state: FSMContext):
     data = get_user_data_entry(call.from_user.id)
     ref_bal = float(data.get('ref_balance', 0))
@@ -701,13 +710,13 @@ async def partner_transfer_amount(message: types.Message, state: FSMContext):
     await state.finish()
 
 
-@dp.callback_query_handler(lambda c: c.data == 'profile_withdraw')
+@callbacks.route('profile_withdraw')
 async def cb_profile_withdraw(call: types.CallbackQuery):
     await ui_from_callback_edit(call, "Функция вывода средств пока недоступна.")
     await call.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data == 'profile_delete_card')
+@callbacks.route('profile_delete_card')
 async def cb_profile_delete_card(call: types.CallbackQuery):
     await ui_from_callback_edit(call, "Данные карты удалены.")
     await call.answer()
@@ -738,7 +747,7 @@ async def cmd_tariff_pro(message: types.Message, state: FSMContext):
     )
 
 
-@dp.callback_query_handler(lambda c: c.data == 'tariff_pro')
+@callbacks.route('tariff_pro')
 async def cb_tariff_pro(call: types.CallbackQuery, state: FSMContext):
     await _process_tariff_pro(
         user_id=call.from_user.id,         # кто нажал кнопку
@@ -763,7 +772,7 @@ async def promo_entered(message: types.Message, state: FSMContext):
             "Перейдите по ссылке для оплаты тарифа PRO.",
             reply_markup=types.ReplyKeyboardRemove(),
         )
-        payment_id, url = create_pro_payment(user_id)
+        payment_id, url = await create_pro_payment(user_id, op=await action_op(state, 'pro'))
         if not payment_id:
             await ui_send_new(user_id, "Не удалось создать платёж. Попробуйте позже.")
         else:
@@ -772,8 +781,8 @@ async def promo_entered(message: types.Message, state: FSMContext):
             kb = types.InlineKeyboardMarkup()
             kb.add(types.InlineKeyboardButton("Оплатить сейчас", url=url))
             await ui_send_new(user_id, "Нажмите кнопку для оплаты.", reply_markup=kb)
-            asyncio.create_task(
-                wait_payment_and_activate(user_id, payment_id, data.get('chat_limit', CHAT_LIMIT))
+            payment_poller.add(
+                'pro', payment_id, user_id, amount=PRO_MONTHLY_RUB, chats=data.get('chat_limit', CHAT_LIMIT)
             )
         await state.finish()
         return
@@ -795,6 +804,7 @@ async def promo_entered(message: types.Message, state: FSMContext):
         expiry = int((datetime.utcnow() + timedelta(days=7)).timestamp())
         data['subscription_expiry'] = expiry
         used_promos.append(code)
+        subscription_changed(user_id)
         save_user_data(user_data)
         await ui_send_new(user_id,
             "Промокод принят! Вам предоставлено 7 дней бесплатного тарифа PRO.",
@@ -819,7 +829,7 @@ async def promo_entered(message: types.Message, state: FSMContext):
         "Перейдите по ссылке для оплаты тарифа PRO.",
         reply_markup=types.ReplyKeyboardRemove(),
     )
-    payment_id, url = create_pro_payment(user_id)
+    payment_id, url = await create_pro_payment(user_id, op=await action_op(state, 'pro'))
     if not payment_id:
         await ui_send_new(user_id, "Не удалось создать платёж. Попробуйте позже.")
     else:
@@ -828,14 +838,14 @@ async def promo_entered(message: types.Message, state: FSMContext):
         kb = types.InlineKeyboardMarkup()
         kb.add(types.InlineKeyboardButton("Оплатить сейчас", url=url))
         await ui_send_new(user_id, "Нажмите кнопку для оплаты.", reply_markup=kb)
-        asyncio.create_task(
-            wait_payment_and_activate(user_id, payment_id, data.get('chat_limit', CHAT_LIMIT))
+        payment_poller.add(
+            'pro', payment_id, user_id, amount=PRO_MONTHLY_RUB, chats=data.get('chat_limit', CHAT_LIMIT)
         )
     await state.finish()
 
 
 
-@dp.callback_query_handler(lambda c: c.data == 'result')
+@callbacks.route('result')
 async def cb_result(call: types.CallbackQuery):
     data = user_data.get(str(call.from_user.id))
     if not data or not data.get('parsers'):
@@ -845,25 +855,25 @@ async def cb_result(call: types.CallbackQuery):
     kb = types.InlineKeyboardMarkup(row_width=1)
     for idx, p in enumerate(data.get('parsers'), 1):
         name = p.get('name', f'Парсер {idx}')
-        kb.add(types.InlineKeyboardButton(name, callback_data=f"csv_{idx}"))
+        kb.add(types.InlineKeyboardButton(name, callback_data=callback_key('csv', idx)))
     kb.add(types.InlineKeyboardButton("🔙 Назад", callback_data="back_main"))
     await ui_from_callback_edit(call, "Выберите парсер для получения CSV:", reply_markup=kb)
     await call.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data == 'help_info')
+@callbacks.route('help_info')
 async def cb_help(call: types.CallbackQuery):
     await ui_from_callback_edit(call, HELP_TEXT)
     await call.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data == 'info')
+@callbacks.route('info')
 async def cb_info(call: types.CallbackQuery):
     await ui_from_callback_edit(call, INFO_TEXT)
     await call.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data == 'active_parsers')
+@callbacks.route('active_parsers')
 async def cb_active_parsers(call: types.CallbackQuery):
     data = user_data.get(str(call.from_user.id))
     if not data or not data.get('parsers'):
@@ -873,15 +883,15 @@ async def cb_active_parsers(call: types.CallbackQuery):
     kb = types.InlineKeyboardMarkup(row_width=1)
     for idx, p in enumerate(data.get('parsers'), 1):
         name = p.get('name', f'Парсер {idx}')
-        kb.add(types.InlineKeyboardButton(name, callback_data=f"edit_{idx}"))
+        kb.add(types.InlineKeyboardButton(name, callback_data=callback_key('edit', idx)))
     kb.add(types.InlineKeyboardButton("🔙 Назад", callback_data="back_main"))
     await ui_from_callback_edit(call, "Активные парсеры:", reply_markup=kb)
     await call.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith('csv_'))
-async def cb_send_csv(call: types.CallbackQuery):
-    idx = int(call.data.split('_')[1]) - 1
+@callbacks.route('csv', int)
+async def cb_send_csv(call: types.CallbackQuery, num: int):
+    idx = num - 1
     user_id = call.from_user.id
     check_subscription(user_id)
     data = user_data.get(str(user_id))
@@ -895,24 +905,15 @@ async def cb_send_csv(call: types.CallbackQuery):
         await call.answer()
         return
     parser = parsers[idx]
-    results = parser.get('results', [])
-    if not results:
+    if not result_archive.total(parser):
         await ui_from_callback_edit(call, "Нет сохранённых результатов для этого парсера.")
         await call.answer()
         return
     path = f"results_{user_id}_{idx + 1}.csv"
     with open(path, 'w', newline='', encoding='utf-8') as f:
         writer = csv.writer(f)
-        writer.writerow(["keyword", "chat", "sender", "datetime", "link", "text"])
-        for r in results:
-            writer.writerow([
-                r.get('keyword', ''),
-                r.get('chat', ''),
-                r.get('sender', ''),
-                r.get('datetime', ''),
-                r.get('link', ''),
-                r.get('text', '').replace('\n', ' '),
-            ])
+        writer.writerow(CSV_HEADER)
+        writer.writerows(r.as_row() for r in result_archive.iter_results(parser))
     await bot.send_document(user_id, types.InputFile(path))
     os.remove(path)
     await ui_from_callback_edit(call, t('menu_main'), reply_markup=main_menu_keyboard())
@@ -925,6 +926,120 @@ async def cmd_export(message: types.Message):
     await send_all_results(message.from_user.id)
 
 
+def _search_page(user_id: int, query: str, before: int | None = None):
+    rows = lead_index.search(user_id, query, before=before, limit=SEARCH_PAGE_SIZE + 1)
+    has_more = len(rows) > SEARCH_PAGE_SIZE
+    rows = rows[:SEARCH_PAGE_SIZE]
+    if not rows:
+        text = "Ничего не найдено." if before is None else "Больше совпадений нет."
+        return text, None
+    blocks = []
+    for _, dt, chat, sender, keyword, link, text in rows:
+        preview = text if len(text) <= 300 else text[:300] + '…'
+        blocks.append(
+            f"📅 {dt} • {chat}\n"
+            f"👤 {sender} • 🔑 {keyword}\n"
+            f"{preview}\n"
+            f"{link}"
+        )
+    kb = types.InlineKeyboardMarkup(row_width=1)
+    if has_more:
+        kb.add(types.InlineKeyboardButton("➡️ Дальше", callback_data=callback_key('search_more', rows[-1][0])))
+    kb.add(types.InlineKeyboardButton("🔙 Назад", callback_data="back_main"))
+    return f"🔎 Результаты по запросу «{query}»:\n\n" + "\n\n".join(blocks), kb
+
+
+@dp.message_handler(commands=['search'])
+async def cmd_search(message: types.Message):
+    """Поиск по сохранённым лидам: /search <запрос>."""
+    user_id = message.from_user.id
+    query = (message.get_args() or '').strip()
+    if not query:
+        await ui_send_new(user_id, "Введите запрос после команды, например: /search ремонт квартиры")
+        return
+    data = get_user_data_entry(user_id)
+    data['search_query'] = query
+    text, kb = _search_page(user_id, query)
+    await ui_send_new(user_id, text, reply_markup=kb)
+
+
+@callbacks.route('search_more', int)
+async def cb_search_more(call: types.CallbackQuery, before: int):
+    query = get_user_data_entry(call.from_user.id).get('search_query')
+    if not query:
+        await call.answer("Повторите поиск командой /search", show_alert=True)
+        return
+    text, kb = _search_page(call.from_user.id, query, before=before)
+    await ui_from_callback_edit(call, text, reply_markup=kb)
+
+
+def _leads_page(parser: dict, idx: int, before: int | None = None):
+    items, lo = result_archive.page(parser, before, LEADS_PAGE_SIZE)
+    kb = types.InlineKeyboardMarkup(row_width=2)
+    if not items:
+        kb.add(types.InlineKeyboardButton("🔙 Назад", callback_data=callback_key('edit', idx)))
+        return t('no_results'), kb
+    total = result_archive.total(parser)
+    hi = items[0][0] + 1
+    blocks = []
+    for _, r in items:
+        preview = r.text if len(r.text) <= 300 else r.text[:300] + '…'
+        blocks.append(
+            f"📅 {r.datetime} • {r.chat}\n"
+            f"👤 {r.sender} • 🔑 {r.keyword}\n"
+            f"{preview}\n"
+            f"{r.link}"
+        )
+    nav = []
+    if hi < total:
+        nav.append(types.InlineKeyboardButton("⬅️ Новее", callback_data=callback_key('leads', idx, min(total, hi + LEADS_PAGE_SIZE))))
+    if lo > 0:
+        nav.append(types.InlineKeyboardButton("Старее ➡️", callback_data=callback_key('leads', idx, lo)))
+    if nav:
+        kb.row(*nav)
+    kb.add(types.InlineKeyboardButton("🔙 Назад", callback_data=callback_key('edit', idx)))
+    header = (
+        f"📋 Последние лиды «{parser.get('name', f'Парсер {idx}')}» "
+        f"({total - hi + 1}–{total - lo} из {total}, в порядке поступления):"
+    )
+    return header + "\n\n" + "\n\n".join(blocks), kb
+
+
+@callbacks.route('leads', int, int, optional=1)
+async def cb_leads(call: types.CallbackQuery, num: int, before: int | None = None):
+    """Просмотр результатов парсера страницами: leads:<номер>[:<курсор>].
+
+    Порядок — по времени поступления в бот, а не по дате сообщения:
+    лиды из проверки истории попадают в конец, хотя сами сообщения старше.
+    """
+    idx = num - 1
+    parsers = user_data.get(str(call.from_user.id), {}).get('parsers', [])
+    if idx < 0 or idx >= len(parsers):
+        await call.answer("Парсер не найден", show_alert=True)
+        return
+    text, kb = _leads_page(parsers[idx], idx + 1, before)
+    await ui_from_callback_edit(call, text, reply_markup=kb)
+    await call.answer()
+
+
+@callbacks.route('backfill', int)
+async def cb_backfill(call: types.CallbackQuery, num: int):
+    idx = num - 1
+    user_id = call.from_user.id
+    parsers = user_data.get(str(user_id), {}).get('parsers', [])
+    if idx < 0 or idx >= len(parsers):
+        await call.answer("Парсер не найден", show_alert=True)
+        return
+    if not await wake_client(user_id):
+        await call.answer("Сначала авторизуйте аккаунт Telegram", show_alert=True)
+        return
+    if parser_key(parsers[idx]) in _backfills_running:
+        await call.answer("Проверка уже идёт", show_alert=True)
+        return
+    asyncio.create_task(run_backfill(user_id, parsers[idx], idx + 1))
+    await call.answer("Запускаю проверку истории")
+
+
 @dp.message_handler(commands=['check_payment'])
 async def cmd_check_payment(message: types.Message):
     user_id = message.from_user.id
@@ -933,10 +1048,13 @@ async def cmd_check_payment(message: types.Message):
     if not payment_id:
         await ui_send_new(user_id, "Платёж не найден.")
         return
-    status = check_payment(payment_id)
+    status = await check_payment(payment_id)
     if status == 'succeeded':
-        expiry = int((datetime.utcnow() + timedelta(days=30)).timestamp())
-        data['subscription_expiry'] = expiry
+        # Тот же платёж может завершить и payment_poller — продлеваем один раз.
+        if mark_applied(data, payment_id):
+            expiry = int((datetime.utcnow() + timedelta(days=30)).timestamp())
+            data['subscription_expiry'] = expiry
+            subscription_changed(user_id)
         data.pop('payment_id', None)
         save_user_data(user_data)
         await ui_send_new(user_id, t('payment_success'))
@@ -946,9 +1064,9 @@ async def cmd_check_payment(message: types.Message):
 
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith('edit_exclude_'), state='*')
-async def cb_edit_exclude(call: types.CallbackQuery, state: FSMContext):
-    idx = int(call.data.split('_')[2]) - 1
+@callbacks.route('edit_exclude', int, state='*')
+async def cb_edit_exclude(call: types.CallbackQuery, num: int, state: FSMContext):
+    idx = num - 1
     await state.update_data(edit_idx=idx)
     await ui_from_callback_edit(call, 
         "Введите новые исключающие слова (через запятую):"
@@ -957,17 +1075,17 @@ async def cb_edit_exclude(call: types.CallbackQuery, state: FSMContext):
     await call.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith('edit_name_'), state='*')
-async def cb_edit_name(call: types.CallbackQuery, state: FSMContext):
-    idx = int(call.data.split('_')[2]) - 1
+@callbacks.route('edit_name', int, state='*')
+async def cb_edit_name(call: types.CallbackQuery, num: int, state: FSMContext):
+    idx = num - 1
     await state.update_data(edit_idx=idx)
     await ui_from_callback_edit(call, "Введите новое название парсера:")
     await EditParserStates.waiting_name.set()
     await call.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith('edit_tariff_'))
-async def cb_edit_tariff(call: types.CallbackQuery, state: FSMContext):
+@callbacks.route('edit_tariff', int)
+async def cb_edit_tariff(call: types.CallbackQuery, idx: int, state: FSMContext):
     await cb_tariff_pro(call, state)
 
 
@@ -1009,28 +1127,14 @@ async def cmd_add_parser(message: types.Message, state: FSMContext):
         return
 
     info = user_clients.get(user_id)
-    if not info:
-        saved = user_data.get(str(user_id))
-        api_id = saved.get('api_id') if saved else None
-        api_hash = saved.get('api_hash') if saved else None
-        if not api_id or not api_hash:
-            await login_flow(message, state)
-            return
-        session_name = f"session_{user_id}"
-        client = TelegramClient(session_name, api_id, api_hash)
-        await client.connect()
-        if not await client.is_user_authorized():
+    if not info or not info.get('client'):
+        info = await wake_client(user_id)
+        if not info:
             await login_flow(message, state)
             return
-        user_clients[user_id] = {
-            'client': client,
-            'phone': saved.get('phone') if saved else None,
-            'phone_hash': '',
-            'parsers': saved.get('parsers', []) if saved else []
-        }
-        for p in user_clients[user_id]['parsers']:
+        for p in info['parsers']:
             await start_monitor(user_id, p)
-        info = user_clients[user_id]
+        asyncio.create_task(recover_gaps(user_id))
 
     parsers = data.setdefault('parsers', [])
     parser_id = len(parsers) + 1
@@ -1225,6 +1329,7 @@ async def login_flow(message: types.Message, state: FSMContext):
         try:
             if 'task' in existing:
                 existing['task'].cancel()
+            release_scheduler(existing['client'])
             await existing['client'].disconnect()
         except Exception:
             logging.exception("Failed to disconnect previous session")
@@ -1233,8 +1338,7 @@ async def login_flow(message: types.Message, state: FSMContext):
         api_id = saved.get('api_id')
         api_hash = saved.get('api_hash')
         if api_id and api_hash:
-            session_name = f"session_{user_id}"
-            client = TelegramClient(session_name, api_id, api_hash)
+            client = TelegramClient(session_store.session(user_id), api_id, api_hash)
             await client.connect()
             if await client.is_user_authorized():
                 user_clients[user_id] = {
@@ -1245,6 +1349,7 @@ async def login_flow(message: types.Message, state: FSMContext):
                 }
                 for p in user_clients[user_id]['parsers']:
                     await start_monitor(user_id, p)
+                asyncio.create_task(recover_gaps(user_id))
                 if user_clients[user_id]['parsers']:
                     await ui_send_new(user_id, "✅ Найдены сохранённые парсеры. Мониторинг запущен.")
                     return
@@ -1302,13 +1407,13 @@ async def get_my_code(message: types.Message, state: FSMContext):
     save_user_data(user_data)
 
     # Теперь создаем Telethon клиент и запрашиваем код для сессии
-    session_name = f"session_{user_id}"
-    client = TelegramClient(session_name, int(api_id), api_hash)
+    client = TelegramClient(session_store.session(user_id), int(api_id), api_hash)
     await client.connect()
 
     try:
-        result = await client.send_code_request(phone)
+        result = await api_call(client, 'auth', client.send_code_request, phone, priority=INTERACTIVE, retry=False)
         phone_hash = result.phone_code_hash
+        session_store.save(user_id, client.session)
     except Exception as e:
         logging.exception(e)
         await ui_send_new(user_id, f"⚠️ Ошибка при запросе кода для сессии: {e}. Начните сначала /start.")
@@ -1338,12 +1443,15 @@ async def get_telethon_code(message: types.Message, state: FSMContext):
     phone = data.get('phone')
     phone_hash = data.get('phone_hash')
 
-    session_name = f"session_{user_id}"
-    client = TelegramClient(session_name, api_id, api_hash)
+    client = TelegramClient(session_store.session(user_id), api_id, api_hash)
     await client.connect()
 
     try:
-        await client.sign_in(phone=phone, code=code, phone_code_hash=phone_hash)
+        await api_call(
+            client, 'auth', client.sign_in,
+            phone=phone, code=code, phone_code_hash=phone_hash,
+            priority=INTERACTIVE, retry=False,
+        )
     except PhoneCodeInvalidError:
         await ui_send_new(user_id, "❌ Неверный код. Попробуйте снова:")
         return
@@ -1361,6 +1469,7 @@ async def get_telethon_code(message: types.Message, state: FSMContext):
         await state.finish()
         return
 
+    session_store.save(user_id, client.session)
     user_clients[user_id] = {
         'client': client,
         'phone': phone,
@@ -1388,11 +1497,12 @@ async def get_password(message: types.Message, state: FSMContext):
 
     client = client_info['client']
     try:
-        await client.sign_in(password=password)
+        await api_call(client, 'auth', client.sign_in, password=password, priority=INTERACTIVE, retry=False)
     except Exception as e:
         logging.exception(e)
         await ui_send_new(user_id, "❌ Неверный пароль. Попробуйте ещё раз:")
         return
+    session_store.save(user_id, client.session)
 
     await ui_send_new(user_id,
         "✅ Пароль принят! Теперь укажите *ссылки* на чаты или каналы для мониторинга (через пробел или запятую):",
@@ -1401,27 +1511,70 @@ async def get_password(message: types.Message, state: FSMContext):
     await AuthStates.waiting_chats.set()
 
 
+def chat_errors_text(errors: list) -> str:
+    lines = "\n".join(f"• {part} — {reason}" for part, reason in errors)
+    return (
+        "⚠️ Не удалось распознать чаты:\n"
+        f"{lines}\n"
+        "Проверьте доступность в аккаунте и корректность ссылок и отправьте список заново."
+    )
+
+
+def chat_skipped_text(errors: list, delayed: list) -> str:
+    lines = [f"• {part} — {reason}" for part, reason in errors]
+    lines += [f"• {part} — лимит Telegram, добавлю сам примерно через {wait} сек." for part, wait in delayed]
+    return "⚠️ Не все чаты удалось добавить сразу, распознанные сохранены:\n" + "\n".join(lines)
+
+
+def delayed_errors(delayed: list) -> list:
+    return [(part, f"лимит Telegram, повторите через {wait} сек.") for part, wait in delayed]
+
+
+async def add_chats_later(user_id: int, parser: dict, delayed: list):
+    """Дорезолвить ссылки, упёршиеся в FloodWait, и добавить их чаты в парсер."""
+    info = user_clients.get(user_id)
+    if not info or 'client' not in info:
+        return
+    ids, errors = await chat_resolver.resolve_later(info['client'], user_id, delayed)
+    if not any(p is parser for p in user_data.get(str(user_id), {}).get('parsers', [])):
+        return  # парсер удалили, пока ждали паузу
+    fresh = [i for i in ids if i not in parser['chats']]
+    limit = get_user_data_entry(user_id).get('chat_limit', CHAT_LIMIT)
+    added = fresh[:max(0, limit - len(parser['chats']))]
+    if added:
+        stop_monitor(user_id, parser)
+        track_active_time(parser)
+        parser['chats'] = parser['chats'] + added
+        parser['daily_price'] = calc_parser_daily_cost(parser)
+        cost_aggregate.update(user_id, parser)
+        save_user_data(user_data)
+        await start_monitor(user_id, parser)
+    lines = []
+    if added:
+        lines.append(f"✅ После паузы Telegram добавлено чатов: {len(added)}.")
+    if len(fresh) > len(added):
+        lines.append(f"⚠️ Не добавлено из-за лимита в {limit} чатов: {len(fresh) - len(added)}.")
+    if errors:
+        lines.append(chat_errors_text(errors))
+    if lines:
+        await ui_send_new(user_id, "\n".join(lines))
+
+
 async def _process_chats(message: types.Message, state: FSMContext, next_state):
     text = message.text.strip().replace(',', ' ')
     parts = [p for p in text.split() if p]
     user_id = message.from_user.id
-    client = user_clients[user_id]['client']
-    chat_ids = []
-
-    for part in parts:
-        try:
-            entity = await client.get_entity(part)
-            chat_ids.append(entity.id)
-        except Exception:
-            if part.lstrip("-").isdigit():
-                chat_ids.append(int(part))
-            else:
-                await ui_send_new(user_id,
-                    "⚠️ Чат не найден. Проверьте доступность в аккаунте и корректность ссылки.")
-                return None
-
+    info = await wake_client(user_id)
+    if not info:
+        await ui_send_new(user_id, "⚠️ Сессия Telegram не найдена. Войдите заново через /start.")
+        return
+    client = info['client']
+    chat_ids, errors, delayed = await chat_resolver.resolve(client, user_id, parts)
     if not chat_ids:
-        await ui_send_new(user_id, "⚠️ Пустой список. Введите хотя бы одну ссылку или ID:")
+        if errors or delayed:
+            await ui_send_new(user_id, chat_errors_text(errors + delayed_errors(delayed)))
+        else:
+            await ui_send_new(user_id, "⚠️ Пустой список. Введите хотя бы одну ссылку или ID:")
         return None
 
     limit = get_user_data_entry(user_id).get('chat_limit', CHAT_LIMIT)
@@ -1429,7 +1582,10 @@ async def _process_chats(message: types.Message, state: FSMContext, next_state):
         await ui_send_new(user_id, f"⚠️ Можно указать не более {limit} чатов.")
         return None
 
-    await state.update_data(chat_ids=chat_ids)
+    if errors or delayed:
+        # Распознанные чаты сохраняем, а не просим прислать весь список заново.
+        await ui_send_new(user_id, chat_skipped_text(errors, delayed))
+    await state.update_data(chat_ids=chat_ids, delayed_chats=delayed)
     await ui_send_new(user_id, "Отлично! Теперь введите ключевые слова для мониторинга (через запятую):")
     await next_state.set()
     return chat_ids
@@ -1483,11 +1639,20 @@ async def _process_keywords(message: types.Message, state: FSMContext):
 
     parser['daily_price'] = calc_parser_daily_cost(parser)
     parser['status'] = 'active'  # если хотите сразу стартовать
+    track_active_time(parser)
+    cost_aggregate.update(user_id, parser)
     save_user_data(user_data)
 
     await start_monitor(user_id, parser)
+    if data.get('delayed_chats'):
+        asyncio.create_task(add_chats_later(user_id, parser, data['delayed_chats']))
 
-    await ui_send_new(message.from_user.id, "✅ Мониторинг запущен! Я уведомлю вас о совпадениях.")
+    await ui_send_new(
+        message.from_user.id,
+        "✅ Мониторинг запущен! Я уведомлю вас о совпадениях.\n"
+        "Можно сразу проверить, что находится в истории чатов.",
+        reply_markup=backfill_keyboard(len(get_user_data_entry(user_id).get('parsers', []))),
+    )
     await ui_send_new(message.from_user.id, t('menu_main'), reply_markup=main_menu_keyboard())
     await state.finish()
 
@@ -1509,20 +1674,17 @@ async def edit_chats_handler(message: types.Message, state: FSMContext):
     text = message.text.strip().replace(',', ' ')
     parts = [p for p in text.split() if p]
     user_id = message.from_user.id
-    client = user_clients[user_id]['client']
-    chat_ids = []
-    for part in parts:
-        try:
-            entity = await client.get_entity(part)
-            chat_ids.append(entity.id)
-        except Exception:
-            if part.lstrip("-").isdigit():
-                chat_ids.append(int(part))
-            else:
-                await ui_send_new(user_id, "⚠️ Чат не найден. Проверьте доступность и корректность ссылки.")
-                return
+    info = await wake_client(user_id)
+    if not info:
+        await ui_send_new(user_id, "⚠️ Сессия Telegram не найдена. Войдите заново через /start.")
+        return
+    client = info['client']
+    chat_ids, errors, delayed = await chat_resolver.resolve(client, user_id, parts)
     if not chat_ids:
-        await ui_send_new(user_id, "⚠️ Пустой список. Введите хотя бы одну ссылку или ID:")
+        if errors or delayed:
+            await ui_send_new(user_id, chat_errors_text(errors + delayed_errors(delayed)))
+        else:
+            await ui_send_new(user_id, "⚠️ Пустой список. Введите хотя бы одну ссылку или ID:")
         return
 
     limit = get_user_data_entry(user_id).get('chat_limit', CHAT_LIMIT)
@@ -1531,12 +1693,19 @@ async def edit_chats_handler(message: types.Message, state: FSMContext):
         return
     parser = user_data[str(user_id)]['parsers'][idx]
     stop_monitor(user_id, parser)
+    # Время до смены чатов начисляется по старой цене.
+    track_active_time(parser)
     parser['chats'] = chat_ids
     save_user_data(user_data)
     parser['daily_price'] = calc_parser_daily_cost(parser)
+    cost_aggregate.update(user_id, parser)
     await start_monitor(user_id, parser)
     await state.finish()
-    await ui_send_new(user_id, "✅ Чаты обновлены.")
+    if errors or delayed:
+        await ui_send_new(user_id, chat_skipped_text(errors, delayed))
+    if delayed:
+        asyncio.create_task(add_chats_later(user_id, parser, delayed))
+    await ui_send_new(user_id, "✅ Чаты обновлены.", reply_markup=backfill_keyboard(idx + 1))
 
 
 @dp.message_handler(state=EditParserStates.waiting_keywords)
@@ -1593,6 +1762,19 @@ if __name__ == '__main__':
 
 
     async def on_startup(dispatcher):
-        asyncio.create_task(daily_billing_loop())
+        if BILLING_MODE == 'prorated':
+            asyncio.create_task(prorated_billing_loop())
+        else:
+            asyncio.create_task(daily_billing_loop())
+        asyncio.create_task(restore_clients())
+        asyncio.create_task(connection_watchdog())
+        asyncio.create_task(client_supervisor())
+        asyncio.create_task(digest_loop())
+        if subscription_timers.rebuild(user_data):
+            save_user_data(user_data)
+        asyncio.create_task(subscription_timers.run())
+        if YOOKASSA_WEBHOOK_PORT:
+            await yookassa_webhook.start(YOOKASSA_WEBHOOK_HOST, YOOKASSA_WEBHOOK_PORT)
+        asyncio.create_task(reconcile_pending_payments())
 
 
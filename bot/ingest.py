@@ -0,0 +1,277 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from collections import deque
+
+POLICIES = ('drop_oldest', 'coalesce', 'block')
+
+
+class _Item:
+    __slots__ = ('chat', 'key', 'job', 'tenant', 'flow', 'on_drop', 'enqueued', 'alive')
+
+    def __init__(self, chat, key, job, tenant, flow, on_drop=None):
+        self.chat = chat
+        self.key = key
+        self.job = job
+        self.tenant = tenant
+        self.flow = flow
+        self.on_drop = on_drop
+        self.enqueued = time.monotonic()
+        self.alive = True
+
+
+class IngestQueue:
+    """Ограниченная очередь между получением сообщений и матчингом.
+
+    Обработчик Telethon только кладёт задачу в очередь, а разбирают её
+    ``workers`` постоянных воркеров. Очередь справедливая: задачи лежат
+    по арендаторам (пользователям) и потокам внутри них (парсерам), и
+    следующим обслуживается арендатор с наименьшим «виртуальным временем»
+    — суммой времени, на которое его задачи занимали воркер, делённой на
+    вес (``weight(tenant)``). Это настенное время вместе с ожиданием API,
+    а не CPU: делится именно занятость воркеров. Пользователь с шумным
+    чатом тратит свою долю воркеров, не чужую.
+
+    При переполнении действует политика:
+
+    * ``drop_oldest`` — выбрасывается самое старое сообщение из «шумного»
+      чата (больше ``flood_rate`` сообщений в минуту), а если таких нет —
+      самое старое у арендатора с самой длинной очередью; у выброшенной
+      задачи вызывается ``on_drop()``, чтобы сообщение можно было дочитать;
+    * ``coalesce`` — повтор уже ждущего в очереди сообщения (тот же
+      ``key``, например пересылка одного текста) не добавляется, в
+      остальном как ``drop_oldest``;
+    * ``block`` — отправитель ждёт свободного места.
+
+    Чтобы выбор жертвы не перебирал всю очередь, задачи дополнительно
+    лежат в очереди арендатора (по порядку поступления) и в общей очереди
+    задач, пришедших во время флуда их чата, а самый загруженный арендатор
+    берётся из кучи по размеру. Из этих очередей задачи удаляются лениво:
+    снятая задача помечается ``alive = False`` и выбрасывается, когда
+    доходит до головы.
+    """
+
+    def __init__(self, maxsize: int = 5000, workers: int = 8, policy: str = 'drop_oldest',
+                 flood_rate: int = 300, report_every: int = 300, weight=None):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown ingest policy: {policy}")
+        self.maxsize = max(1, maxsize)
+        self.workers = max(1, workers)
+        self.policy = policy
+        self.flood_rate = flood_rate
+        self.report_every = report_every
+        self.weight = weight or (lambda tenant: 1.0)
+        self.stats = {'queued': 0, 'processed': 0, 'dropped': 0, 'coalesced': 0, 'errors': 0,
+                      'wait_total': 0.0, 'wait_max': 0.0, 'depth_max': 0}
+        self._queues = {}       # tenant -> {flow: deque[_Item]}
+        self._flow_size = {}    # (tenant, flow) -> живых задач
+        self._tenant_size = {}  # tenant -> живых задач
+        self._arrivals = {}     # tenant -> deque[_Item] по порядку поступления
+        self._flooded = deque() # задачи, поставленные во время флуда их чата
+        self._deepest = []      # куча (-размер, №, tenant), устаревшие записи пропускаются
+        self._tick = itertools.count()
+        self._tenant_vt = {}
+        self._flow_vt = {}
+        self._busy = {}         # tenant -> скользящее среднее занятости воркера задачей
+        self._vclock = 0.0
+        self._size = 0
+        self._keys = {}
+        self._rates = {}
+        self._cond = None
+        self._tasks = []
+        self._last_report = time.monotonic()
+
+    def depth(self) -> int:
+        return self._size
+
+    def tenant_depth(self, tenant) -> int:
+        return self._tenant_size.get(tenant, 0)
+
+    def _start(self):
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        self._tasks = [t for t in self._tasks if not t.done()]
+        while len(self._tasks) < self.workers:
+            self._tasks.append(asyncio.create_task(self._worker()))
+
+    def _is_flooding(self, chat) -> bool:
+        window, count = self._rates.get(chat, (0, 0))
+        return count > self.flood_rate and window == int(time.monotonic() // 60)
+
+    def _count(self, chat):
+        window = int(time.monotonic() // 60)
+        start, count = self._rates.get(chat, (window, 0))
+        self._rates[chat] = (window, count + 1 if start == window else 1)
+
+    def _resize(self, tenant, delta: int):
+        size = self._tenant_size.get(tenant, 0) + delta
+        if size:
+            self._tenant_size[tenant] = size
+            heapq.heappush(self._deepest, (-size, next(self._tick), tenant))
+        else:
+            self._tenant_size.pop(tenant, None)
+        if len(self._deepest) > 4 * len(self._tenant_size) + 64:
+            self._deepest = [(-n, next(self._tick), t) for t, n in self._tenant_size.items()]
+            heapq.heapify(self._deepest)
+
+    def _add(self, item: _Item):
+        tenant, flow = item.tenant, item.flow
+        self._queues.setdefault(tenant, {}).setdefault(flow, deque()).append(item)
+        self._flow_size[(tenant, flow)] = self._flow_size.get((tenant, flow), 0) + 1
+        self._arrivals.setdefault(tenant, deque()).append(item)
+        if self._is_flooding(item.chat):
+            self._flooded.append(item)
+        self._resize(tenant, 1)
+        self._size += 1
+        if item.key is not None:
+            self._keys[item.key] = self._keys.get(item.key, 0) + 1
+
+    def _remove(self, item: _Item):
+        item.alive = False
+        tenant, flow = item.tenant, item.flow
+        left = self._flow_size[(tenant, flow)] - 1
+        if left:
+            self._flow_size[(tenant, flow)] = left
+        else:
+            del self._flow_size[(tenant, flow)]
+            flows = self._queues[tenant]
+            del flows[flow]
+            if not flows:
+                del self._queues[tenant]
+                del self._arrivals[tenant]
+        self._resize(tenant, -1)
+        self._size -= 1
+        if item.key is not None:
+            left = self._keys.get(item.key, 0) - 1
+            if left > 0:
+                self._keys[item.key] = left
+            else:
+                self._keys.pop(item.key, None)
+        arrivals = self._arrivals.get(tenant)
+        if arrivals is not None:
+            self._trim(arrivals, self._tenant_size[tenant])
+        self._trim(self._flooded, self._size)
+
+    @staticmethod
+    def _trim(q: deque, alive: int):
+        # Снятые задачи убираются с головы, а если их набралось больше
+        # живых — очередь пересобирается целиком (амортизированно O(1)).
+        while q and not q[0].alive:
+            q.popleft()
+        if len(q) > 2 * alive + 16:
+            live = [it for it in q if it.alive]
+            q.clear()
+            q.extend(live)
+
+    def _drop_one(self):
+        # Самая старая задача, пришедшая во время флуда, если её чат ещё шумит.
+        victim = None
+        while self._flooded:
+            it = self._flooded[0]
+            if it.alive and self._is_flooding(it.chat):
+                victim = it
+                break
+            self._flooded.popleft()
+        if victim is None:
+            while True:
+                size, _, tenant = self._deepest[0]
+                if self._tenant_size.get(tenant) == -size:
+                    break
+                heapq.heappop(self._deepest)
+            arrivals = self._arrivals[tenant]
+            while not arrivals[0].alive:
+                arrivals.popleft()
+            victim = arrivals[0]
+        self._remove(victim)
+        self.stats['dropped'] += 1
+        if victim.on_drop is not None:
+            try:
+                victim.on_drop()
+            except Exception:
+                logging.exception("Drop callback failed for chat %s", victim.chat)
+
+    async def put(self, chat, job, key=None, tenant=None, flow=None, on_drop=None):
+        """Поставить корутинную функцию ``job()`` в очередь обработки.
+
+        ``on_drop()`` вызывается, если задачу выбросят при переполнении.
+        """
+        self._start()
+        self._count(chat)
+        async with self._cond:
+            if self.policy == 'coalesce' and key is not None and key in self._keys:
+                self.stats['coalesced'] += 1
+                return
+            if self._size >= self.maxsize:
+                if self.policy == 'block':
+                    await self._cond.wait_for(lambda: self._size < self.maxsize)
+                else:
+                    self._drop_one()
+            if tenant not in self._queues:
+                # Простаивавший арендатор не копит «кредит» на будущее.
+                self._tenant_vt[tenant] = max(self._tenant_vt.get(tenant, 0.0), self._vclock)
+            self._add(_Item(chat, key, job, tenant, flow, on_drop))
+            self.stats['queued'] += 1
+            self.stats['depth_max'] = max(self.stats['depth_max'], self._size)
+            self._cond.notify_all()
+
+    def _next(self) -> tuple[_Item, float]:
+        tenant = min(self._queues, key=lambda t: self._tenant_vt.get(t, 0.0))
+        flows = self._queues[tenant]
+        flow = min(flows, key=lambda f: self._flow_vt.get((tenant, f), 0.0))
+        q = flows[flow]
+        while not q[0].alive:
+            q.popleft()
+        item = q.popleft()
+        self._remove(item)
+        # Списываем ожидаемую стоимость сразу, чтобы параллельные воркеры
+        # не набросились на одного арендатора; уточняем после выполнения.
+        estimate = self._busy.get(tenant, 0.001)
+        self._vclock = self._tenant_vt.get(tenant, 0.0)
+        self._charge(tenant, flow, estimate)
+        return item, estimate
+
+    def _charge(self, tenant, flow, busy: float):
+        self._tenant_vt[tenant] = self._tenant_vt.get(tenant, 0.0) + busy / max(self.weight(tenant), 0.01)
+        self._flow_vt[(tenant, flow)] = self._flow_vt.get((tenant, flow), 0.0) + busy
+
+    async def _worker(self):
+        while True:
+            async with self._cond:
+                await self._cond.wait_for(lambda: self._size)
+                item, estimate = self._next()
+                self._cond.notify_all()
+            wait = time.monotonic() - item.enqueued
+            self.stats['wait_total'] += wait
+            self.stats['wait_max'] = max(self.stats['wait_max'], wait)
+            started = time.monotonic()
+            try:
+                await item.job()
+            except Exception:
+                self.stats['errors'] += 1
+                logging.exception("Ingest job failed for chat %s", item.chat)
+            busy = time.monotonic() - started
+            self._charge(item.tenant, item.flow, busy - estimate)
+            self._busy[item.tenant] = 0.8 * self._busy.get(item.tenant, busy) + 0.2 * busy
+            self.stats['processed'] += 1
+            self._report()
+
+    def _report(self):
+        now = time.monotonic()
+        if now - self._last_report < self.report_every:
+            return
+        self._last_report = now
+        processed = self.stats['processed'] or 1
+        logging.info(
+            "Ingest queue: depth %s (max %s), processed %s, dropped %s, coalesced %s, "
+            "wait avg %.3fs max %.3fs, tenants waiting %s",
+            self._size, self.stats['depth_max'], self.stats['processed'],
+            self.stats['dropped'], self.stats['coalesced'],
+            self.stats['wait_total'] / processed, self.stats['wait_max'], len(self._queues),
+        )
+        # Счётчики прошлых минут и учёт ушедших арендаторов больше не нужны.
+        window = int(now // 60)
+        self._rates = {c: v for c, v in self._rates.items() if v[0] == window}
+        self._tenant_vt = {t: vt for t, vt in self._tenant_vt.items() if t in self._queues or vt > self._vclock}
+        self._flow_vt = {k: vt for k, vt in self._flow_vt.items() if k[0] in self._tenant_vt}
@@ -1,5 +1,7 @@
 from aiogram import types
 
+from .callbacks import callback_key
+
 
 def main_menu_keyboard() -> types.InlineKeyboardMarkup:
     kb = types.InlineKeyboardMarkup(row_width=1)
@@ -23,19 +25,30 @@ def main_menu_keyboard() -> types.InlineKeyboardMarkup:
 def parser_settings_keyboard(idx: int) -> types.InlineKeyboardMarkup:
     kb = types.InlineKeyboardMarkup(row_width=2)
     kb.add(
-        types.InlineKeyboardButton("▶️ Запустить", callback_data=f"parser_resume_{idx}"),
-        types.InlineKeyboardButton("⏸ Пауза", callback_data=f"parser_pause_{idx}"),
+        types.InlineKeyboardButton("▶️ Запустить", callback_data=callback_key('parser_resume', idx)),
+        types.InlineKeyboardButton("⏸ Пауза", callback_data=callback_key('parser_pause', idx)),
+    )
+    kb.add(
+        types.InlineKeyboardButton("🛠 Изменить название", callback_data=callback_key('edit_name', idx)),
+        types.InlineKeyboardButton("📂 Изменить чаты", callback_data=callback_key('edit_chats', idx)),
     )
     kb.add(
-        types.InlineKeyboardButton("🛠 Изменить название", callback_data=f"edit_name_{idx}"),
-        types.InlineKeyboardButton("📂 Изменить чаты", callback_data=f"edit_chats_{idx}"),
+        types.InlineKeyboardButton("📂 Изменить слова", callback_data=callback_key('edit_keywords', idx)),
+        types.InlineKeyboardButton("📂 Изменить искл-слова", callback_data=callback_key('edit_exclude', idx)),
     )
     kb.add(
-        types.InlineKeyboardButton("📂 Изменить слова", callback_data=f"edit_keywords_{idx}"),
-        types.InlineKeyboardButton("📂 Изменить искл-слова", callback_data=f"edit_exclude_{idx}"),
+        types.InlineKeyboardButton("📋 Последние лиды", callback_data=callback_key('leads', idx)),
+        types.InlineKeyboardButton("🔄 Онлайн / опрос", callback_data=callback_key('parser_mode', idx)),
     )
     kb.add(
-        types.InlineKeyboardButton("🗑 Удалить (только на паузе)", callback_data=f"parser_delete_{idx}"),
+        types.InlineKeyboardButton("🗑 Удалить (только на паузе)", callback_data=callback_key('parser_delete', idx)),
     )
     kb.add(types.InlineKeyboardButton("🔙 Назад", callback_data="back_main"))
     return kb
+
+
+def backfill_keyboard(idx: int) -> types.InlineKeyboardMarkup:
+    kb = types.InlineKeyboardMarkup()
+    kb.add(types.InlineKeyboardButton("🔎 Проверить историю чатов", callback_data=callback_key('backfill', idx)))
+    kb.add(types.InlineKeyboardButton("🔙 Назад", callback_data="back_main"))
+    return kb
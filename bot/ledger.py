@@ -0,0 +1,100 @@
+import sqlite3
+import time
+
+
+class BillingLedger:
+    """Журнал суточных списаний в общей базе (только добавление).
+
+    Одна запись на пользователя и день (уникальный ключ ``user_id, day``),
+    поэтому повторный прогон того же дня ничего не спишет второй раз.
+    Таблица ``billing_runs`` помнит начатые и завершённые прогоны.
+    """
+
+    def __init__(self, path: str):
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript(
+            "CREATE TABLE IF NOT EXISTS ledger ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, user_id TEXT NOT NULL, day TEXT NOT NULL, "
+            "amount REAL NOT NULL, balance_after REAL NOT NULL, created_at INTEGER NOT NULL, "
+            "UNIQUE(user_id, day));"
+            "CREATE TABLE IF NOT EXISTS billing_runs ("
+            "day TEXT PRIMARY KEY, status TEXT NOT NULL, started_at INTEGER NOT NULL, "
+            "finished_at INTEGER, users INTEGER, charged INTEGER, blocked INTEGER, "
+            "total REAL, duration REAL);"
+        )
+        self.conn.commit()
+
+    def run_status(self, day: str) -> str | None:
+        row = self.conn.execute("SELECT status FROM billing_runs WHERE day = ?", (day,)).fetchone()
+        return row[0] if row else None
+
+    def start_run(self, day: str):
+        self.conn.execute(
+            "INSERT OR IGNORE INTO billing_runs(day, status, started_at) VALUES (?, 'running', ?)",
+            (day, int(time.time())),
+        )
+        self.conn.commit()
+
+    def finish_run(self, day: str, stats: dict):
+        self.conn.execute(
+            "UPDATE billing_runs SET status = 'done', finished_at = ?, users = ?, charged = ?, "
+            "blocked = ?, total = ?, duration = ? WHERE day = ?",
+            (int(time.time()), stats['users'], stats['charged'], stats['blocked'],
+             stats['total'], stats['duration'], day),
+        )
+        self.conn.commit()
+
+    def entries(self, day: str) -> list:
+        """Списания дня: [(user_id, amount, balance_after)]."""
+        return self.conn.execute(
+            "SELECT user_id, amount, balance_after FROM ledger WHERE day = ?", (day,)
+        ).fetchall()
+
+    def latest(self, user_ids, pattern: str = '%') -> dict:
+        """Последняя запись каждого пользователя с ``day LIKE pattern``: {user_id: (day, amount)}."""
+        found = {}
+        user_ids = [str(uid) for uid in user_ids]
+        for i in range(0, len(user_ids), 500):
+            chunk = user_ids[i:i + 500]
+            marks = ",".join("?" * len(chunk))
+            for user_id, day, amount in self.conn.execute(
+                "SELECT user_id, day, amount FROM ledger WHERE id IN ("
+                f"SELECT MAX(id) FROM ledger WHERE day LIKE ? AND user_id IN ({marks}) GROUP BY user_id)",
+                (pattern, *chunk),
+            ):
+                found[user_id] = (day, amount)
+        return found
+
+    def record(self, day: str, debits: list) -> set:
+        """Записать списания дня одной транзакцией.
+
+        ``debits`` — [(user_id, amount, balance_after)]. Возвращает id
+        пользователей, чьи записи добавлены (уже списанные пропускаются).
+        """
+        added = set()
+        now = int(time.time())
+        with self.conn:
+            for user_id, amount, balance_after in debits:
+                cur = self.conn.execute(
+                    "INSERT OR IGNORE INTO ledger(user_id, day, amount, balance_after, created_at) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (str(user_id), day, amount, balance_after, now),
+                )
+                if cur.rowcount:
+                    added.add(str(user_id))
+        return added
+
+    def replay(self, day: str, users: dict) -> int:
+        """Доприменить к ``users`` списания дня, не отмеченные ``billed_day``.
+
+        Нужно после падения между записью в журнал и сохранением
+        ``user_data``. Возвращает число доприменённых записей.
+        """
+        applied = 0
+        for uid, amount, _ in self.entries(day):
+            data = users.get(uid)
+            if data is not None and data.get('billed_day') != day:
+                data['balance'] = round(float(data.get('balance', 0)) - amount, 2)
+                data['billed_day'] = day
+                applied += 1
+        return applied
@@ -0,0 +1,30 @@
+from collections import deque
+
+
+class LatencyStats:
+    """Последние ``window`` замеров (мс) по видам операций.
+
+    ``summary`` даёт число замеров, медиану, 95-й перцентиль и максимум.
+    """
+
+    def __init__(self, window: int = 500):
+        self.window = window
+        self._samples = {}  # вид -> deque замеров
+
+    def add(self, name: str, ms: float):
+        samples = self._samples.get(name)
+        if samples is None:
+            samples = self._samples[name] = deque(maxlen=self.window)
+        samples.append(ms)
+
+    def summary(self) -> dict:
+        out = {}
+        for name, samples in self._samples.items():
+            ordered = sorted(samples)
+            out[name] = {
+                'n': len(ordered),
+                'p50': round(ordered[len(ordered) // 2], 1),
+                'p95': round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 1),
+                'max': round(ordered[-1], 1),
+            }
+        return out
@@ -0,0 +1,147 @@
+import sys
+import uuid
+from dataclasses import dataclass
+
+CSV_HEADER = ["keyword", "chat", "sender", "datetime", "link", "text"]
+
+# Значения по умолчанию для записей user_data. Применяются одним слиянием
+# словарей вместо цепочки setdefault на каждом поле.
+USER_DEFAULTS = {
+    'subscription_expiry': 0,
+    'recurring': False,
+    'reminder3_sent': False,
+    'reminder1_sent': False,
+    'inactive_notified': False,
+    'billing_enabled': True,
+}
+
+PARSER_DEFAULTS = {
+    'name': 'Без названия',
+    'api_id': '',
+    'api_hash': '',
+    'status': 'paused',
+    'daily_price': 0.0,
+    # realtime — обработчик NewMessage, poll — опрос раз в poll_interval секунд.
+    'mode': 'realtime',
+}
+
+
+def parser_key(parser: dict) -> str:
+    """Постоянный идентификатор парсера (индексы в списке сдвигаются при удалении)."""
+    if not parser.get('key'):
+        parser['key'] = uuid.uuid4().hex
+    return parser['key']
+
+
+def _intern(value) -> str:
+    if value is None:
+        return ''
+    if not isinstance(value, str):
+        value = str(value)
+    return sys.intern(value)
+
+
+@dataclass(slots=True)
+class Result:
+    """Найденное сообщение.
+
+    Интернируются только часто повторяющиеся строки: ключевое слово, чат и
+    отправитель. Время почти у каждой записи своё, и интернирование лишь
+    раздувало бы таблицу интернированных строк.
+    """
+
+    keyword: str
+    chat: str
+    sender: str
+    datetime: str
+    link: str
+    text: str
+    # Исходное сообщение (chat_id в формате Telethon) — для дедупликации
+    # при сканировании истории. У старых записей нули.
+    chat_id: int = 0
+    msg_id: int = 0
+
+    def __post_init__(self):
+        self.keyword = _intern(self.keyword)
+        self.chat = _intern(self.chat)
+        self.sender = _intern(self.sender)
+
+    @classmethod
+    def from_dict(cls, raw: dict) -> "Result":
+        return cls(
+            raw.get('keyword', ''),
+            raw.get('chat', ''),
+            raw.get('sender', ''),
+            raw.get('datetime', ''),
+            raw.get('link', ''),
+            raw.get('text', ''),
+            raw.get('chat_id', 0),
+            raw.get('msg_id', 0),
+        )
+
+    def to_dict(self) -> dict:
+        return {
+            'keyword': self.keyword,
+            'chat': self.chat,
+            'sender': self.sender,
+            'datetime': self.datetime,
+            'link': self.link,
+            'text': self.text,
+            'chat_id': self.chat_id,
+            'msg_id': self.msg_id,
+        }
+
+    @property
+    def ident(self) -> tuple[int, int] | None:
+        return (self.chat_id, self.msg_id) if self.msg_id else None
+
+    @property
+    def dedupe_key(self) -> tuple:
+        """``ident``, а у старых записей без id сообщения — (чат, время, текст)."""
+        return self.ident or (self.chat, self.datetime, self.text)
+
+    def as_row(self) -> list:
+        """Строка для CSV-выгрузки."""
+        return [
+            self.keyword,
+            self.chat,
+            self.sender,
+            self.datetime,
+            self.link,
+            self.text.replace('\n', ' '),
+        ]
+
+
+def load_results(raw_results) -> list:
+    return [r if isinstance(r, Result) else Result.from_dict(r) for r in raw_results or []]
+
+
+def user_from_json(raw: dict, chat_limit: int) -> dict:
+    """Дополнить запись пользователя значениями по умолчанию."""
+    u = {**USER_DEFAULTS, 'chat_limit': chat_limit, 'balance': 0.0, **raw}
+    u.setdefault('used_promos', [])
+    parsers = []
+    for p in u.get('parsers', []):
+        p = {**PARSER_DEFAULTS, **p}
+        p['results'] = load_results(p.get('results'))
+        parsers.append(p)
+    if 'parsers' in u:
+        u['parsers'] = parsers
+    return u
+
+
+def user_to_json(u: dict) -> dict:
+    """Поверхностная копия записи без runtime-полей парсеров."""
+    out = dict(u)
+    if 'parsers' in u:
+        out['parsers'] = [
+            {k: v for k, v in p.items() if k not in ('handler', 'event', 'extra_handlers')}
+            for p in u['parsers']
+        ]
+    return out
+
+
+def json_default(obj):
+    if isinstance(obj, Result):
+        return obj.to_dict()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
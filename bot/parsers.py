@@ -1,16 +1,36 @@
 import re
+import logging
 import html
 import asyncio
 import os
+import time
+import gc
 import csv
-from datetime import datetime
-from telethon import events
+from datetime import datetime, timedelta
+from aiogram import types
+from aiogram.utils.exceptions import MessageNotModified
+from telethon import TelegramClient, events
 
-from .config import bot, bot2, CHAT_LIMIT
+from .config import (
+    bot, bot2, CHAT_LIMIT, BACKFILL_LIMIT, BACKFILL_DAYS, BACKFILL_CONCURRENCY,
+    GAP_MAX_MESSAGES, GAP_CHECK_INTERVAL, SESSION_FLUSH_INTERVAL, HIBERNATE_AFTER,
+    INGEST_QUEUE_SIZE, INGEST_WORKERS, INGEST_POLICY, INGEST_FLOOD_RATE,
+    TENANT_CPU_BUDGET, TENANT_MATCH_BUDGET, DIGEST_INTERVAL,
+    POLL_INTERVAL, POLL_MAX_MESSAGES, POLL_CONCURRENCY, EDIT_CACHE_TTL, EDIT_CACHE_PER_CHAT,
+)
 from .text_utils import normalize_word, t
-from .data import user_data, save_user_data, get_user_data_entry
-from .utils import safe_send_message
-from .billing import calc_parser_daily_cost
+from .data import user_data, save_user_data, get_user_data_entry, result_archive, lead_index, session_store
+from .utils import safe_send_message, ui_send_new
+from .billing import calc_parser_daily_cost, cost_aggregate, track_active_time
+from .models import Result, CSV_HEADER, parser_key
+from .backfill import backfill_parser
+from .api_scheduler import api_call, scheduler_for, release_scheduler, MONITORING, BACKGROUND
+from .recovery import chat_key, mark_seen, mark_missed, fetch_missed, latest_message_id, iter_missed
+from .ingest import IngestQueue
+from .callbacks import callback_key
+from .fairness import TenantUsage, DigestBuffer, deliver_digest
+from .poller import PollScheduler
+from .edits import TokenCache
 
 user_clients = {}
 
@@ -29,8 +49,8 @@ def parser_info_text(user_id: int, parser: dict, created: bool = False) -> str:
     else:
         paid_to = '—'
     chat_limit = f"/{data.get('chat_limit', CHAT_LIMIT)}" if plan_name == 'PRO' else ''
-    status_emoji = '🟢' if parser.get('handler') else '⏸'
-    status_text = 'Активен' if parser.get('handler') else 'Остановлен'
+    status_emoji = '🟢' if is_monitoring(parser) else '⏸'
+    status_text = 'Активен' if is_monitoring(parser) else 'Остановлен'
     if created:
         return t('parser_created', id=idx)
     return t(
@@ -49,6 +69,180 @@ def parser_info_text(user_id: int, parser: dict, created: bool = False) -> str:
     )
 
 
+# Отметки last_seen меняются на каждом сообщении; на диск их сбрасывает
+# connection_watchdog, а не каждый обработчик.
+_last_seen_dirty = False
+gap_stats = {'runs': 0, 'fetched': 0, 'recovered': 0}
+# Учёт нагрузки по пользователям: тяжёлые получают меньшую долю воркеров
+# очереди и уведомления сводкой, а не замедляют всех остальных.
+tenant_usage = TenantUsage(TENANT_CPU_BUDGET, TENANT_MATCH_BUDGET)
+digest_buffer = DigestBuffer()
+token_cache = TokenCache(EDIT_CACHE_TTL, EDIT_CACHE_PER_CHAT)
+ingest_queue = IngestQueue(
+    INGEST_QUEUE_SIZE, INGEST_WORKERS, INGEST_POLICY, INGEST_FLOOD_RATE, weight=tenant_usage.weight,
+)
+
+
+def message_words(text: str) -> list:
+    return [normalize_word(w) for w in re.findall(r'\w+', text.lower())]
+
+
+def match_keywords(words: list, keywords: list, exclude: list) -> str | None:
+    """Первое ключевое слово парсера среди нормализованных слов сообщения."""
+    if any(e in words for e in exclude):
+        return None
+    for kw in keywords:
+        if normalize_word(kw) in words:
+            return kw
+    return None
+
+
+def build_result(kw: str, chat, sender, message) -> Result:
+    title = getattr(chat, 'title', str(message.chat_id))
+    username = getattr(sender, 'username', None)
+    sender_name = f"@{username}" if username else getattr(sender, 'first_name', 'Unknown')
+    link = 'Ссылка недоступна'
+    chat_username = getattr(chat, 'username', None)
+    if chat_username:
+        link = f"https://t.me/{chat_username}/{message.id}"
+    return Result(
+        kw, title, sender_name, message.date.strftime('%Y-%m-%d %H:%M:%S'),
+        link, message.raw_text or '', message.chat_id, message.id,
+    )
+
+
+def store_result(user_id: int, parser: dict, result: Result, words: list, save: bool = True):
+    """Сохранить найденное сообщение: горячий список, поисковый индекс, архив."""
+    # Только в конец: номер archived + i — курсор листания лидов, и вставка
+    # сообщения из истории в середину сдвинула бы все записи после него.
+    parser.setdefault('results', []).append(result)
+    lead_index.add(user_id, parser, result, words)
+    result_archive.enforce(parser)
+    if save:
+        save_user_data(user_data)
+
+
+def is_stored(parser: dict, result: Result, depth: int = 200) -> bool:
+    """Есть ли это сообщение среди последних сохранённых результатов."""
+    ident = result.ident
+    if not ident:
+        return False
+    results = parser.get('results') or []
+    return any(r.ident == ident for r in results[-depth:])
+
+
+async def notify_result(user_id: int, result: Result):
+    preview = html.escape(result.text[:400])
+    message_text = (
+        f"🔔 Найдено '{html.escape(result.keyword)}' в чате '{html.escape(result.chat)}'\n"
+        f"Username: {html.escape(result.sender)}\n"
+        f"DateTime: {result.datetime}\n"
+        f"Link: {html.escape(result.link)}\n"
+        f"<pre>{preview}</pre>"
+    )
+    if not bot2 or await safe_send_message(bot2, user_id, message_text, parse_mode="HTML") is None:
+        await safe_send_message(
+            bot,
+            user_id,
+            "Пожалуйста, начните чат с ботом уведомлений сначала: https://t.me/topgraber_yved_bot",
+        )
+
+
+async def process_message(
+    client,
+    user_id: int,
+    parser: dict,
+    message,
+    keywords: list,
+    exclude: list,
+    notify: bool = True,
+    save: bool = True,
+    priority: int = MONITORING,
+    edited: bool = False,
+) -> Result | None:
+    """Общий конвейер для живых, пропущенных и исторических сообщений.
+
+    Матчинг, дедупликация по id сообщения, сохранение и (если ``notify``)
+    уведомление. Для правок (``edited``) ключевые слова ищутся только среди
+    появившихся в тексте слов. Возвращает сохранённый результат или None.
+    """
+    text = message.raw_text or ''
+    scope = (parser_key(parser), message.chat_id)
+    if edited and token_cache.unchanged(scope, message.id, text):
+        return None
+    # Между замерами нет await: process_time — CPU именно этого сообщения.
+    started = time.process_time()
+    words = message_words(text)
+    fresh = token_cache.update(scope, message.id, text, words)
+    if edited:
+        keywords = [k for k in keywords if normalize_word(k) in fresh]
+    kw = match_keywords(words, keywords, exclude) if keywords else None
+    tenant_usage.charge_cpu(user_id, time.process_time() - started)
+    if kw is None:
+        return None
+    # Отправителя запрашиваем только для совпавших сообщений.
+    sender = message.sender or await api_call(client, 'entity', message.get_sender, priority=priority)
+    if getattr(sender, 'bot', False):
+        return None
+    chat = message.chat or await api_call(client, 'entity', message.get_chat, priority=priority)
+    result = build_result(kw, chat, sender, message)
+    if is_stored(parser, result):
+        return None
+    store_result(user_id, parser, result, words, save=save)
+    if notify:
+        tenant_usage.charge_match(user_id)
+        if tenant_usage.over_matches(user_id):
+            digest_buffer.add(user_id, result)
+        else:
+            await notify_result(user_id, result)
+    return result
+
+
+async def mark_after(parser: dict, messages: list, job):
+    """Дождаться обработки ``job`` и только потом сдвинуть ``last_seen``.
+
+    ``last_seen`` — наибольший увиденный id, и параллельные воркеры сдвигают
+    его дальше ещё не обработанных сообщений, поэтому сам по себе пропусков
+    не выдаёт. Сообщение, выброшенное очередью при переполнении,
+    запоминается через ``drop_missed`` и дочитывается ``recover_gaps``.
+    Повторы, склеенные политикой ``coalesce``, не дочитываются намеренно,
+    а сообщения, ждавшие в очереди при падении бота, теряются.
+    """
+    global _last_seen_dirty
+    result = await job if job is not None else None
+    for m in messages:
+        if mark_seen(parser, m):
+            _last_seen_dirty = True
+    return result
+
+
+def drop_missed(parser: dict, messages: list):
+    """``on_drop`` очереди: запомнить выброшенные сообщения для ``recover_gaps``."""
+    global _last_seen_dirty
+    for m in messages:
+        mark_missed(parser, m)
+    _last_seen_dirty = True
+
+
+async def send_digest(user_id: int, results: list):
+    # Как и одиночные уведомления: если бот уведомлений недоступен, шлём основным.
+    await deliver_digest(
+        user_id, results, (bot2, bot),
+        lambda sender, uid, text: safe_send_message(sender, uid, text, parse_mode="HTML"),
+    )
+
+
+async def digest_loop():
+    """Раз в DIGEST_INTERVAL отправлять накопленные сводки и логировать тяжёлых пользователей."""
+    while True:
+        await asyncio.sleep(DIGEST_INTERVAL)
+        heavy = tenant_usage.heavy()
+        if heavy:
+            logging.info("Heavy tenants (user, cpu s/min, matches/min): %s", heavy)
+        for user_id, results in digest_buffer.drain().items():
+            await send_digest(user_id, results)
+
+
 async def start_monitor(user_id: int, parser: dict):
     if parser.get('status', 'paused') != 'active':
         return
@@ -61,60 +255,346 @@ async def start_monitor(user_id: int, parser: dict):
     exclude = [normalize_word(w) for w in parser.get('exclude_keywords', [])]
     if not chat_ids or not keywords:
         return
+    if parser.get('mode') == 'poll':
+        # Опрос по расписанию вместо обработчика: реальное время остаётся
+        # за чатами, которым оно нужно.
+        poll_scheduler.add(user_id, parser, parser.get('poll_interval') or POLL_INTERVAL, delay=0)
+        if not client.is_connected():
+            await client.connect()
+        return
 
     event_builder = events.NewMessage(chats=chat_ids)
 
     async def monitor(event, keywords=keywords, parser=parser):
-        sender = await event.get_sender()
-        if getattr(sender, 'bot', False):
+        message = event.message
+        if message.grouped_id:
+            # Элементы альбома разбирает on_album одним событием.
             return
-        text = event.raw_text or ''
-        words = [normalize_word(w) for w in re.findall(r'\w+', text.lower())]
-        for kw in keywords:
-            if normalize_word(kw) in words and not any(e in words for e in exclude):
-                chat = await event.get_chat()
-                title = getattr(chat, 'title', str(event.chat_id))
-                username = getattr(sender, 'username', None)
-                sender_name = f"@{username}" if username else getattr(sender, 'first_name', 'Unknown')
-                msg_time = event.message.date.strftime('%Y-%m-%d %H:%M:%S')
-                link = 'Ссылка недоступна'
-                chat_username = getattr(chat, 'username', None)
-                if chat_username:
-                    link = f"https://t.me/{chat_username}/{event.id}"
-                preview = html.escape(text[:400])
-                message_text = (
-                    f"🔔 Найдено '{html.escape(kw)}' в чате '{html.escape(title)}'\n"
-                    f"Username: {html.escape(sender_name)}\n"
-                    f"DateTime: {msg_time}\n"
-                    f"Link: {html.escape(link)}\n"
-                    f"<pre>{preview}</pre>"
-                )
-                if not bot2 or await safe_send_message(bot2, user_id, message_text, parse_mode="HTML") is None:
-                    await safe_send_message(
-                        bot,
-                        user_id,
-                        "Пожалуйста, начните чат с ботом уведомлений сначала: https://t.me/topgraber_yved_bot",
-                    )
-                parser.setdefault('results', []).append({
-                    'keyword': kw,
-                    'chat': title,
-                    'sender': sender_name,
-                    'datetime': msg_time,
-                    'link': link,
-                    'text': text,
-                })
-                save_user_data(user_data)
-                break
+        # Матчинг и отправка идут через ограниченную очередь с пулом воркеров;
+        # ключ склеивает одинаковые пересылки при политике coalesce, а tenant/flow
+        # делят воркеры поровну между пользователями и их парсерами.
+        await ingest_queue.put(
+            event.chat_id,
+            lambda: mark_after(
+                parser, [message], process_message(client, user_id, parser, message, keywords, exclude),
+            ),
+            key=(parser_key(parser), message.raw_text or message.id),
+            tenant=user_id,
+            flow=parser_key(parser),
+            on_drop=lambda: drop_missed(parser, [message]),
+        )
 
+    async def on_album(event, keywords=keywords, parser=parser):
+        # Подпись альбома обычно у одного элемента — его и матчим, один раз.
+        message = next((m for m in event.messages if m.raw_text), None)
+        if message is None:
+            await mark_after(parser, event.messages, None)
+            return
+        await ingest_queue.put(
+            event.chat_id,
+            lambda: mark_after(
+                parser, event.messages, process_message(client, user_id, parser, message, keywords, exclude),
+            ),
+            key=(parser_key(parser), message.raw_text),
+            tenant=user_id,
+            flow=parser_key(parser),
+            on_drop=lambda: drop_missed(parser, [message]),
+        )
+
+    async def on_edit(event, keywords=keywords, parser=parser):
+        message = event.message
+        if not message.raw_text:
+            return
+        await ingest_queue.put(
+            event.chat_id,
+            lambda: process_message(client, user_id, parser, message, keywords, exclude, edited=True),
+            tenant=user_id,
+            flow=parser_key(parser),
+        )
+
+    extra = [(on_album, events.Album(chats=chat_ids)), (on_edit, events.MessageEdited(chats=chat_ids))]
     client.add_event_handler(monitor, event_builder)
+    for handler, builder in extra:
+        client.add_event_handler(handler, builder)
     parser['handler'] = monitor
     parser['event'] = event_builder
+    parser['extra_handlers'] = extra
     if not client.is_connected():
         await client.connect()
-    if 'task' not in info:
+    if 'task' not in info or info['task'].done():
         info['task'] = asyncio.create_task(client.run_until_disconnected())
 
 
+async def recover_gaps(user_id: int):
+    """Догнать сообщения, пришедшие, пока клиент был отключён.
+
+    Для каждого чата активных парсеров берутся сообщения после
+    ``parser['last_seen']`` по возрастанию id и прогоняются через обычный
+    конвейер. Чаты без отметки только получают её (с текущего сообщения).
+    Сначала дочитываются сообщения, которые выбросила очередь
+    (``parser['missed']``).
+    """
+    info = user_clients.get(user_id)
+    if not info or 'client' not in info:
+        return
+    client = info['client']
+    fetched = recovered = 0
+    for parser in info.get('parsers', []):
+        missed = parser.pop('missed', {})
+        # Парсеры в режиме опроса догоняют пропущенное сами при следующем опросе.
+        if parser.get('status') != 'active' or not parser.get('keywords') or parser.get('mode') == 'poll':
+            continue
+        keywords = parser['keywords']
+        exclude = [normalize_word(w) for w in parser.get('exclude_keywords', [])]
+        seen = parser.setdefault('last_seen', {})
+        for chat in parser.get('chats', []):
+            key = chat_key(chat)
+            try:
+                dropped = missed.pop(key, None)
+                if dropped:
+                    for msg in await fetch_missed(client, chat, dropped):
+                        fetched += 1
+                        if await process_message(client, user_id, parser, msg, keywords, exclude, save=False):
+                            recovered += 1
+                last = seen.get(key)
+                if not last:
+                    seen[key] = await latest_message_id(client, chat)
+                    continue
+                count = 0
+                async for msg in iter_missed(client, chat, last, GAP_MAX_MESSAGES):
+                    count += 1
+                    if await process_message(client, user_id, parser, msg, keywords, exclude, save=False):
+                        recovered += 1
+                    mark_seen(parser, msg)
+                fetched += count
+                if count >= GAP_MAX_MESSAGES:
+                    logging.warning("Gap in chat %s for user %s exceeds %s messages", chat, user_id, GAP_MAX_MESSAGES)
+            except Exception:
+                if dropped:
+                    parser.setdefault('missed', {})[key] = dropped
+                logging.exception("Gap recovery failed for user %s chat %s", user_id, chat)
+    gap_stats['runs'] += 1
+    gap_stats['fetched'] += fetched
+    gap_stats['recovered'] += recovered
+    if fetched:
+        logging.info(
+            "Gap recovery for %s: %s messages fetched, %s leads recovered (total %s/%s)",
+            user_id, fetched, recovered, gap_stats['fetched'], gap_stats['recovered'],
+        )
+    save_user_data(user_data)
+
+
+async def poll_parser(user_id: int, parser: dict):
+    """Один опрос парсера в режиме poll.
+
+    Новые сообщения всех чатов после ``last_seen`` забираются пачками с
+    фоновым приоритетом, прогоняются через общий конвейер, а найденное
+    сохраняется одним сбросом и приходит одним уведомлением.
+    """
+    if parser.get('status') != 'active' or parser.get('mode') != 'poll' or not parser.get('keywords'):
+        poll_scheduler.remove(parser)
+        return
+    info = await wake_client(user_id)
+    if not info:
+        return
+    client = info['client']
+    keywords = parser['keywords']
+    exclude = [normalize_word(w) for w in parser.get('exclude_keywords', [])]
+    seen = parser.setdefault('last_seen', {})
+    found = []
+    fetched = 0
+    for chat in parser.get('chats', []):
+        key = chat_key(chat)
+        try:
+            last = seen.get(key)
+            if not last:
+                seen[key] = await latest_message_id(client, chat, priority=BACKGROUND)
+                continue
+            async for msg in iter_missed(client, chat, last, POLL_MAX_MESSAGES, priority=BACKGROUND):
+                fetched += 1
+                result = await process_message(
+                    client, user_id, parser, msg, keywords, exclude,
+                    notify=False, save=False, priority=BACKGROUND,
+                )
+                if result:
+                    found.append(result)
+                mark_seen(parser, msg)
+        except Exception:
+            logging.exception("Poll failed for user %s chat %s", user_id, chat)
+    save_user_data(user_data)
+    if len(found) == 1:
+        await notify_result(user_id, found[0])
+    elif found:
+        await send_digest(user_id, found)
+    if fetched:
+        logging.info("Polled %s messages for user %s, %s leads", fetched, user_id, len(found))
+
+
+poll_scheduler = PollScheduler(poll_parser, POLL_CONCURRENCY)
+
+
+async def wake_client(user_id: int) -> dict | None:
+    """Запись ``user_clients`` с подключённым клиентом.
+
+    Если клиента нет (рестарт или спящий режим), он поднимается из
+    сохранённой сессии. ``None`` — сессии нет или она больше не авторизована.
+    """
+    info = user_clients.get(user_id)
+    if info and info.get('client'):
+        if not info['client'].is_connected():
+            await info['client'].connect()
+        return info
+    data = user_data.get(str(user_id)) or {}
+    api_id, api_hash = data.get('api_id'), data.get('api_hash')
+    if not (api_id and api_hash) or not session_store.has(user_id):
+        return None
+    client = TelegramClient(session_store.session(user_id), api_id, api_hash)
+    try:
+        await client.connect()
+        if not await client.is_user_authorized():
+            await client.disconnect()
+            return None
+    except Exception:
+        logging.exception("Failed to connect client for %s", user_id)
+        return None
+    info = user_clients.setdefault(user_id, {})
+    info.update({
+        'client': client,
+        'phone': data.get('phone'),
+        'phone_hash': '',
+        'parsers': data.get('parsers', []),
+    })
+    info.pop('task', None)
+    return info
+
+
+async def restore_clients():
+    """После рестарта поднять клиентов с активными парсерами и догнать пропущенное."""
+    for uid, data in list(user_data.items()):
+        if not any(p.get('status') == 'active' for p in data.get('parsers', [])):
+            continue
+        user_id = int(uid)
+        if user_id in user_clients:
+            continue
+        info = await wake_client(user_id)
+        if not info:
+            continue
+        for p in info['parsers']:
+            await start_monitor(user_id, p)
+        await recover_gaps(user_id)
+
+
+def _rss_mb() -> float:
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError):
+        return 0.0
+
+
+async def client_supervisor():
+    """Отключать клиентов без активных парсеров после HIBERNATE_AFTER секунд простоя.
+
+    Сессия перед этим сохраняется; поднимаются клиенты лениво через
+    ``wake_client`` (запуск парсера, новый парсер, проверка истории).
+    """
+    while True:
+        await asyncio.sleep(60)
+        now = time.monotonic()
+        idle = []
+        for user_id, info in list(user_clients.items()):
+            client = info.get('client')
+            # Пользователь посреди входа: клиента держим, он нужен для sign_in.
+            if client is None or info.get('phone_hash'):
+                continue
+            busy = any(
+                is_monitoring(p) or parser_key(p) in _backfills_running
+                for p in info.get('parsers', [])
+            )
+            if busy or scheduler_for(client).pending():
+                info.pop('idle_since', None)
+                continue
+            info.setdefault('idle_since', now)
+            if now - info['idle_since'] >= HIBERNATE_AFTER:
+                idle.append(user_id)
+        if not idle:
+            continue
+        before_rss = _rss_mb()
+        before_conn = sum(1 for i in user_clients.values() if i.get('client') and i['client'].is_connected())
+        for user_id in idle:
+            info = user_clients.pop(user_id, None)
+            if not info:
+                continue
+            client = info['client']
+            try:
+                session_store.save(user_id, client.session)
+                if 'task' in info:
+                    info['task'].cancel()
+                release_scheduler(client)
+                await client.disconnect()
+            except Exception:
+                logging.exception("Failed to hibernate client for %s", user_id)
+        gc.collect()
+        after_conn = sum(1 for i in user_clients.values() if i.get('client') and i['client'].is_connected())
+        logging.info(
+            "Hibernated %s idle clients: connections %s -> %s, RSS %.1f -> %.1f MB",
+            len(idle), before_conn, after_conn, before_rss, _rss_mb(),
+        )
+
+
+async def connection_watchdog():
+    """Переподключить отвалившиеся клиенты и догнать пропущенные сообщения."""
+    global _last_seen_dirty
+    last_flush = time.monotonic()
+    while True:
+        await asyncio.sleep(GAP_CHECK_INTERVAL)
+        for user_id, info in list(user_clients.items()):
+            client = info.get('client')
+            # Клиенты в процессе входа и без запущенных парсеров не трогаем.
+            if not client or info.get('phone_hash') or not any(is_monitoring(p) for p in info.get('parsers', [])):
+                continue
+            if client.is_connected() and 'task' in info and not info['task'].done():
+                # Клиент на связи, но очередь выбрасывала сообщения — дочитываем их.
+                if any(p.get('missed') for p in info.get('parsers', [])):
+                    try:
+                        await recover_gaps(user_id)
+                    except Exception:
+                        logging.exception("Missed message recovery failed for user %s", user_id)
+                continue
+            try:
+                if not client.is_connected():
+                    await client.connect()
+                info['task'] = asyncio.create_task(client.run_until_disconnected())
+                await recover_gaps(user_id)
+            except Exception:
+                logging.exception("Reconnect failed for user %s", user_id)
+        if _last_seen_dirty:
+            _last_seen_dirty = False
+            save_user_data(user_data)
+        if time.monotonic() - last_flush >= SESSION_FLUSH_INTERVAL:
+            last_flush = time.monotonic()
+            save_sessions()
+
+
+def save_sessions():
+    """Сбросить в базу сессии подключённых клиентов (вместе с кэшем сущностей)."""
+    for user_id, info in list(user_clients.items()):
+        client = info.get('client')
+        if client is None or info.get('phone_hash'):
+            continue
+        try:
+            session_store.save(user_id, client.session)
+        except Exception:
+            logging.exception("Failed to save session for %s", user_id)
+
+
+def is_monitoring(parser: dict) -> bool:
+    """Запущен ли парсер: висит обработчик событий или он стоит в опросе."""
+    if parser.get('mode') == 'poll':
+        return parser in poll_scheduler
+    return bool(parser.get('handler'))
+
+
 def stop_monitor(user_id: int, parser: dict):
     info = user_clients.get(user_id)
     if not info:
@@ -126,45 +606,115 @@ def stop_monitor(user_id: int, parser: dict):
             info['client'].remove_event_handler(handler, event)
         except Exception:
             pass
+    for handler, event in parser.pop('extra_handlers', []):
+        try:
+            info['client'].remove_event_handler(handler, event)
+        except Exception:
+            pass
     parser.pop('handler', None)
     parser.pop('event', None)
+    poll_scheduler.remove(parser)
+    token_cache.forget(parser_key(parser))
 
 
 def pause_parser(user_id: int, parser: dict):
     parser['status'] = 'paused'
     stop_monitor(user_id, parser)
+    track_active_time(parser)
+    cost_aggregate.update(user_id, parser)
     save_user_data(user_data)
 
 
 async def resume_parser(user_id: int, parser: dict):
     parser['status'] = 'active'
     parser['daily_price'] = calc_parser_daily_cost(parser)
+    track_active_time(parser)
+    cost_aggregate.update(user_id, parser)
+    # Время на паузе не догоняем: отметки начнутся с текущих сообщений.
+    parser.pop('last_seen', None)
+    parser.pop('missed', None)
     save_user_data(user_data)
+    await wake_client(user_id)
     await start_monitor(user_id, parser)
 
 
+_backfills_running = set()
+
+
+async def run_backfill(user_id: int, parser: dict, idx: int):
+    """Прогнать историю чатов парсера через матчер с сообщением о прогрессе."""
+    key = parser_key(parser)
+    info = user_clients.get(user_id)
+    if key in _backfills_running or not info or 'client' not in info:
+        return
+    _backfills_running.add(key)
+    client = info['client']
+    keywords = parser.get('keywords') or []
+    exclude = [normalize_word(w) for w in parser.get('exclude_keywords', [])]
+
+    async def handle(msg):
+        return await process_message(
+            client, user_id, parser, msg, keywords, exclude,
+            notify=False, save=False, priority=BACKGROUND,
+        )
+
+    status = await ui_send_new(user_id, "⏳ Проверяю историю чатов…")
+
+    async def progress(stats):
+        if not status:
+            return
+        try:
+            await bot.edit_message_text(
+                f"⏳ Проверяю историю чатов: {stats['done']}/{stats['chats']}\n"
+                f"Просмотрено сообщений: {stats['scanned']}, найдено: {stats['found']}",
+                user_id, status.message_id,
+            )
+        except MessageNotModified:
+            pass
+
+    # Дубли отсеиваются по всем результатам окна, включая архивные.
+    since = (datetime.utcnow() - timedelta(days=BACKFILL_DAYS)).strftime('%Y-%m-%d %H:%M:%S')
+    try:
+        if not client.is_connected():
+            await client.connect()
+        stats = await backfill_parser(
+            client, parser, handle, BACKFILL_LIMIT, BACKFILL_DAYS,
+            concurrency=BACKFILL_CONCURRENCY, known=result_archive.iter_results(parser, since),
+            progress=progress,
+        )
+    except Exception:
+        logging.exception("Backfill failed for user %s", user_id)
+        await ui_send_new(user_id, "⚠️ Не удалось проверить историю чатов.")
+        return
+    finally:
+        _backfills_running.discard(key)
+        save_user_data(user_data)
+    kb = types.InlineKeyboardMarkup()
+    kb.add(types.InlineKeyboardButton("📋 Последние лиды", callback_data=callback_key('leads', idx)))
+    kb.add(types.InlineKeyboardButton("🔙 Назад", callback_data="back_main"))
+    await ui_send_new(
+        user_id,
+        f"✅ История проверена: просмотрено {stats['scanned']} сообщений, "
+        f"найдено совпадений: {stats['found']}.",
+        reply_markup=kb,
+    )
+
+
 async def send_all_results(user_id: int):
     data = user_data.get(str(user_id))
     if not data:
         return
     rows = []
     for parser in data.get('parsers', []):
-        for r in parser.get('results', []):
-            rows.append([
-                r.get('keyword', ''),
-                r.get('chat', ''),
-                r.get('sender', ''),
-                r.get('datetime', ''),
-                r.get('link', ''),
-                r.get('text', '').replace('\n', ' '),
-            ])
+        for r in result_archive.iter_results(parser):
+            rows.append(r.as_row())
     if not rows:
         await safe_send_message(bot, user_id, t('no_results'))
         return
     path = f"results_{user_id}_all.csv"
     with open(path, 'w', newline='', encoding='utf-8') as f:
         writer = csv.writer(f)
-        writer.writerow(["keyword", "chat", "sender", "datetime", "link", "text"])
+        writer.writerow(CSV_HEADER)
         writer.writerows(rows)
     from aiogram import types
     await bot.send_document(user_id, types.InputFile(path), caption=t('csv_export_ready'))
@@ -179,23 +729,14 @@ async def send_parser_results(user_id: int, idx: int):
     if idx < 0 or idx >= len(parsers):
         return
     parser = parsers[idx]
-    results = parser.get('results', [])
-    if not results:
+    if not result_archive.total(parser):
         await safe_send_message(bot, user_id, t('no_results'))
         return
     path = f"results_{user_id}_{idx + 1}.csv"
     with open(path, 'w', newline='', encoding='utf-8') as f:
         writer = csv.writer(f)
-        writer.writerow(["keyword", "chat", "sender", "datetime", "link", "text"])
-        for r in results:
-            writer.writerow([
-                r.get('keyword', ''),
-                r.get('chat', ''),
-                r.get('sender', ''),
-                r.get('datetime', ''),
-                r.get('link', ''),
-                r.get('text', '').replace('\n', ' '),
-            ])
+        writer.writerow(CSV_HEADER)
+        writer.writerows(r.as_row() for r in result_archive.iter_results(parser))
     from aiogram import types
     await bot.send_document(user_id, types.InputFile(path))
     os.remove(path)
@@ -0,0 +1,211 @@
+import asyncio
+import heapq
+import logging
+import time
+
+# Статусы платежей и выплат ЮKassa, после которых опрашивать больше нечего.
+FINAL_STATUSES = {'succeeded', 'canceled', 'expired', 'canceled_by_yoo', 'failed'}
+
+
+class PaymentPoller:
+    """Общий опрос статусов ожидающих платежей и выплат.
+
+    Вместо задачи на каждый платёж — таблица ``pending`` (id -> запись) и
+    куча сроков, которую разбирает одна задача. За проход берётся до
+    ``batch`` записей с наступившим сроком, они проверяются параллельно
+    (не больше ``concurrency`` запросов). Пауза между проверками одной
+    записи растёт от ``first`` до ``longest`` секунд в ``backoff`` раз:
+    только что созданный платёж проверяется часто, брошенный — редко.
+
+    Каждый вид записи (``topup``, ``pro``, ``payout``…) регистрируется через
+    ``register(kind, check, complete)``: ``check(id)`` возвращает статус или
+    None, ``complete(entry, status)`` получает окончательный статус. Если за
+    ``ttl`` секунд его не было, ``complete`` один раз вызывается с
+    ``'timeout'`` (пользователь узнаёт, что оплата не подтвердилась), но
+    запись не закрывается: её проверяют раз в ``longest`` секунд, пока
+    ЮKassa не вернёт окончательный статус, и поздняя оплата зачитывается.
+    Запись закрывается только после того, как ``complete`` отработал без
+    ошибки; при ошибке она остаётся в опросе.
+
+    Если передан ``store`` (``PendingPayments``), записи сохраняются в базу
+    и после рестарта возвращаются в опрос через ``restore``.
+    """
+
+    def __init__(self, batch: int = 20, concurrency: int = 5, first: float = 3.0,
+                 longest: float = 60.0, backoff: float = 1.5, ttl: int = 3600, store=None):
+        self.batch = max(1, batch)
+        self.concurrency = max(1, concurrency)
+        self.first = first
+        self.longest = max(first, longest)
+        self.backoff = backoff
+        self.ttl = ttl
+        self.store = store
+        self.pending = {}       # id -> запись
+        self.stats = {'checks': 0, 'batches': 0, 'completed': 0, 'timeouts': 0, 'errors': 0}
+        self._kinds = {}        # вид -> (check, complete)
+        self._heap = []         # (срок, id)
+        self._due = {}          # id -> актуальный срок
+        self._completing = set()  # id, чей complete ещё выполняется
+        self._sem = None
+        self._wake = None
+        self._task = None
+
+    def __contains__(self, obj_id) -> bool:
+        return obj_id in self.pending
+
+    def __len__(self) -> int:
+        return len(self.pending)
+
+    def register(self, kind: str, check, complete):
+        self._kinds[kind] = (check, complete)
+
+    def add(self, kind: str, obj_id: str, user_id: int, **extra) -> dict:
+        """Поставить платёж или выплату на опрос; ``extra`` (сумма, чаты) уходит в запись."""
+        entry = {'kind': kind, 'id': obj_id, 'user_id': user_id, 'created': int(time.time()),
+                 'interval': self.first, **extra}
+        self.pending[obj_id] = entry
+        if self.store:
+            self.store.save(entry)
+        self._schedule(obj_id, self.first)
+        return entry
+
+    async def restore(self) -> dict:
+        """Вернуть в опрос незакрытые записи из ``store`` и сразу сверить их статусы.
+
+        Возвращает сводку: сколько записей поднято и чем закончилась проверка
+        (``succeeded``, ``canceled``, ``timeout``…, ``pending`` — ждём дальше).
+        """
+        entries = self.store.load() if self.store else []
+        self._start()
+        for entry in entries:
+            self._track(entry)
+        await asyncio.gather(*(self.resolve(entry['id']) for entry in entries))
+        stats = {'restored': len(entries), 'pending': 0}
+        for entry in entries:
+            status = entry.get('status') or ('timeout' if entry.get('timed_out') else 'pending')
+            stats[status] = stats.get(status, 0) + 1
+        return stats
+
+    def _track(self, entry: dict):
+        entry['interval'] = self.longest if entry.get('timed_out') else self.first
+        self.pending[entry['id']] = entry
+
+    async def revive(self, obj_id: str) -> bool:
+        """Вернуть в опрос запись из ``store``, которой нет в памяти, и сразу проверить."""
+        if obj_id in self.pending or obj_id in self._completing:
+            return True
+        entry = self.store.get(obj_id) if self.store else None
+        if entry is None:
+            return False
+        self._start()
+        self._track(entry)
+        return await self.resolve(obj_id)
+
+    def remove(self, obj_id: str) -> dict | None:
+        # Запись в куче удаляется лениво: у неё не будет актуального срока.
+        self._due.pop(obj_id, None)
+        return self.pending.pop(obj_id, None)
+
+    async def resolve(self, obj_id: str) -> bool:
+        """Проверить запись вне очереди (по уведомлению); False, если её не ждали.
+
+        Статус всё равно запрашивается у API, телу уведомления не верим.
+        """
+        entry = self.pending.get(obj_id)
+        if entry is None:
+            return False
+        self._due.pop(obj_id, None)
+        await self._check(entry)
+        return True
+
+    def _schedule(self, obj_id: str, delay: float):
+        due = time.monotonic() + delay
+        self._due[obj_id] = due
+        heapq.heappush(self._heap, (due, obj_id))
+        self._start()
+        self._wake.set()
+
+    def _start(self):
+        if self._wake is None:
+            self._wake = asyncio.Event()
+            self._sem = asyncio.Semaphore(self.concurrency)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            while self._heap and self._due.get(self._heap[0][1]) != self._heap[0][0]:
+                heapq.heappop(self._heap)
+            self._wake.clear()
+            if not self._heap:
+                await self._wake.wait()
+                continue
+            delay = self._heap[0][0] - time.monotonic()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            now = time.monotonic()
+            batch = []
+            while self._heap and self._heap[0][0] <= now and len(batch) < self.batch:
+                due, obj_id = heapq.heappop(self._heap)
+                if self._due.get(obj_id) == due:
+                    del self._due[obj_id]
+                    batch.append(self.pending[obj_id])
+            self.stats['batches'] += 1
+            await asyncio.gather(*(self._check(entry) for entry in batch))
+
+    async def _check(self, entry: dict):
+        check, _ = self._kinds[entry['kind']]
+        async with self._sem:
+            try:
+                status = await check(entry['id'])
+            except Exception:
+                status = None
+                self.stats['errors'] += 1
+                logging.exception("Status check failed for %s %s", entry['kind'], entry['id'])
+        self.stats['checks'] += 1
+        if entry['id'] not in self.pending:
+            return
+        if status in FINAL_STATUSES:
+            await self._complete(entry, status)
+            return
+        entry['interval'] = min(self.longest, entry['interval'] * self.backoff)
+        if not entry.get('timed_out') and time.time() - entry['created'] >= self.ttl:
+            entry['timed_out'] = True
+            entry['interval'] = self.longest
+            self.stats['timeouts'] += 1
+            if self.store:
+                self.store.time_out(entry['id'])
+            _, complete = self._kinds[entry['kind']]
+            try:
+                await complete(entry, 'timeout')
+            except Exception:
+                self.stats['errors'] += 1
+                logging.exception("Timeout notice failed for %s %s", entry['kind'], entry['id'])
+        if entry['id'] in self.pending:
+            self._schedule(entry['id'], entry['interval'])
+
+    async def _complete(self, entry: dict, status: str):
+        # Запись снимается с опроса до вызова, чтобы параллельная проверка
+        # (уведомление и очередной проход) не завершила её второй раз.
+        self.remove(entry['id'])
+        self._completing.add(entry['id'])
+        _, complete = self._kinds[entry['kind']]
+        try:
+            await complete(entry, status)
+        except Exception:
+            self.stats['errors'] += 1
+            logging.exception("Completion failed for %s %s", entry['kind'], entry['id'])
+            entry['interval'] = self.longest
+            self.pending[entry['id']] = entry
+            self._schedule(entry['id'], entry['interval'])
+            return
+        finally:
+            self._completing.discard(entry['id'])
+        entry['status'] = status
+        self.stats['completed'] += 1
+        if self.store:
+            self.store.finish(entry['id'], status)
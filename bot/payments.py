@@ -1,15 +1,24 @@
 from datetime import datetime, timedelta
-import uuid
-from yookassa import Payment
+import logging
 
-from .config import YOOKASSA_SHOP_ID, YOOKASSA_TOKEN, RETURN_URL, PRO_MONTHLY_RUB, bot
-from .data import get_user_data_entry, save_user_data, user_data
+from aiogram.dispatcher import FSMContext
+
+from .config import (
+    YOOKASSA_SHOP_ID, YOOKASSA_TOKEN, RETURN_URL, PRO_MONTHLY_RUB, bot,
+    PAYMENT_POLL_FIRST, PAYMENT_POLL_MAX, PAYMENT_POLL_TTL, PAYMENT_POLL_BATCH, DB_FILE,
+    YOOKASSA_WEBHOOK_PORT, YOOKASSA_WEBHOOK_PATH, YOOKASSA_WEBHOOK_TRUST_PROXY,
+)
+from .data import get_user_data_entry, save_user_data, user_data, payment_client, pending_payments
 from .text_utils import t
-from .billing import _round2
+from .billing import _round2, subscription_changed
 from .utils import safe_send_message
+from .payment_poller import PaymentPoller
+from .pending import mark_applied
+from .yookassa_webhook import YooKassaWebhook
+from .yookassa_client import new_operation
 
 
-def create_payment(user_id: int, amount: str, description: str, user_email: str = None, user_phone: str = None):
+async def create_payment(user_id: int, amount: str, description: str, user_email: str = None, user_phone: str = None, op: str | None = None):
     if not (YOOKASSA_SHOP_ID and YOOKASSA_TOKEN):
         return None, None
     try:
@@ -39,7 +48,8 @@ def create_payment(user_id: int, amount: str, description: str, user_email: str
         else:
             receipt["customer"]["phone"] = "+79777207868"
 
-        payment = Payment.create(
+        status, data = await payment_client.request(
+            "payment_create", "POST", "/payments", (YOOKASSA_SHOP_ID, YOOKASSA_TOKEN),
             {
                 "amount": {"value": amount, "currency": "RUB"},
                 "confirmation": {"type": "redirect", "return_url": RETURN_URL},
@@ -47,69 +57,109 @@ def create_payment(user_id: int, amount: str, description: str, user_email: str
                 "capture": True,
                 "receipt": receipt,
             },
-            str(uuid.uuid4()),
+            op=op or new_operation("payment"),
         )
-        return payment.id, payment.confirmation.confirmation_url
+        if status and 200 <= status < 300:
+            return data["id"], data["confirmation"]["confirmation_url"]
+        logging.error("Payment create failed: %s %s", status, data)
     except Exception:
-        return None, None
+        logging.exception("Failed to create payment")
+    return None, None
 
 
-def create_topup_payment(user_id: int, amount_rub: float):
+async def create_topup_payment(user_id: int, amount_rub: float, op: str | None = None):
     amount = f"{amount_rub:.2f}"
-    return create_payment(user_id, amount, f"Пополнение баланса {user_id} на {amount} ₽")
-
-
-async def wait_topup_and_credit(user_id: int, payment_id: str, amount: float):
-    for _ in range(60):
-        status = check_payment(payment_id)
-        if status == 'succeeded':
-            data = get_user_data_entry(user_id)
-            data['balance'] = _round2(float(data.get('balance', 0)) + amount)
-            data.pop('payment_id', None)
-            save_user_data(user_data)
-            await safe_send_message(bot, user_id, f"✅ Оплата прошла. Баланс пополнен на {amount:.2f} ₽.")
-            return
-        if status in ('canceled', 'expired'):
-            data = get_user_data_entry(user_id)
-            data.pop('payment_id', None)
-            save_user_data(user_data)
-            await safe_send_message(bot, user_id, t('payment_failed', status=status))
-            return
-        from asyncio import sleep
-        await sleep(5)
-    await safe_send_message(bot, user_id, t('payment_failed', status='timeout'))
-
-
-def create_pro_payment(user_id: int):
-    return create_payment(user_id, f"{PRO_MONTHLY_RUB:.2f}", f"Подписка PRO для пользователя {user_id}")
-
-
-def check_payment(payment_id: str):
-    try:
-        payment = Payment.find_one(payment_id)
-        return payment.status
-    except Exception:
+    return await create_payment(user_id, amount, f"Пополнение баланса {user_id} на {amount} ₽", op=op)
+
+
+def _clear_payment_id(data: dict, payment_id: str):
+    if data.get('payment_id') == payment_id:
+        data.pop('payment_id', None)
+
+
+async def finish_topup(entry: dict, status: str):
+    user_id, amount = entry['user_id'], entry['amount']
+    if status == 'timeout':
+        await safe_send_message(bot, user_id, t('payment_pending'))
+        return
+    data = get_user_data_entry(user_id)
+    _clear_payment_id(data, entry['id'])
+    if status == 'succeeded' and mark_applied(data, entry['id']):
+        data['balance'] = _round2(float(data.get('balance', 0)) + amount)
+    save_user_data(user_data)
+    if status == 'succeeded':
+        await safe_send_message(bot, user_id, f"✅ Оплата прошла. Баланс пополнен на {amount:.2f} ₽.")
+    elif not entry.get('timed_out'):
+        # После таймаута пользователь уже получил сообщение о неподтверждённой оплате.
+        await safe_send_message(bot, user_id, t('payment_failed', status=status))
+
+
+async def create_pro_payment(user_id: int, op: str | None = None):
+    return await create_payment(user_id, f"{PRO_MONTHLY_RUB:.2f}", f"Подписка PRO для пользователя {user_id}", op=op)
+
+
+async def action_op(state: FSMContext, kind: str) -> str:
+    """Id операции текущего действия пользователя, хранящийся в FSM.
+
+    Первый вызов выдаёт новый id, повторы (двойное нажатие, повторная
+    отправка до ``state.finish()``) получают тот же, и ЮKassa вернёт уже
+    созданный объект. После ``state.finish()`` следующее действие получит
+    новый id.
+    """
+    data = await state.get_data()
+    op = data.get('op')
+    if not op:
+        op = new_operation(kind)
+        await state.update_data(op=op)
+    return op
+
+
+async def check_payment(payment_id: str):
+    if not (YOOKASSA_SHOP_ID and YOOKASSA_TOKEN):
         return None
+    status, data = await payment_client.request(
+        "payment_status", "GET", f"/payments/{payment_id}", (YOOKASSA_SHOP_ID, YOOKASSA_TOKEN)
+    )
+    if status and 200 <= status < 300:
+        return data.get("status")
+    logging.error("Payment status failed: %s %s", status, data)
+    return None
+
+
+async def finish_pro_payment(entry: dict, status: str):
+    user_id = entry['user_id']
+    if status == 'timeout':
+        await safe_send_message(bot, user_id, t('payment_pending'))
+        return
+    data = get_user_data_entry(user_id)
+    _clear_payment_id(data, entry['id'])
+    if status == 'succeeded' and mark_applied(data, entry['id']):
+        expiry = int((datetime.utcnow() + timedelta(days=30)).timestamp())
+        data['subscription_expiry'] = expiry
+        data['chat_limit'] = entry['chats']
+        subscription_changed(user_id)
+    save_user_data(user_data)
+    if status == 'succeeded':
+        await safe_send_message(bot, user_id, t('payment_success'))
+    elif not entry.get('timed_out'):
+        # После таймаута пользователь уже получил сообщение о неподтверждённой оплате.
+        await safe_send_message(bot, user_id, t('payment_failed', status=status))
+
+
+payment_poller = PaymentPoller(
+    PAYMENT_POLL_BATCH,
+    first=PAYMENT_POLL_MAX if YOOKASSA_WEBHOOK_PORT else PAYMENT_POLL_FIRST,
+    longest=PAYMENT_POLL_MAX,
+    ttl=PAYMENT_POLL_TTL,
+    store=pending_payments,
+)
+payment_poller.register('topup', check_payment, finish_topup)
+payment_poller.register('pro', check_payment, finish_pro_payment)
+payment_poller.register('expand', check_payment, finish_pro_payment)
+yookassa_webhook = YooKassaWebhook(payment_poller, DB_FILE, YOOKASSA_WEBHOOK_PATH, YOOKASSA_WEBHOOK_TRUST_PROXY)
 
 
-async def wait_payment_and_activate(user_id: int, payment_id: str, chats: int):
-    for _ in range(60):
-        status = check_payment(payment_id)
-        if status == 'succeeded':
-            data = get_user_data_entry(user_id)
-            expiry = int((datetime.utcnow() + timedelta(days=30)).timestamp())
-            data['subscription_expiry'] = expiry
-            data['chat_limit'] = chats
-            data.pop('payment_id', None)
-            save_user_data(user_data)
-            await safe_send_message(bot, user_id, t('payment_success'))
-            return
-        if status in ('canceled', 'expired'):
-            data = get_user_data_entry(user_id)
-            data.pop('payment_id', None)
-            save_user_data(user_data)
-            await safe_send_message(bot, user_id, t('payment_failed', status=status))
-            return
-        from asyncio import sleep
-        await sleep(5)
-    await safe_send_message(bot, user_id, t('payment_failed', status='timeout'))
+async def reconcile_pending_payments():
+    stats = await payment_poller.restore()
+    if stats['restored']:
+        logging.info("Pending payments reconciled: %s", stats)
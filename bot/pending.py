@@ -0,0 +1,91 @@
+import sqlite3
+import time
+
+# Сколько последних применённых операций помнит запись пользователя.
+APPLIED_KEEP = 50
+
+
+def mark_applied(data: dict, obj_id: str) -> bool:
+    """Отметить в записи пользователя, что платёж или выплата ``obj_id`` применены.
+
+    Возвращает False, если операция уже была применена. Отметка сохраняется
+    вместе с балансом одним ``save_user_data``, поэтому рестарт между
+    зачислением и ``PendingPayments.finish`` не зачтёт платёж второй раз.
+    """
+    applied = data.setdefault('applied_payments', [])
+    if obj_id in applied:
+        return False
+    applied.append(obj_id)
+    del applied[:-APPLIED_KEEP]
+    return True
+
+
+class PendingPayments:
+    """Ожидающие платежи и выплаты в общей базе, чтобы пережить рестарт.
+
+    Запись появляется при создании платежа и закрывается окончательным
+    статусом (``finish``), поэтому таблица заодно служит журналом. Статус
+    ``timeout`` (``time_out``) окончательным не считается: такие записи
+    проверяются и дальше, пока платёж не оплатят или не отменят. При старте
+    ``load`` отдаёт незакрытые записи для повторной проверки.
+    """
+
+    def __init__(self, path: str):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS pending_payments ("
+            "id TEXT PRIMARY KEY, kind TEXT NOT NULL, user_id INTEGER NOT NULL, amount REAL, "
+            "chats INTEGER, created_at INTEGER NOT NULL, status TEXT, finished_at INTEGER)"
+        )
+        self.conn.commit()
+
+    def save(self, entry: dict):
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO pending_payments(id, kind, user_id, amount, chats, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (entry['id'], entry['kind'], entry['user_id'], entry.get('amount'),
+                 entry.get('chats'), entry['created']),
+            )
+
+    def finish(self, obj_id: str, status: str):
+        with self.conn:
+            self.conn.execute(
+                "UPDATE pending_payments SET status = ?, finished_at = ? WHERE id = ?",
+                (status, int(time.time()), obj_id),
+            )
+
+    def time_out(self, obj_id: str):
+        """Отметить, что за отведённое время статус не пришёл (запись остаётся открытой)."""
+        with self.conn:
+            self.conn.execute(
+                "UPDATE pending_payments SET status = 'timeout' WHERE id = ? AND status IS NULL", (obj_id,)
+            )
+
+    def load(self) -> list:
+        """Незакрытые записи в виде, который принимает ``PaymentPoller``."""
+        rows = self.conn.execute(
+            "SELECT id, kind, user_id, amount, chats, created_at, status FROM pending_payments "
+            "WHERE status IS NULL OR status = 'timeout' ORDER BY created_at"
+        ).fetchall()
+        return [self._entry(row) for row in rows]
+
+    def get(self, obj_id: str) -> dict | None:
+        """Незакрытая запись (в том числе после таймаута) или None."""
+        row = self.conn.execute(
+            "SELECT id, kind, user_id, amount, chats, created_at, status FROM pending_payments "
+            "WHERE id = ? AND (status IS NULL OR status = 'timeout')", (obj_id,)
+        ).fetchone()
+        return self._entry(row) if row else None
+
+    @staticmethod
+    def _entry(row) -> dict:
+        obj_id, kind, user_id, amount, chats, created, status = row
+        entry = {'kind': kind, 'id': obj_id, 'user_id': user_id, 'created': created}
+        if amount is not None:
+            entry['amount'] = amount
+        if chats is not None:
+            entry['chats'] = chats
+        if status == 'timeout':
+            entry['timed_out'] = True
+        return entry
@@ -0,0 +1,95 @@
+import asyncio
+import heapq
+import logging
+import time
+
+from .models import parser_key
+
+
+class PollScheduler:
+    """Периодический опрос парсеров в режиме ``poll``.
+
+    Такие парсеры не вешают обработчик ``NewMessage``: раз в ``interval``
+    секунд ``poll(user_id, parser)`` забирает новые сообщения пачкой.
+    Очередь сроков — куча, одновременно опрашивается не больше
+    ``concurrency`` парсеров, так что живые обработчики не делят с опросом
+    ни воркеров, ни очередь запросов.
+    """
+
+    def __init__(self, poll, concurrency: int = 2):
+        self.poll = poll
+        self.concurrency = max(1, concurrency)
+        self.stats = {'polls': 0, 'errors': 0, 'skipped': 0, 'time_total': 0.0}
+        self._heap = []         # (срок, поколение, ключ парсера)
+        self._jobs = {}         # ключ -> (user_id, parser, interval, поколение)
+        self._running = set()
+        self._gen = 0
+        self._sem = None
+        self._wake = None
+        self._task = None
+
+    def __contains__(self, parser) -> bool:
+        return parser_key(parser) in self._jobs
+
+    def __len__(self) -> int:
+        return len(self._jobs)
+
+    def add(self, user_id, parser: dict, interval: int, delay: float | None = None):
+        """Поставить парсер на опрос (повторный вызов переносит расписание)."""
+        key = parser_key(parser)
+        self._gen += 1
+        self._jobs[key] = (user_id, parser, max(10, interval), self._gen)
+        due = time.monotonic() + (interval if delay is None else delay)
+        heapq.heappush(self._heap, (due, self._gen, key))
+        self._start()
+        self._wake.set()
+
+    def remove(self, parser: dict):
+        # Записи в куче удаляются лениво по несовпадению поколения.
+        self._jobs.pop(parser_key(parser), None)
+
+    def _start(self):
+        if self._wake is None:
+            self._wake = asyncio.Event()
+            self._sem = asyncio.Semaphore(self.concurrency)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            while self._heap and self._jobs.get(self._heap[0][2], (0, 0, 0, None))[3] != self._heap[0][1]:
+                heapq.heappop(self._heap)
+            self._wake.clear()
+            if not self._heap:
+                await self._wake.wait()
+                continue
+            due, gen, key = self._heap[0]
+            delay = due - time.monotonic()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            heapq.heappop(self._heap)
+            user_id, parser, interval, _ = self._jobs[key]
+            heapq.heappush(self._heap, (time.monotonic() + interval, gen, key))
+            if key in self._running:
+                # Прошлый опрос ещё идёт — этот пропускаем, а не копим.
+                self.stats['skipped'] += 1
+                continue
+            self._running.add(key)
+            asyncio.create_task(self._poll_one(key, user_id, parser))
+
+    async def _poll_one(self, key, user_id, parser):
+        async with self._sem:
+            started = time.monotonic()
+            try:
+                await self.poll(user_id, parser)
+            except Exception:
+                self.stats['errors'] += 1
+                logging.exception("Poll failed for user %s parser %s", user_id, key)
+            finally:
+                self._running.discard(key)
+                self.stats['polls'] += 1
+                self.stats['time_total'] += time.monotonic() - started
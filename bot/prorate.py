@@ -0,0 +1,123 @@
+import math
+import time
+import zlib
+from datetime import datetime
+
+# Ключ журнала почасового расчёта: '2024-05-01T13'.
+PERIOD_PATTERN = '____-__-__T__'
+
+
+def accrue_parser(parser: dict, parser_cost, now: int | None = None) -> float:
+    """Начислить стоимость активного времени парсера с прошлой отметки.
+
+    ``parser['active_since']`` ставится при запуске и сдвигается при каждом
+    начислении; накопленное лежит в ``parser['accrued']`` до расчёта.
+    Активный парсер без отметки (старые данные) начинает копить с ``now``.
+    """
+    now = now or int(time.time())
+    since = parser.get('active_since')
+    amount = 0.0
+    if since:
+        amount = max(0, now - since) / 86400 * parser_cost(parser)
+        parser['accrued'] = parser.get('accrued', 0.0) + amount
+    if parser.get('status') == 'active':
+        parser['active_since'] = now
+    else:
+        parser.pop('active_since', None)
+    return amount
+
+
+def pending_charge(user: dict, parser_cost, now: int | None = None) -> float:
+    """Сумма к списанию в копейках на момент ``now`` без изменения записи."""
+    now = now or int(time.time())
+    total = user.get('accrued', 0.0)
+    for p in user.get('parsers', []):
+        total += p.get('accrued', 0.0)
+        since = p.get('active_since')
+        if since:
+            total += max(0, now - since) / 86400 * parser_cost(p)
+    return math.floor(total * 100 + 1e-6) / 100
+
+
+def collect_user(user: dict, parser_cost, now: int | None = None) -> float:
+    """Перенести начисления всех парсеров в ``user['accrued']``; вернуть итог."""
+    now = now or int(time.time())
+    total = user.get('accrued', 0.0)
+    for p in user.get('parsers', []):
+        if p.get('active_since') or p.get('status') == 'active':
+            accrue_parser(p, parser_cost, now)
+        total += p.pop('accrued', 0.0)
+    user['accrued'] = total
+    return total
+
+
+def settle_user(user: dict, parser_cost, now: int | None = None) -> float:
+    """Собрать начисления пользователя; вернуть сумму к списанию в копейках.
+
+    Дробный остаток меньше копейки остаётся в ``user['accrued']`` и уходит
+    в следующий расчёт.
+    """
+    total = collect_user(user, parser_cost, now)
+    charge = math.floor(total * 100 + 1e-6) / 100
+    user['accrued'] = total - charge
+    return charge
+
+
+def _apply(user: dict, parser_cost, now: int, period: str, amount: float):
+    collect_user(user, parser_cost, now)
+    user['accrued'] -= amount
+    user['balance'] = round(float(user.get('balance', 0)) - amount, 2)
+    user['billed_period'] = period
+
+
+def settle_batch(users: dict, batch: int, ledger, parser_cost, block, now: int | None = None) -> tuple[bool, list]:
+    """Почасовое списание одной группы пользователей (из ``batches=60``).
+
+    Сумма сначала считается без изменения записей и пишется в журнал
+    (ключ — час расчёта); начисления сбрасываются и баланс уменьшается
+    только у тех, чья запись в журнал добавлена, с отметкой
+    ``billed_period``. Если бот упал между журналом и сохранением
+    ``users``, последняя запись журнала доприменяется при следующем
+    проходе группы. Кому не хватает денег, у тех ``block(uid)`` ставит
+    парсеры на паузу, а долг остаётся в ``accrued``.
+
+    Возвращает (изменены ли записи, заблокированные uid).
+    """
+    now = now or int(time.time())
+    period = datetime.utcfromtimestamp(now).strftime('%Y-%m-%dT%H')
+    uids = [uid for uid in users if user_batch(uid, 60) == batch]
+    changed = False
+    for uid, (last, amount) in ledger.latest(uids, PERIOD_PATTERN).items():
+        user = users[uid]
+        # Без отметки — записи до её появления, они уже применены.
+        if user.get('billed_period') and user['billed_period'] < last:
+            _apply(user, parser_cost, now, last, amount)
+            changed = True
+    debits = []
+    blocked = []
+    for uid in uids:
+        user = users[uid]
+        if user.get('billed_period') == period:
+            continue
+        charge = pending_charge(user, parser_cost, now)
+        if charge <= 0:
+            continue
+        bal = float(user.get('balance', 0))
+        if bal >= charge:
+            debits.append((uid, charge, round(bal - charge, 2)))
+        else:
+            collect_user(user, parser_cost, now)
+            changed = True
+            if block(uid):
+                blocked.append(uid)
+    added = ledger.record(period, debits)
+    for uid, charge, _ in debits:
+        if uid in added:
+            _apply(users[uid], parser_cost, now, period, charge)
+            changed = True
+    return changed, blocked
+
+
+def user_batch(uid, batches: int) -> int:
+    """Номер группы пользователя для почасового расчёта (стабилен между рестартами)."""
+    return zlib.crc32(str(uid).encode()) % batches
@@ -0,0 +1,71 @@
+from telethon.utils import resolve_id
+
+from .api_scheduler import api_call, MONITORING
+
+
+def chat_key(chat_id) -> str:
+    """Ключ чата в ``parser['last_seen']``: id без префикса -100.
+
+    В ``parser['chats']`` лежат id сущностей, а в событиях — «помеченные»
+    id, поэтому оба приводятся к одному виду.
+    """
+    return str(resolve_id(int(chat_id))[0])
+
+
+def mark_seen(parser: dict, message) -> bool:
+    """Запомнить последний увиденный id сообщения в чате. True, если сдвинулся."""
+    seen = parser.setdefault('last_seen', {})
+    key = chat_key(message.chat_id)
+    if message.id > seen.get(key, 0):
+        seen[key] = message.id
+        return True
+    return False
+
+
+def mark_missed(parser: dict, message, limit: int = 1000):
+    """Запомнить сообщение, которое очередь выбросила, не обработав.
+
+    ``last_seen`` — это наибольший увиденный id, и параллельные воркеры
+    сдвигают его дальше выброшенного сообщения, поэтому пропуск хранится
+    отдельно: ``parser['missed'][chat_key]`` — список id, который дочитывает
+    ``recover_gaps``. На чат хранится не больше ``limit`` последних id.
+    """
+    missed = parser.setdefault('missed', {}).setdefault(chat_key(message.chat_id), [])
+    missed.append(message.id)
+    del missed[:-limit]
+
+
+async def fetch_missed(client, chat, ids: list, priority: int = MONITORING) -> list:
+    """Сообщения чата по списку id (удалённые пропускаются), по 100 за запрос."""
+    found = []
+    for start in range(0, len(ids), 100):
+        batch = await api_call(
+            client, 'history', client.get_messages, chat, ids=ids[start:start + 100], priority=priority,
+        )
+        found.extend(m for m in batch if m is not None)
+    return found
+
+
+async def latest_message_id(client, chat, priority: int = MONITORING) -> int:
+    batch = await api_call(client, 'history', client.get_messages, chat, limit=1, priority=priority)
+    return batch[0].id if batch else 0
+
+
+async def iter_missed(client, chat, after_id: int, max_messages: int, priority: int = MONITORING):
+    """Сообщения чата с id больше ``after_id``, от старых к новым, пачками по 100."""
+    offset_id = after_id
+    remaining = max_messages
+    while remaining > 0:
+        batch = await api_call(
+            client, 'history', client.get_messages, chat,
+            limit=min(100, remaining), offset_id=offset_id, reverse=True,
+            priority=priority,
+        )
+        if not batch:
+            return
+        for msg in batch:
+            offset_id = msg.id
+            remaining -= 1
+            yield msg
+        if len(batch) < 100:
+            return
@@ -0,0 +1,146 @@
+import asyncio
+import logging
+import re
+import sqlite3
+
+from telethon.errors import (
+    FloodWaitError,
+    ChannelPrivateError,
+    UsernameInvalidError,
+    UsernameNotOccupiedError,
+    InviteHashExpiredError,
+    InviteHashInvalidError,
+)
+
+from .api_scheduler import api_call, INTERACTIVE
+
+_T_ME_RE = re.compile(r'^(?:https?://)?(?:www\.)?(?:t\.me|telegram\.me)/', re.I)
+
+
+def normalize_link(part: str) -> str:
+    """Ключ кэша: ``@Name``, ``t.me/name`` и ``name`` дают одно и то же.
+
+    Инвайт-ссылки (``+hash``, ``joinchat/hash``) чувствительны к регистру
+    и остаются как есть.
+    """
+    part = part.strip()
+    path = _T_ME_RE.sub('', part).strip('/')
+    if path.startswith('+') or path.lower().startswith('joinchat/'):
+        return path
+    return path.lstrip('@').split('/')[0].lower()
+
+
+class ChatResolver:
+    """Разрешение ссылок на чаты в id с постоянным кэшем на аккаунт.
+
+    Ссылки одного списка разрешаются параллельно через планировщик
+    аккаунта (лимиты и FloodWait — там же). Найденные id
+    сохраняются в таблицу ``chat_cache`` общей базы, поэтому повторные
+    ссылки (в т.ч. из других парсеров того же аккаунта) не идут в API.
+    Ссылки, упёршиеся в FloodWait длиннее лимита планировщика, не считаются
+    ошибкой: ``resolve`` возвращает их отдельно, а ``resolve_later``
+    повторяет после паузы.
+    """
+
+    def __init__(self, path: str):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS chat_cache ("
+            "account TEXT NOT NULL, link TEXT NOT NULL, peer_id INTEGER NOT NULL, "
+            "PRIMARY KEY (account, link))"
+        )
+        self.conn.commit()
+        self._cache = {}
+        # Одна и та же ссылка, вставленная дважды, запрашивается один раз.
+        self._inflight = {}
+
+    def _account_cache(self, account) -> dict:
+        account = str(account)
+        cache = self._cache.get(account)
+        if cache is None:
+            rows = self.conn.execute(
+                "SELECT link, peer_id FROM chat_cache WHERE account = ?", (account,)
+            ).fetchall()
+            cache = self._cache[account] = dict(rows)
+        return cache
+
+    def _remember(self, account, link: str, peer_id: int):
+        self._account_cache(account)[link] = peer_id
+        try:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO chat_cache(account, link, peer_id) VALUES (?, ?, ?)",
+                (str(account), link, peer_id),
+            )
+            self.conn.commit()
+        except Exception:
+            logging.exception("Failed to cache chat %s", link)
+
+    async def _fetch(self, client, part: str) -> int:
+        entity = await api_call(client, 'resolve', client.get_entity, part, priority=INTERACTIVE)
+        return entity.id
+
+    async def _resolve_one(self, client, account, part: str):
+        """``(id, ошибка, пауза)``: ``пауза`` — секунды FloodWait, после которых повторить."""
+        if part.lstrip('-').isdigit():
+            return int(part), None, 0
+        link = normalize_link(part)
+        cached = self._account_cache(account).get(link)
+        if cached is not None:
+            return cached, None, 0
+        key = (str(account), link)
+        task = self._inflight.get(key)
+        if task is None:
+            task = self._inflight[key] = asyncio.ensure_future(self._fetch(client, part))
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        try:
+            peer_id = await task
+        except FloodWaitError as e:
+            return None, None, max(1, e.seconds)
+        except ChannelPrivateError:
+            return None, "нет доступа (приватный чат)", 0
+        except (InviteHashExpiredError, InviteHashInvalidError):
+            return None, "приглашение недействительно", 0
+        except (UsernameNotOccupiedError, UsernameInvalidError, ValueError):
+            return None, "чат не найден", 0
+        except Exception:
+            logging.exception("Failed to resolve chat %s", part)
+            return None, "чат не найден", 0
+        self._remember(account, link, peer_id)
+        return peer_id, None, 0
+
+    async def resolve(self, client, account, parts: list) -> tuple[list, list, list]:
+        """Вернуть ``(ids, errors, delayed)``.
+
+        ``errors`` — список ``(ссылка, причина)``, ``delayed`` — ``(ссылка,
+        секунды)`` для ссылок, упёршихся в FloodWait. Порядок id
+        соответствует порядку ссылок, повторы убираются.
+        """
+        outcomes = await asyncio.gather(
+            *(self._resolve_one(client, account, part) for part in parts)
+        )
+        ids, errors, delayed = [], [], []
+        for part, (peer_id, error, wait) in zip(parts, outcomes):
+            if wait:
+                delayed.append((part, wait))
+            elif error:
+                errors.append((part, error))
+            elif peer_id not in ids:
+                ids.append(peer_id)
+        return ids, errors, delayed
+
+    async def resolve_later(self, client, account, delayed: list, attempts: int = 3) -> tuple[list, list]:
+        """Дождаться FloodWait из ``delayed`` и разрешить ссылки заново.
+
+        Возвращает ``(ids, errors)``; ссылки, так и не прошедшие лимит за
+        ``attempts`` попыток, попадают в ``errors``.
+        """
+        ids, errors = [], []
+        for _ in range(attempts):
+            if not delayed:
+                break
+            await asyncio.sleep(max(wait for _, wait in delayed) + 1)
+            found, failed, delayed = await self.resolve(client, account, [part for part, _ in delayed])
+            ids.extend(i for i in found if i not in ids)
+            errors.extend(failed)
+        errors.extend((part, f"лимит Telegram, повторите через {wait} сек.") for part, wait in delayed)
+        return ids, errors
@@ -0,0 +1,131 @@
+import asyncio
+import logging
+import re
+import sqlite3
+from functools import lru_cache
+
+from .models import Result, parser_key
+
+WORD_RE = re.compile(r'\w+')
+# Колонки, по которым ищутся слова запроса (owner — служебный токен владельца).
+TEXT_COLUMNS = '{keyword chat sender text lemmas}'
+
+
+def owner_token(user_id) -> str:
+    return f'u{user_id}'
+
+
+class LeadIndex:
+    """Полнотекстовый индекс найденных лидов (SQLite FTS5).
+
+    Помимо исходного текста индексируются леммы слов, полученные той же
+    функцией нормализации, что и при поиске ключевых слов, поэтому запрос
+    «ремонт» находит «ремонта», «ремонтом» и т.п.
+
+    Владелец записи хранится индексируемым токеном ``u<id>`` в колонке
+    ``owner``, и запрос всегда пересекается с ним: поиск идёт по спискам
+    документов одного пользователя, а не по всем лидам с фильтром после.
+    Слова запроса ищутся только в текстовых колонках (``TEXT_COLUMNS``).
+    """
+
+    def __init__(self, path: str, normalize):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS leads USING fts5("
+            "owner, parser UNINDEXED, dt UNINDEXED, link UNINDEXED, "
+            "keyword, chat, sender, text, lemmas, tokenize='unicode61')"
+        )
+        self.conn.commit()
+        self._normalize = lru_cache(maxsize=200_000)(normalize)
+
+    def lemmas(self, text: str) -> str:
+        return ' '.join(self._normalize(w) for w in WORD_RE.findall(text.lower()))
+
+    def _row(self, user_id: int, parser: dict, r: Result, lemmas: str | None = None):
+        return (
+            owner_token(user_id), parser_key(parser), r.datetime, r.link,
+            r.keyword, r.chat, r.sender, r.text,
+            lemmas if lemmas is not None else self.lemmas(r.text),
+        )
+
+    def add(self, user_id: int, parser: dict, r: Result, lemmas: list | None = None):
+        try:
+            self.conn.execute(
+                "INSERT INTO leads(owner, parser, dt, link, keyword, chat, sender, text, lemmas) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                self._row(user_id, parser, r, ' '.join(lemmas) if lemmas is not None else None),
+            )
+            self.conn.commit()
+        except Exception:
+            logging.exception("Failed to index lead for %s", user_id)
+
+    def drop_parser(self, parser: dict):
+        if parser.get('key'):
+            self.conn.execute("DELETE FROM leads WHERE parser = ?", (parser['key'],))
+            self.conn.commit()
+
+    async def rebuild_if_empty(self, user_data: dict, iter_results):
+        """Построить индекс с нуля, если база пустая (первый запуск)."""
+        if self.conn.execute("SELECT 1 FROM leads LIMIT 1").fetchone():
+            return
+        total = 0
+        for uid, u in list(user_data.items()):
+            for p in u.get('parsers', []):
+                batch = []
+                for r in iter_results(p):
+                    batch.append(self._row(uid, p, r))
+                    if len(batch) >= 500:
+                        total += self._insert_many(batch)
+                        batch = []
+                        await asyncio.sleep(0)
+                total += self._insert_many(batch)
+        if total:
+            logging.info("Search index built: %s leads", total)
+
+    def _insert_many(self, rows: list) -> int:
+        if rows:
+            self.conn.executemany(
+                "INSERT INTO leads(owner, parser, dt, link, keyword, chat, sender, text, lemmas) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            self.conn.commit()
+        return len(rows)
+
+    def _match_expr(self, query: str) -> str | None:
+        terms = []
+        for w in WORD_RE.findall(query.lower()):
+            lemma = self._normalize(w)
+            variants = {f'"{w}"', f'"{lemma}"'}
+            terms.append('(' + ' OR '.join(sorted(variants)) + ')')
+        return ' AND '.join(terms) if terms else None
+
+    def search(self, user_id: int, query: str, before: int | None = None, limit: int = 5):
+        """Страница совпадений, от новых к старым по времени сообщения.
+
+        ``before`` — rowid последней показанной записи (курсор): следующая
+        страница начинается после неё в порядке ``(dt, rowid)``. Возвращает
+        список ``(rowid, dt, chat, sender, keyword, link, text)``.
+        """
+        expr = self._match_expr(query)
+        if not expr:
+            return []
+        sql = (
+            "SELECT rowid, dt, chat, sender, keyword, link, text FROM leads "
+            "WHERE leads MATCH ?"
+        )
+        args = [f'owner:"{owner_token(user_id)}" AND {TEXT_COLUMNS}: ({expr})']
+        if before is not None:
+            row = self.conn.execute("SELECT dt FROM leads WHERE rowid = ?", (before,)).fetchone()
+            if row is None:
+                return []
+            sql += " AND (dt < ? OR (dt = ? AND rowid < ?))"
+            args += [row[0], row[0], before]
+        sql += " ORDER BY dt DESC, rowid DESC LIMIT ?"
+        args.append(limit)
+        try:
+            return self.conn.execute(sql, args).fetchall()
+        except sqlite3.OperationalError:
+            logging.exception("Search query failed: %r", query)
+            return []
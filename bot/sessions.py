@@ -0,0 +1,115 @@
+import glob
+import json
+import logging
+import os
+import re
+import sqlite3
+import time
+from contextlib import closing
+
+from telethon.sessions import StringSession, SQLiteSession
+
+_SESSION_FILE_RE = re.compile(r'^session_(\d+)\.session$')
+
+
+class SessionStore:
+    """Telethon-сессии пользователей в общей базе вместо файлов session_<id>.
+
+    Хранится строка StringSession (DC, адрес, ключ авторизации) и кэш
+    сущностей, чтобы после рестарта не резолвить чаты заново. Все строки
+    читаются одним запросом при старте; другой процесс с той же базой
+    видит те же сессии.
+    """
+
+    def __init__(self, path: str):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "user_id TEXT PRIMARY KEY, session TEXT NOT NULL, "
+            "entities TEXT NOT NULL DEFAULT '[]', updated_at INTEGER NOT NULL)"
+        )
+        self.conn.commit()
+        self._cache = {}
+
+    def load_all(self) -> int:
+        rows = self.conn.execute("SELECT user_id, session, entities FROM sessions").fetchall()
+        self._cache = {uid: (blob, entities) for uid, blob, entities in rows}
+        return len(rows)
+
+    def _row(self, user_id):
+        key = str(user_id)
+        row = self._cache.get(key)
+        if row is None:
+            row = self.conn.execute(
+                "SELECT session, entities FROM sessions WHERE user_id = ?", (key,)
+            ).fetchone()
+            if row:
+                self._cache[key] = row
+        return row
+
+    def has(self, user_id) -> bool:
+        row = self._row(user_id)
+        return bool(row and row[0])
+
+    def session(self, user_id) -> StringSession:
+        """Сессия для ``TelegramClient``; пустая, если пользователь не входил."""
+        row = self._row(user_id)
+        session = StringSession(row[0] if row else None)
+        if row:
+            try:
+                session._entities.update(tuple(e) for e in json.loads(row[1]))
+            except Exception:
+                logging.exception("Broken entity cache for session %s", user_id)
+        return session
+
+    def save(self, user_id, session):
+        """Сохранить ключ и кэш сущностей клиента (``client.session``)."""
+        blob = StringSession.save(session)
+        if not blob:
+            return
+        entities = json.dumps([list(e) for e in getattr(session, '_entities', ())], ensure_ascii=False)
+        key = str(user_id)
+        self.conn.execute(
+            "INSERT OR REPLACE INTO sessions(user_id, session, entities, updated_at) VALUES (?, ?, ?, ?)",
+            (key, blob, entities, int(time.time())),
+        )
+        self.conn.commit()
+        self._cache[key] = (blob, entities)
+
+    def delete(self, user_id):
+        key = str(user_id)
+        self.conn.execute("DELETE FROM sessions WHERE user_id = ?", (key,))
+        self.conn.commit()
+        self._cache.pop(key, None)
+
+    def migrate_files(self, directory: str = '.') -> int:
+        """Перенести старые файлы session_<id>.session в базу.
+
+        Файл после переноса переименовывается в ``*.session.migrated``.
+        """
+        moved = 0
+        for path in glob.glob(os.path.join(directory, 'session_*.session')):
+            m = _SESSION_FILE_RE.match(os.path.basename(path))
+            if not m or self.has(m.group(1)):
+                continue
+            try:
+                old = SQLiteSession(path[:-len('.session')])
+                blob = StringSession.save(old)
+                old.close()
+                with closing(sqlite3.connect(path)) as conn:
+                    rows = conn.execute('SELECT id, hash, username, phone, name FROM entities').fetchall()
+            except Exception:
+                logging.exception("Failed to migrate session file %s", path)
+                continue
+            if not blob:
+                continue
+            self.conn.execute(
+                "INSERT OR REPLACE INTO sessions(user_id, session, entities, updated_at) VALUES (?, ?, ?, ?)",
+                (m.group(1), blob, json.dumps([list(r) for r in rows], ensure_ascii=False), int(time.time())),
+            )
+            self.conn.commit()
+            os.replace(path, path + '.migrated')
+            moved += 1
+        if moved:
+            logging.info("Migrated %s session files into the database", moved)
+        return moved
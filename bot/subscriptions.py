@@ -0,0 +1,105 @@
+import asyncio
+import heapq
+import logging
+from datetime import datetime
+
+# Событие и за сколько секунд до окончания подписки оно наступает.
+EVENTS = (('reminder3', 3 * 86400), ('reminder1', 86400), ('expiry', 0))
+# Флаг в записи пользователя, отмечающий уже отправленное событие.
+SENT_FLAGS = {'reminder3': 'reminder3_sent', 'reminder1': 'reminder1_sent', 'expiry': 'inactive_notified'}
+# События, опоздавшие при старте больше чем на столько, не отправляются.
+REBUILD_GRACE = 86400
+
+
+def _now() -> float:
+    # Сроки подписок записываются как datetime.utcnow().timestamp(), сравниваем в той же шкале.
+    return datetime.utcnow().timestamp()
+
+
+class SubscriptionTimers:
+    """Ближайшие события подписок в min-куче, которую разбирает одна задача.
+
+    Куча восстанавливается из ``user_data`` при старте (``rebuild``), а при
+    смене подписки ``schedule`` добавляет три новых события за O(log n).
+    Старые записи не удаляются из кучи: событие с устаревшим сроком
+    подписки просто пропускается при извлечении. ``fire(user_id, kind)`` —
+    корутина, которая отправляет напоминание или выгрузку.
+    """
+
+    def __init__(self, fire):
+        self.fire = fire
+        self.stats = {'fired': 0, 'errors': 0}
+        self._heap = []         # (когда, user_id, событие, срок подписки)
+        self._expiry = {}       # user_id -> актуальный срок подписки
+        self._wake = None
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def rebuild(self, users: dict, grace: int = REBUILD_GRACE) -> int:
+        """Собрать кучу из ``users``; вернуть число записей, помеченных без отправки.
+
+        Событие, срок которого прошёл больше ``grace`` секунд назад (старые
+        данные без флагов, долгий простой бота), не ставится в очередь, а
+        помечается отправленным — иначе при первом запуске все давно
+        истёкшие подписки разом получили бы уведомление. Изменённые записи
+        сохраняет вызывающий.
+        """
+        self._heap = []
+        self._expiry = {}
+        stale = _now() - grace
+        marked = 0
+        for uid, data in users.items():
+            expiry = data.get('subscription_expiry') or 0
+            if not expiry:
+                continue
+            self._expiry[uid] = expiry
+            changed = False
+            for kind, before in EVENTS:
+                flag = SENT_FLAGS[kind]
+                if data.get(flag):
+                    continue
+                if expiry - before < stale:
+                    data[flag] = changed = True
+                else:
+                    self._heap.append((expiry - before, uid, kind, expiry))
+            marked += changed
+        heapq.heapify(self._heap)
+        if self._wake:
+            self._wake.set()
+        return marked
+
+    def schedule(self, user_id, expiry: int):
+        uid = str(user_id)
+        if expiry:
+            self._expiry[uid] = expiry
+            for kind, before in EVENTS:
+                heapq.heappush(self._heap, (expiry - before, uid, kind, expiry))
+        else:
+            self._expiry.pop(uid, None)
+        if self._wake:
+            self._wake.set()
+
+    async def run(self):
+        self._wake = asyncio.Event()
+        while True:
+            while self._heap and self._expiry.get(self._heap[0][1]) != self._heap[0][3]:
+                heapq.heappop(self._heap)
+            self._wake.clear()
+            if not self._heap:
+                await self._wake.wait()
+                continue
+            delay = self._heap[0][0] - _now()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), min(delay, 3600))
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            _, uid, kind, _ = heapq.heappop(self._heap)
+            try:
+                await self.fire(int(uid), kind)
+                self.stats['fired'] += 1
+            except Exception:
+                self.stats['errors'] += 1
+                logging.exception("Subscription event %s failed for %s", kind, uid)
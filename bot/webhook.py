@@ -0,0 +1,55 @@
+import hmac
+import time
+
+from aiohttp import web
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+from .metrics import LatencyStats
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def secret_token_middleware(path: str, secret: str):
+    """aiohttp-middleware: запросы на ``path`` без секрета, выданного Telegram в setWebhook, получают 403."""
+
+    @web.middleware
+    async def middleware(request: web.Request, handler):
+        if request.path == path and not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), secret):
+            return web.Response(status=403)
+        return await handler(request)
+
+    return middleware
+
+
+class UpdateLatency(BaseMiddleware):
+    """Замеры обработки апдейтов, одинаковые для long polling и вебхука.
+
+    ``age_message`` — от даты сообщения в Telegram до начала обработки (в
+    режиме long polling сюда входит задержка getUpdates, точность — секунда),
+    ``handle_<вид>`` — от начала до конца работы хендлеров.
+    """
+
+    def __init__(self, window: int = 500):
+        super().__init__()
+        self.latency = LatencyStats(window)
+
+    @staticmethod
+    def _kind(update) -> str:
+        if update.callback_query:
+            return "callback_query"
+        if update.message:
+            return "message"
+        return "other"
+
+    async def on_pre_process_update(self, update, data: dict):
+        data["_started"] = time.monotonic()
+        if update.message and update.message.date:
+            self.latency.add("age_message", max(0.0, time.time() - update.message.date.timestamp()) * 1000)
+
+    async def on_post_process_update(self, update, result, data: dict):
+        started = data.get("_started")
+        if started is not None:
+            self.latency.add(f"handle_{self._kind(update)}", (time.monotonic() - started) * 1000)
+
+    def summary(self) -> dict:
+        return self.latency.summary()
@@ -0,0 +1,126 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+import uuid
+
+import aiohttp
+
+from .metrics import LatencyStats
+
+API_URL = "https://api.yookassa.ru/v3"
+# Ключ идемпотентности ЮKassa действует сутки.
+KEY_TTL = 86400
+# Ответы, после которых запрос повторяется с тем же ключом.
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+LATENCY_WINDOW = 500
+
+
+def new_operation(kind: str) -> str:
+    """Новый id операции (``op``) для одного действия пользователя."""
+    return f"{kind}:{uuid.uuid4().hex}"
+
+
+class YooKassaClient:
+    """Асинхронный клиент API ЮKassa на одной keep-alive сессии aiohttp.
+
+    Соединения переиспользуются между запросами (не больше ``limit``
+    одновременно), каждый запрос ограничен ``timeout`` секундами. Сетевые
+    ошибки, 429 и 5xx повторяются до ``retries`` раз с нарастающей паузой.
+    Для создающих запросов ключ идемпотентности хранится в таблице
+    ``idempotence_keys`` по id операции (``op``), пока на неё не пришёл
+    окончательный ответ: повтор того же действия уходит с тем же ключом и
+    не создаёт второй платёж или выплату. ``op`` выдаёт ``new_operation``
+    один раз на действие пользователя, поэтому такое же действие позже
+    получает новый ключ. Время ответов копится по видам запросов в
+    ``latency``.
+    """
+
+    def __init__(self, path: str, timeout: float = 15.0, retries: int = 3, limit: int = 10):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS idempotence_keys ("
+            "op TEXT PRIMARY KEY, key TEXT NOT NULL, created_at INTEGER NOT NULL, result TEXT)"
+        )
+        self.conn.commit()
+        self.timeout = timeout
+        self.retries = retries
+        self.limit = limit
+        self.stats = {'requests': 0, 'retries': 0, 'errors': 0}
+        self.latency = LatencyStats(LATENCY_WINDOW)   # по видам запросов
+        self._session = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.limit, keepalive_timeout=60),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+        return self._session
+
+    async def close(self):
+        if self._session and not self._session.closed:
+            await self._session.close()
+
+    def idempotence_key(self, op: str) -> str:
+        """Ключ незавершённой операции ``op`` или новый, если её ещё нет."""
+        now = int(time.time())
+        row = self.conn.execute(
+            "SELECT key, created_at, result FROM idempotence_keys WHERE op = ?", (op,)
+        ).fetchone()
+        if row and row[2] is None and now - row[1] < KEY_TTL:
+            return row[0]
+        key = str(uuid.uuid4())
+        with self.conn:
+            self.conn.execute("DELETE FROM idempotence_keys WHERE created_at < ?", (now - KEY_TTL,))
+            self.conn.execute(
+                "INSERT OR REPLACE INTO idempotence_keys(op, key, created_at, result) VALUES (?, ?, ?, NULL)",
+                (op, key, now),
+            )
+        return key
+
+    def _complete(self, op: str, result: str):
+        with self.conn:
+            self.conn.execute("UPDATE idempotence_keys SET result = ? WHERE op = ?", (result, op))
+
+    def _observe(self, name: str, started: float):
+        self.stats['requests'] += 1
+        self.latency.add(name, (time.perf_counter() - started) * 1000)
+
+    def summary(self) -> dict:
+        """Медиана, 95-й перцентиль и максимум времени ответа (мс) по видам запросов."""
+        return self.latency.summary()
+
+    async def request(self, name: str, method: str, path: str, auth: tuple,
+                      payload: dict | None = None, op: str | None = None) -> tuple[int | None, dict]:
+        """Вызвать API; вернуть (HTTP-статус, JSON) или (None, {'error': ...}) после всех повторов."""
+        headers = {'Idempotence-Key': self.idempotence_key(op)} if op else {}
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self.stats['retries'] += 1
+                await asyncio.sleep(min(2 ** attempt, 10))
+            started = time.perf_counter()
+            try:
+                async with self._get_session().request(
+                    method, API_URL + path, auth=aiohttp.BasicAuth(*auth), json=payload, headers=headers
+                ) as resp:
+                    status = resp.status
+                    body = await resp.text()
+                data = json.loads(body) if body else {}
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                self._observe(name, started)
+                error = repr(e)
+                logging.warning("YooKassa %s attempt %s failed: %s", name, attempt + 1, error)
+                continue
+            self._observe(name, started)
+            if status in RETRY_STATUSES:
+                error = f"HTTP {status}"
+                logging.warning("YooKassa %s attempt %s failed: %s", name, attempt + 1, error)
+                continue
+            if op:
+                self._complete(op, str(data.get('id') or status))
+            return status, data
+        self.stats['errors'] += 1
+        return None, {'error': error}
@@ -0,0 +1,131 @@
+import asyncio
+import ipaddress
+import logging
+import sqlite3
+import time
+
+from aiohttp import web
+
+# Адреса, с которых ЮKassa отправляет уведомления (по документации API).
+YOOKASSA_NETWORKS = tuple(ipaddress.ip_network(n) for n in (
+    "185.71.76.0/27",
+    "185.71.77.0/27",
+    "77.75.153.0/25",
+    "77.75.156.11/32",
+    "77.75.156.35/32",
+    "77.75.154.128/25",
+    "2a02:5180::/32",
+))
+# Сколько помнить обработанные уведомления (ЮKassa повторяет их до суток).
+SEEN_TTL = 7 * 86400
+
+
+class YooKassaWebhook:
+    """HTTP-приёмник уведомлений ЮKassa о платежах и выплатах.
+
+    Принимает ``payment.*`` и ``payout.*`` только с адресов ЮKassa
+    (``networks``; за обратным прокси адрес берётся из ``X-Forwarded-For``,
+    если ``trust_proxy``). Повторы одного события отсекаются по ключу
+    ``событие:id``: пока уведомление обрабатывается, ключ держится в памяти,
+    а в таблицу ``webhook_events`` пишется только после успешной обработки,
+    так что после сбоя повтор от ЮKassa обработается заново. Телу
+    уведомления не верим: id передаётся в ``poller.resolve``, который
+    запрашивает статус у API и завершает платёж теми же обработчиками,
+    что и опрос. Если в опросе
+    такого id нет (например, он уже снят по таймауту), запись ищется в
+    ``pending_payments`` и возвращается в опрос (``poller.revive``).
+    """
+
+    def __init__(self, poller, db_path: str, path: str = "/yookassa/webhook",
+                 trust_proxy: bool = False, networks=YOOKASSA_NETWORKS):
+        self.poller = poller
+        self.path = path
+        self.trust_proxy = trust_proxy
+        self.networks = networks
+        self.stats = {'received': 0, 'rejected': 0, 'duplicates': 0, 'unknown': 0}
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS webhook_events (key TEXT PRIMARY KEY, received_at INTEGER NOT NULL)"
+        )
+        self.conn.commit()
+        self._runner = None
+        self._inflight = set()
+
+    def allowed(self, request: web.Request) -> bool:
+        remote = request.remote
+        if self.trust_proxy and request.headers.get('X-Forwarded-For'):
+            remote = request.headers['X-Forwarded-For'].split(',')[0].strip()
+        try:
+            ip = ipaddress.ip_address(remote)
+        except ValueError:
+            return False
+        return any(ip in net for net in self.networks)
+
+    def _seen(self, key: str) -> bool:
+        if key in self._inflight:
+            return True
+        now = int(time.time())
+        with self.conn:
+            self.conn.execute("DELETE FROM webhook_events WHERE received_at < ?", (now - SEEN_TTL,))
+            row = self.conn.execute("SELECT 1 FROM webhook_events WHERE key = ?", (key,)).fetchone()
+        return row is not None
+
+    def _remember(self, key: str):
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR IGNORE INTO webhook_events(key, received_at) VALUES (?, ?)",
+                (key, int(time.time())),
+            )
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if not self.allowed(request):
+            self.stats['rejected'] += 1
+            logging.warning("YooKassa webhook from unexpected address %s", request.remote)
+            return web.Response(status=403)
+        try:
+            data = await request.json()
+            event = data['event']
+            obj_id = data['object']['id']
+        except (ValueError, KeyError, TypeError):
+            self.stats['rejected'] += 1
+            return web.Response(status=400)
+        self.stats['received'] += 1
+        if not event.startswith(('payment.', 'payout.')):
+            return web.Response(status=200)
+        key = f"{event}:{obj_id}"
+        if self._seen(key):
+            self.stats['duplicates'] += 1
+            return web.Response(status=200)
+        self._inflight.add(key)
+        # Отвечаем сразу: проверка статуса может занять время, а ЮKassa ждёт 200.
+        asyncio.create_task(self._resolve(event, obj_id))
+        return web.Response(status=200)
+
+    async def _resolve(self, event: str, obj_id: str):
+        key = f"{event}:{obj_id}"
+        try:
+            if not await self.poller.resolve(obj_id) and not await self.poller.revive(obj_id):
+                self.stats['unknown'] += 1
+                logging.info("YooKassa %s for unknown object %s", event, obj_id)
+            self._remember(key)
+        except Exception:
+            logging.exception("Failed to handle YooKassa %s for %s", event, obj_id)
+        finally:
+            self._inflight.discard(key)
+
+    def setup(self, app: web.Application):
+        """Повесить приёмник на уже работающее приложение (например, вебхук бота)."""
+        app.router.add_post(self.path, self.handle)
+
+    async def start(self, host: str, port: int):
+        app = web.Application()
+        self.setup(app)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        logging.info("YooKassa webhook listening on %s:%s%s", host, port, self.path)
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
@@ -3,12 +3,15 @@ import asyncio
 import logging
 import json
 import os
+import time
+import gc
+import secrets
 from dotenv import load_dotenv
 load_dotenv()
 import html
 import csv
-import copy
 from datetime import datetime, timedelta
+from aiohttp import web
 from aiogram import Bot, Dispatcher, types
 from aiogram.utils import executor
 from aiogram.contrib.fsm_storage.memory import MemoryStorage
@@ -26,10 +29,8 @@ from telethon.errors import (
     PasswordHashInvalidError,      # ← добавить
 )
 
-from yookassa import Payment, Configuration
 from pymorphy3 import MorphAnalyzer
 import snowballstemmer
-import uuid
 from aiogram.utils.exceptions import (
     MessageNotModified,
     MessageToEditNotFound,
@@ -38,7 +39,30 @@ from aiogram.utils.exceptions import (
     ChatNotFound,
     BotBlocked,
 )
-import requests
+
+from bot.models import Result, CSV_HEADER, parser_key, user_from_json, user_to_json, json_default
+from bot.archive import ResultArchive
+from bot.search import LeadIndex
+from bot.backfill import backfill_parser
+from bot.resolver import ChatResolver
+from bot.sessions import SessionStore
+from bot.ingest import IngestQueue
+from bot.fairness import TenantUsage, DigestBuffer, deliver_digest
+from bot.poller import PollScheduler
+from bot.edits import TokenCache
+from bot.api_scheduler import api_call, scheduler_for, release_scheduler, INTERACTIVE, MONITORING, BACKGROUND
+from bot.recovery import chat_key, mark_seen, mark_missed, fetch_missed, latest_message_id, iter_missed
+from bot.billing_engine import plan_daily_debits
+from bot.costs import CostAggregate
+from bot.subscriptions import SubscriptionTimers, SENT_FLAGS
+from bot.prorate import accrue_parser, settle_batch
+from bot.ledger import BillingLedger
+from bot.yookassa_client import YooKassaClient, new_operation
+from bot.payment_poller import PaymentPoller
+from bot.yookassa_webhook import YooKassaWebhook
+from bot.pending import PendingPayments, mark_applied
+from bot.webhook import UpdateLatency, secret_token_middleware
+from bot.callbacks import CallbackRouter, callback_key
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
@@ -50,6 +74,23 @@ if not API_TOKEN:
 bot = Bot(token=API_TOKEN)
 storage = MemoryStorage()
 dp = Dispatcher(bot, storage=storage)
+# Получение апдейтов: polling (getUpdates) или webhook. Для webhook нужен
+# публичный https-адрес WEBHOOK_URL (без пути), бот слушает WEBHOOK_HOST:WEBHOOK_PORT
+# и принимает запросы только с WEBHOOK_SECRET (пусто — случайный на каждый запуск).
+# WEBHOOK_MAX_CONNECTIONS — сколько соединений Telegram держит параллельно.
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+update_latency = UpdateLatency()
+dp.middleware.setup(update_latency)
+# Все inline-кнопки разбирает один маршрутизатор: хендлеры регистрируются
+# через @callbacks.route(префикс, типы аргументов) и получают готовые аргументы.
+callbacks = CallbackRouter()
+callbacks.install(dp)
 
 API_TOKEN2 = os.getenv("API_TOKEN2")
 if API_TOKEN2:
@@ -61,15 +102,31 @@ else:
 # ЮKassa configuration
 YOOKASSA_SHOP_ID = os.getenv("YOOKASSA_SHOP_ID")
 YOOKASSA_TOKEN = os.getenv("YOOKASSA_TOKEN")
-if YOOKASSA_SHOP_ID and YOOKASSA_TOKEN:
-    Configuration.account_id = YOOKASSA_SHOP_ID
-    Configuration.secret_key = YOOKASSA_TOKEN
-else:
+if not (YOOKASSA_SHOP_ID and YOOKASSA_TOKEN):
     logging.warning("YOOKASSA credentials are missing; payment features may not work")
+# Запросы к API ЮKassa: таймаут (сек) и число повторов при сбоях сети, 429 и 5xx.
+YOOKASSA_TIMEOUT = float(os.getenv("YOOKASSA_TIMEOUT", "15"))
+YOOKASSA_RETRIES = int(os.getenv("YOOKASSA_RETRIES", "3"))
+# Опрос статусов платежей и выплат: первая пауза и потолок паузы (сек),
+# сколько ждать окончательного статуса и сколько записей проверять за проход.
+PAYMENT_POLL_FIRST = float(os.getenv("PAYMENT_POLL_FIRST", "3"))
+PAYMENT_POLL_MAX = float(os.getenv("PAYMENT_POLL_MAX", "60"))
+PAYMENT_POLL_TTL = int(os.getenv("PAYMENT_POLL_TTL", "3600"))
+PAYMENT_POLL_BATCH = int(os.getenv("PAYMENT_POLL_BATCH", "20"))
+# Приём HTTP-уведомлений ЮKassa. Порт 0 — выключено, статусы узнаём только
+# опросом; иначе опрос остаётся запасным и начинается с PAYMENT_POLL_MAX.
+# YOOKASSA_WEBHOOK_TRUST_PROXY=1 — брать адрес отправителя из X-Forwarded-For.
+YOOKASSA_WEBHOOK_PORT = int(os.getenv("YOOKASSA_WEBHOOK_PORT", "0"))
+YOOKASSA_WEBHOOK_HOST = os.getenv("YOOKASSA_WEBHOOK_HOST", "0.0.0.0")
+YOOKASSA_WEBHOOK_PATH = os.getenv("YOOKASSA_WEBHOOK_PATH", "/yookassa/webhook")
+YOOKASSA_WEBHOOK_TRUST_PROXY = os.getenv("YOOKASSA_WEBHOOK_TRUST_PROXY", "0") == "1"
 # ===== New billing constants =====
 PRO_MONTHLY_RUB = 1490.00  # Базовый PRO «за парсер» до 5 чатов
 EXTRA_CHAT_MONTHLY_RUB = 490.00  # За каждый чат сверх 5
 DAYS_IN_MONTH = 30
+# daily — списание раз в сутки в 03:00 UTC; prorated — почасово за фактические
+# минуты работы парсеров (отметки ставят pause_parser/resume_parser).
+BILLING_MODE = os.getenv("BILLING_MODE", "daily")
 
 
 PAYOUT_SHOP_ID = os.getenv("PAYOUT_SHOP_ID")
@@ -81,10 +138,7 @@ PAYOUT_RETURN_URL = os.getenv("PAYOUT_CALLBACK_RETURN_URL", "")
 def _normalize_rub(amount: float) -> str:
     return f"{float(amount):.2f}"
 
-def _generate_idempotence_key() -> str:
-    return str(uuid.uuid4())
-
-def create_yookassa_payout(user_id: int, amount_rub: float, description: str, method: str, destination: str) -> tuple[str | None, dict | None]:
+async def create_yookassa_payout(user_id: int, amount_rub: float, description: str, method: str, destination: str, op: str | None = None) -> tuple[str | None, dict | None]:
     """
     Создать выплату через ЮKassa Payouts API.
 
@@ -129,11 +183,6 @@ def create_yookassa_payout(user_id: int, amount_rub: float, description: str, me
     else:
         return None, {"error": "unsupported_method"}
 
-    url = "https://api.yookassa.ru/payouts"  # базовая точка для выплат
-    headers = {
-        "Idempotence-Key": _generate_idempotence_key(),
-        "Content-Type": "application/json",
-    }
     payload = {
         "amount": {"value": _normalize_rub(amount_rub), "currency": "RUB"},
         "payout_destination_data": payout_destination,
@@ -144,58 +193,50 @@ def create_yookassa_payout(user_id: int, amount_rub: float, description: str, me
     if PAYOUT_RETURN_URL:
         payload["receipt_data"] = {"service_name": "Partner withdrawal", "url": PAYOUT_RETURN_URL}
 
-    try:
-        resp = requests.post(url, auth=(PAYOUT_SHOP_ID, PAYOUT_SECRET_KEY), headers=headers, json=payload, timeout=30)
-        data = resp.json() if resp.content else {}
-        if 200 <= resp.status_code < 300:
-            payout_id = data.get("id")
-            return payout_id, data
-        logging.error("Payout create failed: %s %s", resp.status_code, data)
-        return None, data
-    except Exception as e:
-        logging.exception("Payout create exception")
-        return None, {"error": str(e)}
+    # Повтор того же вывода (op из FSM) уходит с прежним ключом
+    # идемпотентности — ЮKassa не создаст вторую выплату.
+    status, data = await payment_client.request(
+        "payout_create", "POST", "/payouts", (PAYOUT_SHOP_ID, PAYOUT_SECRET_KEY), payload,
+        op=op or new_operation("payout"),
+    )
+    if status and 200 <= status < 300:
+        return data.get("id"), data
+    logging.error("Payout create failed: %s %s", status, data)
+    return None, data
 
 
-def get_payout_status(payout_id: str) -> str | None:
+async def get_payout_status(payout_id: str) -> str | None:
     """Запросить статус выплаты."""
     if not (PAYOUT_SHOP_ID and PAYOUT_SECRET_KEY):
         return None
-    url = f"https://api.yookassa.ru/payouts/{payout_id}"
-    try:
-        resp = requests.get(url, auth=(PAYOUT_SHOP_ID, PAYOUT_SECRET_KEY), timeout=20)
-        data = resp.json() if resp.content else {}
-        if 200 <= resp.status_code < 300:
-            return data.get("status")
-        logging.error("Payout status failed: %s %s", resp.status_code, data)
-        return None
-    except Exception:
-        logging.exception("Payout status exception")
-        return None
+    status, data = await payment_client.request(
+        "payout_status", "GET", f"/payouts/{payout_id}", (PAYOUT_SHOP_ID, PAYOUT_SECRET_KEY)
+    )
+    if status and 200 <= status < 300:
+        return data.get("status")
+    logging.error("Payout status failed: %s %s", status, data)
+    return None
 
 
-async def wait_payout_and_finalize(user_id: int, payout_id: str, amount: float):
+async def finish_payout(entry: dict, status: str):
     """
-    Периодически проверяет статус выплаты.
+    Завершение выплаты (вызывает payment_poller).
     При succeeded — списывает с партнёрского баланса и уведомляет.
     При canceled/failed — сообщает пользователю.
     """
-    for _ in range(60):  # до 5 минут с шагом 5 сек
-        status = get_payout_status(payout_id)
-        if status == "succeeded":
-            data = get_user_data_entry(user_id)
+    user_id, amount = entry['user_id'], entry['amount']
+    if status == "succeeded":
+        data = get_user_data_entry(user_id)
+        # Списываем, только если эту выплату ещё не списали (повтор после рестарта).
+        if mark_applied(data, entry['id']):
             ref_bal = float(data.get('ref_balance', 0))
-            # безопасно: списываем, если ещё не списали
-            new_bal = max(0.0, ref_bal - amount)
-            data['ref_balance'] = _round2(new_bal)
+            data['ref_balance'] = _round2(max(0.0, ref_bal - amount))
             save_user_data(user_data)
-            await safe_send_message(bot, user_id, f"✅ Вывод {amount:.2f} ₽ выполнен успешно.")
-            return
-        if status in ("canceled", "canceled_by_yoo", "failed"):
-            await safe_send_message(bot, user_id, f"❌ Вывод отклонён ({status}). Средства на счёте не списаны.")
-            return
-        await asyncio.sleep(5)
-    await safe_send_message(bot, user_id, "⚠️ Не удалось подтвердить статус выплаты вовремя. Проверьте позже командой /menu → профиль.")
+        await safe_send_message(bot, user_id, f"✅ Вывод {amount:.2f} ₽ выполнен успешно.")
+    elif status == "timeout":
+        await safe_send_message(bot, user_id, "⚠️ Не удалось подтвердить статус выплаты вовремя. Проверьте позже командой /menu → профиль.")
+    else:
+        await safe_send_message(bot, user_id, f"❌ Вывод отклонён ({status}). Средства на счёте не списаны.")
 
 
 async def safe_send_message(
@@ -311,14 +352,19 @@ def calc_parser_daily_cost(parser: dict) -> float:
     return _round2(base + extras)
 
 
+def _parser_cost(parser: dict) -> float:
+    return parser.get('daily_price') or calc_parser_daily_cost(parser)
+
+
+def track_active_time(parser: dict):
+    """Отметить смену статуса или цены парсера для почасового режима биллинга."""
+    if BILLING_MODE == 'prorated':
+        accrue_parser(parser, _parser_cost)
+
+
 def total_daily_cost(user_id: int) -> float:
-    """Сумма в сутки по всем активным парсерам пользователя."""
-    data = user_data.get(str(user_id), {})
-    total = 0.0
-    for p in data.get('parsers', []):
-        if p.get('status', 'paused') == 'active':
-            total += p.get('daily_price') or calc_parser_daily_cost(p)
-    return _round2(total)
+    """Сумма в сутки по всем активным парсерам пользователя (из ``cost_aggregate``)."""
+    return cost_aggregate.total(user_id)
 
 
 def predict_block_date(user_id: int) -> tuple[str, int]:
@@ -335,6 +381,13 @@ def predict_block_date(user_id: int) -> tuple[str, int]:
         return dt, days
     bal = float(data.get('balance', 0))
     per_day = total_daily_cost(user_id)
+    # Прогноз зависит только от баланса, стоимости и даты — по ним и кэшируем.
+    return cost_aggregate.block_date(
+        user_id, (bal, per_day, datetime.utcnow().date()), lambda: _block_date(bal, per_day),
+    )
+
+
+def _block_date(bal: float, per_day: float) -> tuple[str, int]:
     if per_day <= 0 or bal <= 0:
         return "—", 0
     days = int(bal // per_day)
@@ -343,9 +396,6 @@ def predict_block_date(user_id: int) -> tuple[str, int]:
 
 
 RETURN_URL = "https://t.me/TOPGrabber_bot"
-if YOOKASSA_SHOP_ID and YOOKASSA_TOKEN:
-    Configuration.account_id = YOOKASSA_SHOP_ID
-    Configuration.secret_key = YOOKASSA_TOKEN
 
 # Хранилище Telethon-клиентов и данных по пользователям
 user_clients = {}  # runtime data: {user_id: {"client": TelegramClient,
@@ -356,6 +406,54 @@ user_clients = {}  # runtime data: {user_id: {"client": TelegramClient,
 DATA_FILE = "user_data.json"
 TEXT_FILE = "texts.json"
 
+# Хранение результатов: в памяти держим последние N штук не старше D дней,
+# остальное уходит в сжатый архив на диске.
+RESULTS_HOT_LIMIT = int(os.getenv("RESULTS_HOT_LIMIT", "1000"))
+RESULTS_HOT_DAYS = int(os.getenv("RESULTS_HOT_DAYS", "30"))
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")
+result_archive = ResultArchive(ARCHIVE_DIR, RESULTS_HOT_LIMIT, RESULTS_HOT_DAYS)
+
+# Общая SQLite-база для служебных таблиц (поисковый индекс и т.д.)
+DB_FILE = os.getenv("DB_FILE", "topgrabber.db")
+SEARCH_PAGE_SIZE = 5
+LEADS_PAGE_SIZE = 5
+
+# Сканирование истории чатов после создания парсера или смены чатов:
+# не более N сообщений и не старше D дней на чат, K чатов параллельно.
+BACKFILL_LIMIT = int(os.getenv("BACKFILL_LIMIT", "500"))
+BACKFILL_DAYS = int(os.getenv("BACKFILL_DAYS", "3"))
+BACKFILL_CONCURRENCY = int(os.getenv("BACKFILL_CONCURRENCY", "2"))
+
+# Догон пропущенных сообщений после рестарта/переподключения.
+GAP_MAX_MESSAGES = int(os.getenv("GAP_MAX_MESSAGES", "2000"))
+GAP_CHECK_INTERVAL = int(os.getenv("GAP_CHECK_INTERVAL", "30"))
+SESSION_FLUSH_INTERVAL = int(os.getenv("SESSION_FLUSH_INTERVAL", "600"))
+# Клиенты без активных парсеров отключаются после N секунд простоя.
+HIBERNATE_AFTER = int(os.getenv("HIBERNATE_AFTER", "900"))
+
+# Очередь между обработчиком Telethon и матчингом: размер, число воркеров
+# и политика переполнения (drop_oldest / coalesce / block).
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "5000"))
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "8"))
+INGEST_POLICY = os.getenv("INGEST_POLICY", "drop_oldest")
+# Чат, приславший больше N сообщений за минуту, первым теряет сообщения.
+INGEST_FLOOD_RATE = int(os.getenv("INGEST_FLOOD_RATE", "300"))
+# Бюджеты пользователя в минуту: секунды CPU на матчинг и число совпадений.
+# Сверх CPU-бюджета сообщения пользователя обрабатываются с меньшим весом,
+# сверх бюджета совпадений уведомления приходят сводкой раз в DIGEST_INTERVAL.
+TENANT_CPU_BUDGET = float(os.getenv("TENANT_CPU_BUDGET", "2.0"))
+TENANT_MATCH_BUDGET = int(os.getenv("TENANT_MATCH_BUDGET", "30"))
+DIGEST_INTERVAL = int(os.getenv("DIGEST_INTERVAL", "60"))
+# Режим опроса (parser['mode'] == 'poll'): период по умолчанию, максимум
+# сообщений на чат за один опрос и число одновременно опрашиваемых парсеров.
+POLL_INTERVAL = int(os.getenv("POLL_INTERVAL", "600"))
+POLL_MAX_MESSAGES = int(os.getenv("POLL_MAX_MESSAGES", "1000"))
+POLL_CONCURRENCY = int(os.getenv("POLL_CONCURRENCY", "2"))
+# Сколько помнить слова недавних сообщений для разбора правок (секунды и
+# сообщений на чат парсера).
+EDIT_CACHE_TTL = int(os.getenv("EDIT_CACHE_TTL", "3600"))
+EDIT_CACHE_PER_CHAT = int(os.getenv("EDIT_CACHE_PER_CHAT", "500"))
+
 with open(TEXT_FILE, "r", encoding="utf-8") as f:
     TEXTS = json.load(f)
 
@@ -375,6 +473,20 @@ def normalize_word(word: str) -> str:
     return stemmer_en.stemWord(word)
 
 
+lead_index = LeadIndex(DB_FILE, normalize_word)
+chat_resolver = ChatResolver(DB_FILE)
+billing_ledger = BillingLedger(DB_FILE)
+payment_client = YooKassaClient(DB_FILE, YOOKASSA_TIMEOUT, YOOKASSA_RETRIES)
+# Ожидающие платежи и выплаты переживают рестарт: опрос поднимает их при старте.
+pending_payments = PendingPayments(DB_FILE)
+
+# Сессии Telethon хранятся в DB_FILE; старые файлы session_<id>.session
+# переносятся туда при первом запуске.
+session_store = SessionStore(DB_FILE)
+session_store.migrate_files()
+session_store.load_all()
+
+
 def t(key, **kwargs):
     text = TEXTS.get(key, key)
     if kwargs:
@@ -390,24 +502,9 @@ def load_user_data():
         try:
             with open(DATA_FILE, "r", encoding="utf-8") as f:
                 data = json.load(f)
+            data = {uid: user_from_json(u, CHAT_LIMIT) for uid, u in data.items()}
             for u in data.values():
-                u.setdefault('subscription_expiry', 0)
-                u.setdefault('recurring', False)
-                u.setdefault('reminder3_sent', False)
-                u.setdefault('reminder1_sent', False)
-                u.setdefault('inactive_notified', False)
-                u.setdefault('used_promos', [])
-                u.setdefault('chat_limit', CHAT_LIMIT)
-                u.setdefault('balance', 0.0)  # новый кошелёк пользователя
-                u.setdefault('billing_enabled', True)  # флаг на будущее
-                # Старые поля подписки можно оставить — они не будут использоваться
                 for p in u.get('parsers', []):
-                    p.setdefault('results', [])
-                    p.setdefault('name', 'Без названия')
-                    p.setdefault('api_id', '')
-                    p.setdefault('api_hash', '')
-                    p.setdefault('status', 'paused')  # 'active' | 'paused'
-                    p.setdefault('daily_price', 0.0)  # кэш рассчётной цены/сутки
                     # Актуализируем daily_price, если уже известны чаты
                     if not p.get('daily_price'):
                         p['daily_price'] = calc_parser_daily_cost(p)
@@ -419,18 +516,16 @@ def load_user_data():
 
 def save_user_data(data):
     try:
-        data_copy = copy.deepcopy(data)
-        for u in data_copy.values():
-            for p in u.get('parsers', []):
-                p.pop('handler', None)
-                p.pop('event', None)
+        data_copy = {uid: user_to_json(u) for uid, u in data.items()}
         with open(DATA_FILE, "w", encoding="utf-8") as f:
-            json.dump(data_copy, f, ensure_ascii=False, indent=2)
+            json.dump(data_copy, f, ensure_ascii=False, indent=2, default=json_default)
     except Exception:
         logging.exception("Failed to save user data")
 
 
 user_data = load_user_data()  # persistent data: {str(user_id): {...}}
+# Суточная стоимость по пользователям; обновляется при смене статуса или чатов парсера.
+cost_aggregate = CostAggregate(user_data, _parser_cost)
 
 
 def get_user_data_entry(user_id: int):
@@ -440,7 +535,7 @@ def get_user_data_entry(user_id: int):
     return data
 
 
-def create_payment(user_id: int, amount: str, description: str, user_email:str = None, user_phone: str = None):
+async def create_payment(user_id: int, amount: str, description: str, user_email:str = None, user_phone: str = None, op: str | None = None):
     if not (YOOKASSA_SHOP_ID and YOOKASSA_TOKEN):
         return None, None
     try:
@@ -474,7 +569,8 @@ def create_payment(user_id: int, amount: str, description: str, user_email:str =
         else:
             receipt["customer"]["phone"] = "+79777207868"
 
-        payment = Payment.create(
+        status, data = await payment_client.request(
+            "payment_create", "POST", "/payments", (YOOKASSA_SHOP_ID, YOOKASSA_TOKEN),
             {
                 "amount": {"value": amount, "currency": "RUB"},
                 "confirmation": {"type": "redirect", "return_url": RETURN_URL},
@@ -482,71 +578,115 @@ def create_payment(user_id: int, amount: str, description: str, user_email:str =
                 "capture": True,
                 "receipt": receipt,
             },
-            str(uuid.uuid4()),
+            op=op or new_operation("payment"),
         )
-        return payment.id, payment.confirmation.confirmation_url
+        if status and 200 <= status < 300:
+            return data["id"], data["confirmation"]["confirmation_url"]
+        logging.error("Payment create failed: %s %s", status, data)
     except Exception:
         logging.exception("Failed to create payment")
     return None, None
 
 
-def create_topup_payment(user_id: int, amount_rub: float):
+async def create_topup_payment(user_id: int, amount_rub: float, op: str | None = None):
     amount = f"{amount_rub:.2f}"
-    return create_payment(user_id, amount, f"Пополнение баланса {user_id} на {amount} ₽")
+    return await create_payment(user_id, amount, f"Пополнение баланса {user_id} на {amount} ₽", op=op)
 
 
-async def wait_topup_and_credit(user_id: int, payment_id: str, amount: float):
-    for _ in range(60):
-        status = check_payment(payment_id)
-        if status == 'succeeded':
-            data = get_user_data_entry(user_id)
-            data['balance'] = _round2(float(data.get('balance', 0)) + amount)
-            data.pop('payment_id', None)
-            save_user_data(user_data)
-            await safe_send_message(bot, user_id, f"✅ Оплата прошла. Баланс пополнен на {amount:.2f} ₽.")
-            return
-        if status in ('canceled', 'expired'):
-            data = get_user_data_entry(user_id)
-            data.pop('payment_id', None)
-            save_user_data(user_data)
-            await safe_send_message(bot, user_id, t('payment_failed', status=status))
-            return
-        await asyncio.sleep(5)
-    await safe_send_message(bot, user_id, t('payment_failed', status='timeout'))
+def _clear_payment_id(data: dict, payment_id: str):
+    # Не трогаем payment_id, если пользователь уже начал новый платёж.
+    if data.get('payment_id') == payment_id:
+        data.pop('payment_id', None)
+
 
-def create_pro_payment(user_id: int):
-    return create_payment(user_id, f"{PRO_MONTHLY_RUB:.2f}", f"Подписка PRO для пользователя {user_id}")
+async def finish_topup(entry: dict, status: str):
+    user_id, amount = entry['user_id'], entry['amount']
+    if status == 'timeout':
+        await safe_send_message(bot, user_id, t('payment_pending'))
+        return
+    data = get_user_data_entry(user_id)
+    _clear_payment_id(data, entry['id'])
+    if status == 'succeeded' and mark_applied(data, entry['id']):
+        data['balance'] = _round2(float(data.get('balance', 0)) + amount)
+    save_user_data(user_data)
+    if status == 'succeeded':
+        await safe_send_message(bot, user_id, f"✅ Оплата прошла. Баланс пополнен на {amount:.2f} ₽.")
+    elif not entry.get('timed_out'):
+        # После таймаута пользователь уже получил сообщение о неподтверждённой оплате.
+        await safe_send_message(bot, user_id, t('payment_failed', status=status))
 
+async def create_pro_payment(user_id: int, op: str | None = None):
+    return await create_payment(user_id, f"{PRO_MONTHLY_RUB:.2f}", f"Подписка PRO для пользователя {user_id}", op=op)
 
-def check_payment(payment_id: str):
-    try:
-        payment = Payment.find_one(payment_id)
-        return payment.status
-    except Exception:
-        logging.exception("Failed to check payment")
+
+async def action_op(state: FSMContext, kind: str) -> str:
+    """Id операции текущего действия пользователя, хранящийся в FSM.
+
+    Первый вызов выдаёт новый id, повторы (двойное нажатие, повторная
+    отправка до ``state.finish()``) получают тот же, и ЮKassa вернёт уже
+    созданный объект. После ``state.finish()`` следующее действие получит
+    новый id.
+    """
+    data = await state.get_data()
+    op = data.get('op')
+    if not op:
+        op = new_operation(kind)
+        await state.update_data(op=op)
+    return op
+
+
+async def check_payment(payment_id: str):
+    if not (YOOKASSA_SHOP_ID and YOOKASSA_TOKEN):
+        return None
+    status, data = await payment_client.request(
+        "payment_status", "GET", f"/payments/{payment_id}", (YOOKASSA_SHOP_ID, YOOKASSA_TOKEN)
+    )
+    if status and 200 <= status < 300:
+        return data.get("status")
+    logging.error("Payment status failed: %s %s", status, data)
     return None
 
 
-async def wait_payment_and_activate(user_id: int, payment_id: str, chats: int):
-    for _ in range(60):
-        status = check_payment(payment_id)
-        if status == 'succeeded':
-            data = get_user_data_entry(user_id)
-            expiry = int((datetime.utcnow() + timedelta(days=30)).timestamp())
-            data['subscription_expiry'] = expiry
-            data['chat_limit'] = chats
-            data.pop('payment_id', None)
-            save_user_data(user_data)
-            await safe_send_message(bot, user_id, t('payment_success'))
-            return
-        if status in ('canceled', 'expired'):
-            data = get_user_data_entry(user_id)
-            data.pop('payment_id', None)
-            save_user_data(user_data)
-            await safe_send_message(bot, user_id, t('payment_failed', status=status))
-            return
-        await asyncio.sleep(5)
-    await safe_send_message(bot, user_id, t('payment_failed', status='timeout'))
+async def finish_pro_payment(entry: dict, status: str):
+    user_id = entry['user_id']
+    if status == 'timeout':
+        await safe_send_message(bot, user_id, t('payment_pending'))
+        return
+    data = get_user_data_entry(user_id)
+    _clear_payment_id(data, entry['id'])
+    if status == 'succeeded' and mark_applied(data, entry['id']):
+        expiry = int((datetime.utcnow() + timedelta(days=30)).timestamp())
+        data['subscription_expiry'] = expiry
+        data['chat_limit'] = entry['chats']
+        subscription_changed(user_id)
+    save_user_data(user_data)
+    if status == 'succeeded':
+        await safe_send_message(bot, user_id, t('payment_success'))
+    elif not entry.get('timed_out'):
+        # После таймаута пользователь уже получил сообщение о неподтверждённой оплате.
+        await safe_send_message(bot, user_id, t('payment_failed', status=status))
+
+
+# Один опрос статусов на все ожидающие платежи и выплаты вместо задачи на каждый.
+payment_poller = PaymentPoller(
+    PAYMENT_POLL_BATCH,
+    first=PAYMENT_POLL_MAX if YOOKASSA_WEBHOOK_PORT else PAYMENT_POLL_FIRST,
+    longest=PAYMENT_POLL_MAX,
+    ttl=PAYMENT_POLL_TTL,
+    store=pending_payments,
+)
+payment_poller.register('topup', check_payment, finish_topup)
+payment_poller.register('pro', check_payment, finish_pro_payment)
+payment_poller.register('expand', check_payment, finish_pro_payment)
+payment_poller.register('payout', get_payout_status, finish_payout)
+yookassa_webhook = YooKassaWebhook(payment_poller, DB_FILE, YOOKASSA_WEBHOOK_PATH, YOOKASSA_WEBHOOK_TRUST_PROXY)
+
+
+async def reconcile_pending_payments():
+    """Сверить платежи, которые ждали подтверждения до рестарта."""
+    stats = await payment_poller.restore()
+    if stats['restored']:
+        logging.info("Pending payments reconciled: %s", stats)
 
 def check_subscription(user_id: int):
     data = get_user_data_entry(user_id)
@@ -572,6 +712,41 @@ def check_subscription(user_id: int):
             save_user_data(user_data)
 
 
+async def subscription_event(user_id: int, kind: str):
+    """Событие подписки из ``subscription_timers``: напоминание или окончание."""
+    data = user_data.get(str(user_id))
+    if not data:
+        return
+    exp = data.get('subscription_expiry', 0)
+    now = int(datetime.utcnow().timestamp())
+    if kind == 'expiry':
+        if not exp or exp > now or data.get('inactive_notified'):
+            return
+        asyncio.create_task(send_all_results(user_id))
+        await safe_send_message(bot, user_id, t('subscription_inactive'))
+        data['inactive_notified'] = True
+    else:
+        days = 3 if kind == 'reminder3' else 1
+        flag = f'reminder{days}_sent'
+        # Опоздавшее напоминание (бот был выключен) не шлём, если уже пора следующее.
+        if data.get('recurring') or data.get(flag) or exp - now <= (days - 1) * 86400:
+            return
+        await safe_send_message(bot, user_id, t('subscription_reminder', days=days))
+        data[flag] = True
+    save_user_data(user_data)
+
+
+subscription_timers = SubscriptionTimers(subscription_event)
+
+
+def subscription_changed(user_id: int):
+    """Новый срок подписки: сбросить отметки напоминаний и поставить события."""
+    data = get_user_data_entry(user_id)
+    for flag in SENT_FLAGS.values():
+        data[flag] = False
+    subscription_timers.schedule(user_id, data.get('subscription_expiry', 0))
+
+
 # Текст для информационного сообщения
 INFO_TEXT = (
     "TopGrabber – это сервис для автоматического поиска потенциальных клиентов"
@@ -595,6 +770,180 @@ HELP_TEXT = (
 )
 
 
+# Отметки last_seen меняются на каждом сообщении; на диск их сбрасывает
+# connection_watchdog, а не каждый обработчик.
+_last_seen_dirty = False
+gap_stats = {'runs': 0, 'fetched': 0, 'recovered': 0}
+# Учёт нагрузки по пользователям: тяжёлые получают меньшую долю воркеров
+# очереди и уведомления сводкой, а не замедляют всех остальных.
+tenant_usage = TenantUsage(TENANT_CPU_BUDGET, TENANT_MATCH_BUDGET)
+digest_buffer = DigestBuffer()
+token_cache = TokenCache(EDIT_CACHE_TTL, EDIT_CACHE_PER_CHAT)
+ingest_queue = IngestQueue(
+    INGEST_QUEUE_SIZE, INGEST_WORKERS, INGEST_POLICY, INGEST_FLOOD_RATE, weight=tenant_usage.weight,
+)
+
+
+def message_words(text: str) -> list:
+    return [normalize_word(w) for w in re.findall(r'\w+', text.lower())]
+
+
+def match_keywords(words: list, keywords: list, exclude: list) -> str | None:
+    """Первое ключевое слово парсера среди нормализованных слов сообщения."""
+    if any(e in words for e in exclude):
+        return None
+    for kw in keywords:
+        if normalize_word(kw) in words:
+            return kw
+    return None
+
+
+def build_result(kw: str, chat, sender, message) -> Result:
+    title = getattr(chat, 'title', str(message.chat_id))
+    username = getattr(sender, 'username', None)
+    sender_name = f"@{username}" if username else getattr(sender, 'first_name', 'Unknown')
+    link = 'Ссылка недоступна'
+    chat_username = getattr(chat, 'username', None)
+    if chat_username:
+        link = f"https://t.me/{chat_username}/{message.id}"
+    return Result(
+        kw, title, sender_name, message.date.strftime('%Y-%m-%d %H:%M:%S'),
+        link, message.raw_text or '', message.chat_id, message.id,
+    )
+
+
+def store_result(user_id: int, parser: dict, result: Result, words: list, save: bool = True):
+    """Сохранить найденное сообщение: горячий список, поисковый индекс, архив."""
+    # Только в конец: номер archived + i — курсор листания лидов, и вставка
+    # сообщения из истории в середину сдвинула бы все записи после него.
+    parser.setdefault('results', []).append(result)
+    lead_index.add(user_id, parser, result, words)
+    result_archive.enforce(parser)
+    if save:
+        save_user_data(user_data)
+
+
+def is_stored(parser: dict, result: Result, depth: int = 200) -> bool:
+    """Есть ли это сообщение среди последних сохранённых результатов."""
+    ident = result.ident
+    if not ident:
+        return False
+    results = parser.get('results') or []
+    return any(r.ident == ident for r in results[-depth:])
+
+
+async def notify_result(user_id: int, result: Result):
+    preview = html.escape(result.text[:400])
+    message_text = (
+        f"🔔 Найдено '{html.escape(result.keyword)}' в чате '{html.escape(result.chat)}'\n"
+        f"Username: {html.escape(result.sender)}\n"
+        f"DateTime: {result.datetime}\n"
+        f"Link: {html.escape(result.link)}\n"
+        f"<pre>{preview}</pre>"
+    )
+    if not bot2 or await safe_send_message(bot2, user_id, message_text, parse_mode="HTML") is None:
+        await safe_send_message(
+            bot,
+            user_id,
+            "Пожалуйста, начните чат с ботом уведомлений сначала: https://t.me/topgraber_yved_bot"
+        )
+
+
+async def process_message(
+    client,
+    user_id: int,
+    parser: dict,
+    message,
+    keywords: list,
+    exclude: list,
+    notify: bool = True,
+    save: bool = True,
+    priority: int = MONITORING,
+    edited: bool = False,
+) -> Result | None:
+    """Общий конвейер для живых, пропущенных и исторических сообщений.
+
+    Матчинг, дедупликация по id сообщения, сохранение и (если ``notify``)
+    уведомление. Для правок (``edited``) ключевые слова ищутся только среди
+    появившихся в тексте слов. Возвращает сохранённый результат или None.
+    """
+    text = message.raw_text or ''
+    scope = (parser_key(parser), message.chat_id)
+    if edited and token_cache.unchanged(scope, message.id, text):
+        return None
+    # Между замерами нет await: process_time — CPU именно этого сообщения.
+    started = time.process_time()
+    words = message_words(text)
+    fresh = token_cache.update(scope, message.id, text, words)
+    if edited:
+        keywords = [k for k in keywords if normalize_word(k) in fresh]
+    kw = match_keywords(words, keywords, exclude) if keywords else None
+    tenant_usage.charge_cpu(user_id, time.process_time() - started)
+    if kw is None:
+        return None
+    # Отправителя запрашиваем только для совпавших сообщений.
+    sender = message.sender or await api_call(client, 'entity', message.get_sender, priority=priority)
+    if getattr(sender, 'bot', False):
+        return None
+    chat = message.chat or await api_call(client, 'entity', message.get_chat, priority=priority)
+    result = build_result(kw, chat, sender, message)
+    if is_stored(parser, result):
+        return None
+    store_result(user_id, parser, result, words, save=save)
+    if notify:
+        tenant_usage.charge_match(user_id)
+        if tenant_usage.over_matches(user_id):
+            digest_buffer.add(user_id, result)
+        else:
+            await notify_result(user_id, result)
+    return result
+
+
+async def mark_after(parser: dict, messages: list, job):
+    """Дождаться обработки ``job`` и только потом сдвинуть ``last_seen``.
+
+    ``last_seen`` — наибольший увиденный id, и параллельные воркеры сдвигают
+    его дальше ещё не обработанных сообщений, поэтому сам по себе пропусков
+    не выдаёт. Сообщение, выброшенное очередью при переполнении,
+    запоминается через ``drop_missed`` и дочитывается ``recover_gaps``.
+    Повторы, склеенные политикой ``coalesce``, не дочитываются намеренно,
+    а сообщения, ждавшие в очереди при падении бота, теряются.
+    """
+    global _last_seen_dirty
+    result = await job if job is not None else None
+    for m in messages:
+        if mark_seen(parser, m):
+            _last_seen_dirty = True
+    return result
+
+
+def drop_missed(parser: dict, messages: list):
+    """``on_drop`` очереди: запомнить выброшенные сообщения для ``recover_gaps``."""
+    global _last_seen_dirty
+    for m in messages:
+        mark_missed(parser, m)
+    _last_seen_dirty = True
+
+
+async def send_digest(user_id: int, results: list):
+    # Как и одиночные уведомления: если бот уведомлений недоступен, шлём основным.
+    await deliver_digest(
+        user_id, results, (bot2, bot),
+        lambda sender, uid, text: safe_send_message(sender, uid, text, parse_mode="HTML"),
+    )
+
+
+async def digest_loop():
+    """Раз в DIGEST_INTERVAL отправлять накопленные сводки и логировать тяжёлых пользователей."""
+    while True:
+        await asyncio.sleep(DIGEST_INTERVAL)
+        heavy = tenant_usage.heavy()
+        if heavy:
+            logging.info("Heavy tenants (user, cpu s/min, matches/min): %s", heavy)
+        for user_id, results in digest_buffer.drain().items():
+            await send_digest(user_id, results)
+
+
 async def start_monitor(user_id: int, parser: dict):
     if parser.get('status', 'paused') != 'active':
         return
@@ -607,60 +956,346 @@ async def start_monitor(user_id: int, parser: dict):
     exclude = [normalize_word(w) for w in parser.get('exclude_keywords', [])]
     if not chat_ids or not keywords:
         return
+    if parser.get('mode') == 'poll':
+        # Опрос по расписанию вместо обработчика: реальное время остаётся
+        # за чатами, которым оно нужно.
+        poll_scheduler.add(user_id, parser, parser.get('poll_interval') or POLL_INTERVAL, delay=0)
+        if not client.is_connected():
+            await client.connect()
+        return
 
     event_builder = events.NewMessage(chats=chat_ids)
 
     async def monitor(event, keywords=keywords, parser=parser):
-        sender = await event.get_sender()
-        if getattr(sender, 'bot', False):
+        message = event.message
+        if message.grouped_id:
+            # Элементы альбома разбирает on_album одним событием.
             return
-        text = event.raw_text or ''
-        words = [normalize_word(w) for w in re.findall(r'\w+', text.lower())]
-        for kw in keywords:
-            if normalize_word(kw) in words and not any(e in words for e in exclude):
-                chat = await event.get_chat()
-                title = getattr(chat, 'title', str(event.chat_id))
-                username = getattr(sender, 'username', None)
-                sender_name = f"@{username}" if username else getattr(sender, 'first_name', 'Unknown')
-                msg_time = event.message.date.strftime('%Y-%m-%d %H:%M:%S')
-                link = 'Ссылка недоступна'
-                chat_username = getattr(chat, 'username', None)
-                if chat_username:
-                    link = f"https://t.me/{chat_username}/{event.id}"
-                preview = html.escape(text[:400])
-                message_text = (
-                    f"🔔 Найдено '{html.escape(kw)}' в чате '{html.escape(title)}'\n"
-                    f"Username: {html.escape(sender_name)}\n"
-                    f"DateTime: {msg_time}\n"
-                    f"Link: {html.escape(link)}\n"
-                    f"<pre>{preview}</pre>"
-                )
-                if not bot2 or await safe_send_message(bot2, user_id, message_text, parse_mode="HTML") is None:
-                    await safe_send_message(
-                        bot,
-                        user_id,
-                        "Пожалуйста, начните чат с ботом уведомлений сначала: https://t.me/topgraber_yved_bot"
-                    )
-                parser.setdefault('results', []).append({
-                    'keyword': kw,
-                    'chat': title,
-                    'sender': sender_name,
-                    'datetime': msg_time,
-                    'link': link,
-                    'text': text,
-                })
-                save_user_data(user_data)
-                break
-        
+        # Матчинг и отправка идут через ограниченную очередь с пулом воркеров;
+        # ключ склеивает одинаковые пересылки при политике coalesce, а tenant/flow
+        # делят воркеры поровну между пользователями и их парсерами.
+        await ingest_queue.put(
+            event.chat_id,
+            lambda: mark_after(
+                parser, [message], process_message(client, user_id, parser, message, keywords, exclude),
+            ),
+            key=(parser_key(parser), message.raw_text or message.id),
+            tenant=user_id,
+            flow=parser_key(parser),
+            on_drop=lambda: drop_missed(parser, [message]),
+        )
+
+    async def on_album(event, keywords=keywords, parser=parser):
+        # Подпись альбома обычно у одного элемента — его и матчим, один раз.
+        message = next((m for m in event.messages if m.raw_text), None)
+        if message is None:
+            await mark_after(parser, event.messages, None)
+            return
+        await ingest_queue.put(
+            event.chat_id,
+            lambda: mark_after(
+                parser, event.messages, process_message(client, user_id, parser, message, keywords, exclude),
+            ),
+            key=(parser_key(parser), message.raw_text),
+            tenant=user_id,
+            flow=parser_key(parser),
+            on_drop=lambda: drop_missed(parser, [message]),
+        )
+
+    async def on_edit(event, keywords=keywords, parser=parser):
+        message = event.message
+        if not message.raw_text:
+            return
+        await ingest_queue.put(
+            event.chat_id,
+            lambda: process_message(client, user_id, parser, message, keywords, exclude, edited=True),
+            tenant=user_id,
+            flow=parser_key(parser),
+        )
+
+    extra = [(on_album, events.Album(chats=chat_ids)), (on_edit, events.MessageEdited(chats=chat_ids))]
     client.add_event_handler(monitor, event_builder)
+    for handler, builder in extra:
+        client.add_event_handler(handler, builder)
     parser['handler'] = monitor
     parser['event'] = event_builder
+    parser['extra_handlers'] = extra
     if not client.is_connected():
         await client.connect()
-    if 'task' not in info:
+    if 'task' not in info or info['task'].done():
         info['task'] = asyncio.create_task(client.run_until_disconnected())
 
 
+async def recover_gaps(user_id: int):
+    """Догнать сообщения, пришедшие, пока клиент был отключён.
+
+    Для каждого чата активных парсеров берутся сообщения после
+    ``parser['last_seen']`` по возрастанию id и прогоняются через обычный
+    конвейер. Чаты без отметки только получают её (с текущего сообщения).
+    Сначала дочитываются сообщения, которые выбросила очередь
+    (``parser['missed']``).
+    """
+    info = user_clients.get(user_id)
+    if not info or 'client' not in info:
+        return
+    client = info['client']
+    fetched = recovered = 0
+    for parser in info.get('parsers', []):
+        missed = parser.pop('missed', {})
+        # Парсеры в режиме опроса догоняют пропущенное сами при следующем опросе.
+        if parser.get('status') != 'active' or not parser.get('keywords') or parser.get('mode') == 'poll':
+            continue
+        keywords = parser['keywords']
+        exclude = [normalize_word(w) for w in parser.get('exclude_keywords', [])]
+        seen = parser.setdefault('last_seen', {})
+        for chat in parser.get('chats', []):
+            key = chat_key(chat)
+            try:
+                dropped = missed.pop(key, None)
+                if dropped:
+                    for msg in await fetch_missed(client, chat, dropped):
+                        fetched += 1
+                        if await process_message(client, user_id, parser, msg, keywords, exclude, save=False):
+                            recovered += 1
+                last = seen.get(key)
+                if not last:
+                    seen[key] = await latest_message_id(client, chat)
+                    continue
+                count = 0
+                async for msg in iter_missed(client, chat, last, GAP_MAX_MESSAGES):
+                    count += 1
+                    if await process_message(client, user_id, parser, msg, keywords, exclude, save=False):
+                        recovered += 1
+                    mark_seen(parser, msg)
+                fetched += count
+                if count >= GAP_MAX_MESSAGES:
+                    logging.warning("Gap in chat %s for user %s exceeds %s messages", chat, user_id, GAP_MAX_MESSAGES)
+            except Exception:
+                if dropped:
+                    parser.setdefault('missed', {})[key] = dropped
+                logging.exception("Gap recovery failed for user %s chat %s", user_id, chat)
+    gap_stats['runs'] += 1
+    gap_stats['fetched'] += fetched
+    gap_stats['recovered'] += recovered
+    if fetched:
+        logging.info(
+            "Gap recovery for %s: %s messages fetched, %s leads recovered (total %s/%s)",
+            user_id, fetched, recovered, gap_stats['fetched'], gap_stats['recovered'],
+        )
+    save_user_data(user_data)
+
+
+async def poll_parser(user_id: int, parser: dict):
+    """Один опрос парсера в режиме poll.
+
+    Новые сообщения всех чатов после ``last_seen`` забираются пачками с
+    фоновым приоритетом, прогоняются через общий конвейер, а найденное
+    сохраняется одним сбросом и приходит одним уведомлением.
+    """
+    if parser.get('status') != 'active' or parser.get('mode') != 'poll' or not parser.get('keywords'):
+        poll_scheduler.remove(parser)
+        return
+    info = await wake_client(user_id)
+    if not info:
+        return
+    client = info['client']
+    keywords = parser['keywords']
+    exclude = [normalize_word(w) for w in parser.get('exclude_keywords', [])]
+    seen = parser.setdefault('last_seen', {})
+    found = []
+    fetched = 0
+    for chat in parser.get('chats', []):
+        key = chat_key(chat)
+        try:
+            last = seen.get(key)
+            if not last:
+                seen[key] = await latest_message_id(client, chat, priority=BACKGROUND)
+                continue
+            async for msg in iter_missed(client, chat, last, POLL_MAX_MESSAGES, priority=BACKGROUND):
+                fetched += 1
+                result = await process_message(
+                    client, user_id, parser, msg, keywords, exclude,
+                    notify=False, save=False, priority=BACKGROUND,
+                )
+                if result:
+                    found.append(result)
+                mark_seen(parser, msg)
+        except Exception:
+            logging.exception("Poll failed for user %s chat %s", user_id, chat)
+    save_user_data(user_data)
+    if len(found) == 1:
+        await notify_result(user_id, found[0])
+    elif found:
+        await send_digest(user_id, found)
+    if fetched:
+        logging.info("Polled %s messages for user %s, %s leads", fetched, user_id, len(found))
+
+
+poll_scheduler = PollScheduler(poll_parser, POLL_CONCURRENCY)
+
+
+async def wake_client(user_id: int) -> dict | None:
+    """Запись ``user_clients`` с подключённым клиентом.
+
+    Если клиента нет (рестарт или спящий режим), он поднимается из
+    сохранённой сессии. ``None`` — сессии нет или она больше не авторизована.
+    """
+    info = user_clients.get(user_id)
+    if info and info.get('client'):
+        if not info['client'].is_connected():
+            await info['client'].connect()
+        return info
+    data = user_data.get(str(user_id)) or {}
+    api_id, api_hash = data.get('api_id'), data.get('api_hash')
+    if not (api_id and api_hash) or not session_store.has(user_id):
+        return None
+    client = TelegramClient(session_store.session(user_id), api_id, api_hash)
+    try:
+        await client.connect()
+        if not await client.is_user_authorized():
+            await client.disconnect()
+            return None
+    except Exception:
+        logging.exception("Failed to connect client for %s", user_id)
+        return None
+    info = user_clients.setdefault(user_id, {})
+    info.update({
+        'client': client,
+        'phone': data.get('phone'),
+        'phone_hash': '',
+        'parsers': data.get('parsers', []),
+    })
+    info.pop('task', None)
+    return info
+
+
+async def restore_clients():
+    """После рестарта поднять клиентов с активными парсерами и догнать пропущенное."""
+    for uid, data in list(user_data.items()):
+        if not any(p.get('status') == 'active' for p in data.get('parsers', [])):
+            continue
+        user_id = int(uid)
+        if user_id in user_clients:
+            continue
+        info = await wake_client(user_id)
+        if not info:
+            continue
+        for p in info['parsers']:
+            await start_monitor(user_id, p)
+        await recover_gaps(user_id)
+
+
+def _rss_mb() -> float:
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError):
+        return 0.0
+
+
+async def client_supervisor():
+    """Отключать клиентов без активных парсеров после HIBERNATE_AFTER секунд простоя.
+
+    Сессия перед этим сохраняется; поднимаются клиенты лениво через
+    ``wake_client`` (запуск парсера, новый парсер, проверка истории).
+    """
+    while True:
+        await asyncio.sleep(60)
+        now = time.monotonic()
+        idle = []
+        for user_id, info in list(user_clients.items()):
+            client = info.get('client')
+            # Пользователь посреди входа: клиента держим, он нужен для sign_in.
+            if client is None or info.get('phone_hash'):
+                continue
+            busy = any(
+                is_monitoring(p) or parser_key(p) in _backfills_running
+                for p in info.get('parsers', [])
+            )
+            if busy or scheduler_for(client).pending():
+                info.pop('idle_since', None)
+                continue
+            info.setdefault('idle_since', now)
+            if now - info['idle_since'] >= HIBERNATE_AFTER:
+                idle.append(user_id)
+        if not idle:
+            continue
+        before_rss = _rss_mb()
+        before_conn = sum(1 for i in user_clients.values() if i.get('client') and i['client'].is_connected())
+        for user_id in idle:
+            info = user_clients.pop(user_id, None)
+            if not info:
+                continue
+            client = info['client']
+            try:
+                session_store.save(user_id, client.session)
+                if 'task' in info:
+                    info['task'].cancel()
+                release_scheduler(client)
+                await client.disconnect()
+            except Exception:
+                logging.exception("Failed to hibernate client for %s", user_id)
+        gc.collect()
+        after_conn = sum(1 for i in user_clients.values() if i.get('client') and i['client'].is_connected())
+        logging.info(
+            "Hibernated %s idle clients: connections %s -> %s, RSS %.1f -> %.1f MB",
+            len(idle), before_conn, after_conn, before_rss, _rss_mb(),
+        )
+
+
+async def connection_watchdog():
+    """Переподключить отвалившиеся клиенты и догнать пропущенные сообщения."""
+    global _last_seen_dirty
+    last_flush = time.monotonic()
+    while True:
+        await asyncio.sleep(GAP_CHECK_INTERVAL)
+        for user_id, info in list(user_clients.items()):
+            client = info.get('client')
+            # Клиенты в процессе входа и без запущенных парсеров не трогаем.
+            if not client or info.get('phone_hash') or not any(is_monitoring(p) for p in info.get('parsers', [])):
+                continue
+            if client.is_connected() and 'task' in info and not info['task'].done():
+                # Клиент на связи, но очередь выбрасывала сообщения — дочитываем их.
+                if any(p.get('missed') for p in info.get('parsers', [])):
+                    try:
+                        await recover_gaps(user_id)
+                    except Exception:
+                        logging.exception("Missed message recovery failed for user %s", user_id)
+                continue
+            try:
+                if not client.is_connected():
+                    await client.connect()
+                info['task'] = asyncio.create_task(client.run_until_disconnected())
+                await recover_gaps(user_id)
+            except Exception:
+                logging.exception("Reconnect failed for user %s", user_id)
+        if _last_seen_dirty:
+            _last_seen_dirty = False
+            save_user_data(user_data)
+        if time.monotonic() - last_flush >= SESSION_FLUSH_INTERVAL:
+            last_flush = time.monotonic()
+            save_sessions()
+
+
+def save_sessions():
+    """Сбросить в базу сессии подключённых клиентов (вместе с кэшем сущностей)."""
+    for user_id, info in list(user_clients.items()):
+        client = info.get('client')
+        if client is None or info.get('phone_hash'):
+            continue
+        try:
+            session_store.save(user_id, client.session)
+        except Exception:
+            logging.exception("Failed to save session for %s", user_id)
+
+
+def is_monitoring(parser: dict) -> bool:
+    """Запущен ли парсер: висит обработчик событий или он стоит в опросе."""
+    if parser.get('mode') == 'poll':
+        return parser in poll_scheduler
+    return bool(parser.get('handler'))
+
+
 def stop_monitor(user_id: int, parser: dict):
     info = user_clients.get(user_id)
     if not info:
@@ -672,14 +1307,23 @@ def stop_monitor(user_id: int, parser: dict):
             info['client'].remove_event_handler(handler, event)
         except Exception:
             pass
+    for handler, event in parser.pop('extra_handlers', []):
+        try:
+            info['client'].remove_event_handler(handler, event)
+        except Exception:
+            pass
     parser.pop('handler', None)
     parser.pop('event', None)
+    poll_scheduler.remove(parser)
+    token_cache.forget(parser_key(parser))
 
 
 def pause_parser(user_id: int, parser: dict):
     """Ставит парсер на паузу и снимает обработчики."""
     parser['status'] = 'paused'
     stop_monitor(user_id, parser)
+    track_active_time(parser)
+    cost_aggregate.update(user_id, parser)
     save_user_data(user_data)
 
 
@@ -687,7 +1331,13 @@ async def resume_parser(user_id: int, parser: dict):
     """Возобновляет парсер и пересчитывает цену."""
     parser['status'] = 'active'
     parser['daily_price'] = calc_parser_daily_cost(parser)
+    track_active_time(parser)
+    cost_aggregate.update(user_id, parser)
+    # Время на паузе не догоняем: отметки начнутся с текущих сообщений.
+    parser.pop('last_seen', None)
+    parser.pop('missed', None)
     save_user_data(user_data)
+    await wake_client(user_id)
     await start_monitor(user_id, parser)
 
 
@@ -797,19 +1447,23 @@ def main_menu_keyboard() -> types.InlineKeyboardMarkup:
 def parser_settings_keyboard(idx: int) -> types.InlineKeyboardMarkup:
     kb = types.InlineKeyboardMarkup(row_width=2)
     kb.add(
-        types.InlineKeyboardButton("▶️ Запустить", callback_data=f"parser_resume_{idx}"),
-        types.InlineKeyboardButton("⏸ Пауза", callback_data=f"parser_pause_{idx}"),
+        types.InlineKeyboardButton("▶️ Запустить", callback_data=callback_key('parser_resume', idx)),
+        types.InlineKeyboardButton("⏸ Пауза", callback_data=callback_key('parser_pause', idx)),
+    )
+    kb.add(
+        types.InlineKeyboardButton("🛠 Изменить название", callback_data=callback_key('edit_name', idx)),
+        types.InlineKeyboardButton("📂 Изменить чаты", callback_data=callback_key('edit_chats', idx)),
     )
     kb.add(
-        types.InlineKeyboardButton("🛠 Изменить название", callback_data=f"edit_name_{idx}"),
-        types.InlineKeyboardButton("📂 Изменить чаты", callback_data=f"edit_chats_{idx}"),
+        types.InlineKeyboardButton("📂 Изменить слова", callback_data=callback_key('edit_keywords', idx)),
+        types.InlineKeyboardButton("📂 Изменить искл-слова", callback_data=callback_key('edit_exclude', idx)),
     )
     kb.add(
-        types.InlineKeyboardButton("📂 Изменить слова", callback_data=f"edit_keywords_{idx}"),
-        types.InlineKeyboardButton("📂 Изменить искл-слова", callback_data=f"edit_exclude_{idx}"),
+        types.InlineKeyboardButton("📋 Последние лиды", callback_data=callback_key('leads', idx)),
+        types.InlineKeyboardButton("🔄 Онлайн / опрос", callback_data=callback_key('parser_mode', idx)),
     )
     kb.add(
-        types.InlineKeyboardButton("🗑 Удалить (только на паузе)", callback_data=f"parser_delete_{idx}"),
+        types.InlineKeyboardButton("🗑 Удалить (только на паузе)", callback_data=callback_key('parser_delete', idx)),
     )
     kb.add(types.InlineKeyboardButton("🔙 Назад", callback_data="back_main"))
     return kb
@@ -823,9 +1477,9 @@ class PartnerTransferStates(StatesGroup):
     waiting_amount = State()
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith('parser_pause_'))
-async def cb_parser_pause(call: types.CallbackQuery):
-    idx = int(call.data.split('_')[2]) - 1
+@callbacks.route('parser_pause', int)
+async def cb_parser_pause(call: types.CallbackQuery, num: int):
+    idx = num - 1
     user_id = call.from_user.id
     data = user_data.get(str(user_id), {})
     if not data or idx < 0 or idx >= len(data.get('parsers', [])):
@@ -839,9 +1493,9 @@ async def cb_parser_pause(call: types.CallbackQuery):
     await ui_from_callback_edit(call, "⏸ Парсер поставлен на паузу.")
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith('parser_resume_'))
-async def cb_parser_resume(call: types.CallbackQuery):
-    idx = int(call.data.split('_')[2]) - 1
+@callbacks.route('parser_resume', int)
+async def cb_parser_resume(call: types.CallbackQuery, num: int):
+    idx = num - 1
     user_id = call.from_user.id
     data = user_data.get(str(user_id), {})
     if not data or idx < 0 or idx >= len(data.get('parsers', [])):
@@ -854,9 +1508,38 @@ async def cb_parser_resume(call: types.CallbackQuery):
     await ui_from_callback_edit(call, "▶️ Парсер запущен.")
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith('parser_delete_'))
-async def cb_parser_delete(call: types.CallbackQuery):
-    idx = int(call.data.split('_')[2]) - 1
+@callbacks.route('parser_mode', int)
+async def cb_parser_mode(call: types.CallbackQuery, num: int):
+    idx = num - 1
+    user_id = call.from_user.id
+    data = user_data.get(str(user_id), {})
+    if not data or idx < 0 or idx >= len(data.get('parsers', [])):
+        await call.answer("Не найдено", show_alert=True)
+        return
+    p = data['parsers'][idx]
+    p['mode'] = 'realtime' if p.get('mode') == 'poll' else 'poll'
+    save_user_data(user_data)
+    if p.get('status') == 'active':
+        stop_monitor(user_id, p)
+        await wake_client(user_id)
+        await start_monitor(user_id, p)
+        if p['mode'] == 'realtime':
+            # Догоняем сообщения с последнего опроса.
+            asyncio.create_task(recover_gaps(user_id))
+    if p['mode'] == 'poll':
+        interval = (p.get('poll_interval') or POLL_INTERVAL) // 60
+        text = (
+            f"⏱ Парсер переведён в режим опроса: чаты проверяются раз в {interval} мин, "
+            "найденное приходит одной сводкой."
+        )
+    else:
+        text = "⚡️ Парсер переведён в режим реального времени."
+    await ui_from_callback_edit(call, text, reply_markup=parser_settings_keyboard(idx + 1))
+
+
+@callbacks.route('parser_delete', int)
+async def cb_parser_delete(call: types.CallbackQuery, num: int):
+    idx = num - 1
     user_id = call.from_user.id
     data = user_data.get(str(user_id), {})
     if not data or idx < 0 or idx >= len(data.get('parsers', [])):
@@ -869,7 +1552,10 @@ async def cb_parser_delete(call: types.CallbackQuery):
         return
     stop_monitor(user_id, p)
     await send_parser_results(user_id, idx)  # как и раньше — отдадим CSV перед удалением
-    data['parsers'].pop(idx)
+    removed = data['parsers'].pop(idx)
+    cost_aggregate.remove(user_id, removed)
+    result_archive.drop(removed)
+    lead_index.drop_parser(removed)
     save_user_data(user_data)
     await ui_from_callback_edit(call, "🗑 Парсер удалён.")
     await call.answer()
@@ -893,7 +1579,7 @@ async def topup_amount(message: types.Message, state: FSMContext):
         await ui_send_new(message.from_user.id, "Минимальная сумма пополнения — 300 ₽. Введите другую сумму:")
         return
     user_id = message.from_user.id
-    payment_id, url = create_topup_payment(user_id, amount)
+    payment_id, url = await create_topup_payment(user_id, amount, op=await action_op(state, 'topup'))
     if not payment_id:
         await ui_send_new(message.from_user.id, "Не удалось создать платёж. Попробуйте позже.")
     else:
@@ -903,48 +1589,154 @@ async def topup_amount(message: types.Message, state: FSMContext):
         kb = types.InlineKeyboardMarkup()
         kb.add(types.InlineKeyboardButton("Оплатить сейчас", url=url))
         await ui_send_new(message.from_user.id, "Нажмите кнопку для оплаты.", reply_markup=kb)
-        asyncio.create_task(wait_topup_and_credit(user_id, payment_id, amount))
+        payment_poller.add('topup', payment_id, user_id, amount=amount)
     await state.finish()
 
 
-async def bill_user_daily(user_id: int):
-    data = user_data.get(str(user_id), {})
-    if not data:
-        return
-    per_day = total_daily_cost(user_id)
-    if per_day <= 0:
-        return
-    bal = float(data.get('balance', 0))
-    if bal >= per_day:
-        data['balance'] = _round2(bal - per_day)
-        save_user_data(user_data)
-    else:
-        paused_any = False
-        for p in data.get('parsers', []):
-            if p.get('status') == 'active':
-                pause_parser(user_id, p)
-                paused_any = True
+# Итоги последнего прогона суточного биллинга.
+billing_stats = {'runs': 0, 'last_run': 0, 'duration': 0.0, 'users': 0, 'charged': 0, 'blocked': 0, 'total': 0.0}
+
+
+def billing_day(now: datetime | None = None) -> str:
+    """Расчётный день: прогон в 03:00 UTC и рестарты до следующих 03:00 — один день."""
+    return ((now or datetime.utcnow()) - timedelta(hours=3)).strftime('%Y-%m-%d')
+
+
+async def run_daily_billing(day: str | None = None) -> dict:
+    """Суточное списание по всем пользователям за один проход.
+
+    Списания считаются векторно (``plan_daily_debits``) и применяются к
+    ``user_data`` без await посередине, так что остальные корутины не видят
+    половины прогона. На диск всё уходит одним сбросом.
+
+    Прогон идемпотентен: списание сначала пишется в ``billing_ledger``
+    (одна запись на пользователя и день), а в записи пользователя
+    отмечается ``billed_day``. Если бот упал между журналом и сохранением
+    ``user_data``, записи журнала доприменяются при следующем запуске.
+    """
+    day = day or billing_day()
+    if billing_ledger.run_status(day) == 'done':
+        return billing_stats
+    started = time.perf_counter()
+    billing_ledger.start_run(day)
+    billing_ledger.replay(day, user_data)
+    pending = {uid: u for uid, u in user_data.items() if u.get('billed_day') != day}
+    plan = plan_daily_debits(pending, cost_aggregate.total)
+    debits = plan.debits()
+    added = billing_ledger.record(day, debits)
+    for uid, _, balance in debits:
+        if uid in added:
+            user_data[uid]['balance'] = balance
+            user_data[uid]['billed_day'] = day
+    blocked = [int(uid) for uid in plan.blocked() if _block_user(uid)]
+    save_user_data(user_data)
+    billing_stats.update({
+        'runs': billing_stats['runs'] + 1,
+        'last_run': int(time.time()),
+        'duration': time.perf_counter() - started,
+        'users': len(plan.uids),
+        'charged': len(added),
+        'blocked': len(blocked),
+        'total': _round2(sum(amount for uid, amount, _ in debits if uid in added)),
+    })
+    billing_ledger.finish_run(day, billing_stats)
+    logging.info(
+        "Billing run %s: %s users, %s charged for %.2f RUB, %s blocked, %.3fs",
+        day, billing_stats['users'], billing_stats['charged'], billing_stats['total'],
+        billing_stats['blocked'], billing_stats['duration'],
+    )
+    await _notify_blocked(blocked)
+    return billing_stats
+
+
+def _block_user(uid: str) -> bool:
+    """Поставить активные парсеры на паузу без сохранения (его делает вызывающий)."""
+    paused_any = False
+    for p in user_data[uid].get('parsers', []):
+        if p.get('status') == 'active':
+            p['status'] = 'paused'
+            stop_monitor(int(uid), p)
+            track_active_time(p)
+            cost_aggregate.update(uid, p)
+            paused_any = True
+    return paused_any
+
+
+async def _notify_blocked(blocked: list):
+    for user_id in blocked:
+        await safe_send_message(
+            bot,
+            user_id,
+            "⏸ Недостаточно средств. Все парсеры поставлены на паузу. Пополните баланс командой /topup."
+        )
+
+
+def settle_prorated_batch(batch: int, now: int | None = None) -> list:
+    """Списать накопленное за активные минуты у одной группы пользователей.
+
+    Ключ журнала — час расчёта, так что повтор в том же часу не спишет
+    дважды, а начисления сбрасываются только после записи в журнал (см.
+    ``settle_batch``). Кому не хватает денег, тем парсеры ставятся на паузу,
+    а долг остаётся в ``accrued`` до следующего расчёта. Возвращает
+    заблокированных.
+    """
+    changed, blocked = settle_batch(user_data, batch, billing_ledger, _parser_cost, _block_user, now)
+    if changed:
         save_user_data(user_data)
-        if paused_any:
-            await safe_send_message(
-                bot,
-                user_id,
-                "⏸ Недостаточно средств. Все парсеры поставлены на паузу. Пополните баланс командой /topup."
-            )
+    return [int(uid) for uid in blocked]
+
+
+async def prorated_billing_loop():
+    """Почасовое списание за фактически активные минуты парсеров.
+
+    Пользователи разбиты на 60 групп по id; каждую минуту часа
+    рассчитывается своя группа, так что за час проходят все, а нагрузка
+    ровная, без пика в 03:00.
+    """
+    while True:
+        now = int(time.time())
+        batch = now // 60 % 60
+        try:
+            started = time.perf_counter()
+            blocked = settle_prorated_batch(batch, now)
+            logging.debug("Prorated batch %s settled in %.3fs", batch, time.perf_counter() - started)
+            await _notify_blocked(blocked)
+        except Exception:
+            logging.exception("Prorated billing failed for batch %s", batch)
+        await asyncio.sleep(60 - time.time() % 60)
+
+
+async def results_retention_loop():
+    """Раз в несколько часов сбрасывает устаревшие результаты в архив."""
+    while True:
+        moved = 0
+        for u in list(user_data.values()):
+            for p in u.get('parsers', []):
+                try:
+                    moved += result_archive.enforce(p, force=True)
+                except Exception:
+                    logging.exception("Retention error for parser %s", p.get('name'))
+        if moved:
+            logging.info("Archived %s results", moved)
+            save_user_data(user_data)
+        await asyncio.sleep(6 * 3600)
+
 
 async def daily_billing_loop():
-    # Списываем сразу при старте и затем — ежедневно в 03:00 UTC (пример)
+    # При старте доводим прогон текущего расчётного дня (если он не завершён),
+    # затем — ежедневно в 03:00 UTC
     while True:
         # 1) Списание
-        for uid in list(user_data.keys()):
-            try:
-                await bill_user_daily(int(uid))
-            except Exception:
-                logging.exception("Billing error for %s", uid)
-        # 2) Ждём до следующего дня 03:00 UTC
+        try:
+            await run_daily_billing()
+        except Exception:
+            logging.exception("Billing run failed")
+        # 2) Ждём до ближайших 03:00 UTC
         now = datetime.utcnow()
-        tomorrow = (now + timedelta(days=1)).replace(hour=3, minute=0, second=0, microsecond=0)
-        sleep_seconds = (tomorrow - now).total_seconds()
+        next_run = now.replace(hour=3, minute=0, second=0, microsecond=0)
+        if next_run <= now:
+            next_run += timedelta(days=1)
+        sleep_seconds = (next_run - now).total_seconds()
         await asyncio.sleep(max(60, sleep_seconds))
 
 
@@ -962,8 +1754,8 @@ def parser_info_text(user_id: int, parser: dict, created: bool = False) -> str:
     else:
         paid_to = '—'
     chat_limit = f"/{data.get('chat_limit', CHAT_LIMIT)}" if plan_name == 'PRO' else ''
-    status_emoji = '🟢' if parser.get('handler') else '⏸'
-    status_text = 'Активен' if parser.get('handler') else 'Остановлен'
+    status_emoji = '🟢' if is_monitoring(parser) else '⏸'
+    status_text = 'Активен' if is_monitoring(parser) else 'Остановлен'
     if created:
         return t('parser_created', id=idx)
     return t(
@@ -1015,6 +1807,8 @@ async def cmd_clear_result(message: types.Message):
     if data:
         for parser in data.get('parsers', []):
             parser['results'] = []
+            result_archive.drop(parser)
+            lead_index.drop_parser(parser)
         save_user_data(user_data)
 
 
@@ -1046,33 +1840,31 @@ async def cmd_delete_parser(message: types.Message):
     kb = types.InlineKeyboardMarkup(row_width=1)
     for idx, p in parsers:
         name = p.get('name', f'Парсер {idx + 1}')
-        kb.add(types.InlineKeyboardButton(name, callback_data=f'delp_select_{idx}'))
+        kb.add(types.InlineKeyboardButton(name, callback_data=callback_key('delp_select', idx)))
     kb.add(types.InlineKeyboardButton("🔙 Назад", callback_data="back_main"))
     await ui_send_new(message.from_user.id, "Выберите парсер для удаления:", reply_markup=kb)
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith('delp_select_'))
-async def cb_delp_select(call: types.CallbackQuery):
-    idx = int(call.data.split('_')[2])
+@callbacks.route('delp_select', int)
+async def cb_delp_select(call: types.CallbackQuery, idx: int):
     kb = types.InlineKeyboardMarkup(row_width=2)
     kb.add(
         types.InlineKeyboardButton("Нет", callback_data='delp_cancel'),
-        types.InlineKeyboardButton("Да", callback_data=f'delp_confirm_{idx}')
+        types.InlineKeyboardButton("Да", callback_data=callback_key('delp_confirm', idx))
     )
     await ui_from_callback_edit(call, "Удалить парсер?", reply_markup=kb)
     await call.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data == 'delp_cancel')
+@callbacks.route('delp_cancel')
 async def cb_delp_cancel(call: types.CallbackQuery):
     await ui_from_callback_edit(call, "Удаление отменено.")
     await ui_from_callback_edit(call, t('menu_main'), reply_markup=main_menu_keyboard())
     await call.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith('delp_confirm_'))
-async def cb_delp_confirm(call: types.CallbackQuery):
-    idx = int(call.data.split('_')[2])
+@callbacks.route('delp_confirm', int)
+async def cb_delp_confirm(call: types.CallbackQuery, idx: int):
     user_id = call.from_user.id
     await send_parser_results(user_id, idx)
     data = user_data.get(str(user_id))
@@ -1083,20 +1875,23 @@ async def cb_delp_confirm(call: types.CallbackQuery):
             await call.answer()
             return
         stop_monitor(user_id, parser)
-        data['parsers'].pop(idx)
+        removed = data['parsers'].pop(idx)
+        cost_aggregate.remove(user_id, removed)
+        result_archive.drop(removed)
+        lead_index.drop_parser(removed)
         save_user_data(user_data)
         await ui_from_callback_edit(call, "Парсер удалён.")
     await ui_from_callback_edit(call, t('menu_main'), reply_markup=main_menu_keyboard())
     await call.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data == 'back_main')
+@callbacks.route('back_main')
 async def cb_back_main(call: types.CallbackQuery):
     await ui_from_callback_edit(call, t('menu_main'), reply_markup=main_menu_keyboard())
     await call.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data == 'menu_setup')
+@callbacks.route('menu_setup')
 async def cb_menu_setup(call: types.CallbackQuery):
     kb = types.InlineKeyboardMarkup(row_width=1)
     kb.add(
@@ -1109,18 +1904,18 @@ async def cb_menu_setup(call: types.CallbackQuery):
     await call.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data == 'setup_new')
+@callbacks.route('setup_new')
 async def cb_setup_new(call: types.CallbackQuery, state: FSMContext):
     await call.answer()
     await cmd_add_parser(call.message, state)
 
 
-@dp.callback_query_handler(lambda c: c.data == 'setup_list')
+@callbacks.route('setup_list')
 async def cb_setup_list(call: types.CallbackQuery):
     await cb_active_parsers(call)
 
 
-@dp.callback_query_handler(lambda c: c.data == 'setup_pay')
+@callbacks.route('setup_pay')
 async def cb_setup_pay(call: types.CallbackQuery, state: FSMContext):
     """Show list of parsers for payment actions."""
     data = user_data.get(str(call.from_user.id))
@@ -1131,29 +1926,28 @@ async def cb_setup_pay(call: types.CallbackQuery, state: FSMContext):
     kb = types.InlineKeyboardMarkup(row_width=1)
     for idx, p in enumerate(data.get('parsers'), 1):
         name = p.get('name', f'Парсер {idx}')
-        kb.add(types.InlineKeyboardButton(name, callback_data=f'pay_select_{idx - 1}'))
+        kb.add(types.InlineKeyboardButton(name, callback_data=callback_key('pay_select', idx - 1)))
     kb.add(types.InlineKeyboardButton("🔙 Назад", callback_data="menu_setup"))
     await ui_from_callback_edit(call, "Выберите парсер:", reply_markup=kb)
     await call.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith('pay_select_'))
-async def cb_pay_select(call: types.CallbackQuery):
+@callbacks.route('pay_select', int)
+async def cb_pay_select(call: types.CallbackQuery, idx: int):
     """Show payment options for selected parser."""
-    idx = int(call.data.split('_')[2])
     kb = types.InlineKeyboardMarkup(row_width=1)
     kb.add(
-        types.InlineKeyboardButton("Продлить подписку", callback_data=f'pay_renew_{idx}'),
-        types.InlineKeyboardButton("Расширить Pro", callback_data=f'pay_expand_{idx}'),
-        types.InlineKeyboardButton("Перейти на Infinity", callback_data=f'pay_infinity_{idx}'),
+        types.InlineKeyboardButton("Продлить подписку", callback_data=callback_key('pay_renew', idx)),
+        types.InlineKeyboardButton("Расширить Pro", callback_data=callback_key('pay_expand', idx)),
+        types.InlineKeyboardButton("Перейти на Infinity", callback_data=callback_key('pay_infinity', idx)),
         types.InlineKeyboardButton("🔙 Назад", callback_data='setup_pay'),
     )
     await ui_from_callback_edit(call, "Выберите действие:", reply_markup=kb)
     await call.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith('pay_renew_'))
-async def cb_pay_renew(call: types.CallbackQuery, state: FSMContext):
+@callbacks.route('pay_renew', int)
+async def cb_pay_renew(call: types.CallbackQuery, idx: int, state: FSMContext):
     """Renew PRO subscription."""
     await _process_tariff_pro(
         user_id=call.from_user.id,
@@ -1163,18 +1957,17 @@ async def cb_pay_renew(call: types.CallbackQuery, state: FSMContext):
     await call.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith('pay_expand_'))
-async def cb_pay_expand(call: types.CallbackQuery, state: FSMContext):
+@callbacks.route('pay_expand', int)
+async def cb_pay_expand(call: types.CallbackQuery, idx: int, state: FSMContext):
     """Start process to expand PRO plan chats."""
-    idx = int(call.data.split('_')[2])
     await state.update_data(expand_idx=idx)
     await ui_from_callback_edit(call, "Сколько чатов вам нужно?")
     await ExpandProStates.waiting_chats.set()
     await call.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith('pay_infinity_'))
-async def cb_pay_infinity(call: types.CallbackQuery):
+@callbacks.route('pay_infinity', int)
+async def cb_pay_infinity(call: types.CallbackQuery, idx: int):
     """Inform about INFINITY plan."""
     keyboard111 = types.InlineKeyboardMarkup()
     keyboard111.add(types.InlineKeyboardButton(text="Подключить", url="https://t.me/antufev2025"))
@@ -1209,16 +2002,17 @@ async def expand_pro_chats(message: types.Message, state: FSMContext):
     await ExpandProStates.waiting_confirm.set()
 
 
-@dp.callback_query_handler(lambda c: c.data == 'expand_confirm', state=ExpandProStates.waiting_confirm)
+@callbacks.route('expand_confirm', state=ExpandProStates.waiting_confirm)
 async def cb_expand_confirm(call: types.CallbackQuery, state: FSMContext):
     data = await state.get_data()
     price = data.get('price')
     chats = data.get('chats')
     user_id = call.from_user.id
-    payment_id, url = create_payment(
+    payment_id, url = await create_payment(
         user_id,
         f"{price:.2f}",
         f"Расширение PRO до {chats} чатов для пользователя {user_id}",
+        op=await action_op(state, 'expand'),
     )
     if not payment_id:
         await ui_from_callback_edit(call, "Не удалось создать платёж. Попробуйте позже.")
@@ -1229,26 +2023,26 @@ async def cb_expand_confirm(call: types.CallbackQuery, state: FSMContext):
         kb = types.InlineKeyboardMarkup()
         kb.add(types.InlineKeyboardButton("Оплатить сейчас", url=url))
         await ui_from_callback_edit(call, "Нажмите кнопку для оплаты.", reply_markup=kb)
-        asyncio.create_task(wait_payment_and_activate(user_id, payment_id, chats))
+        payment_poller.add('expand', payment_id, user_id, amount=price, chats=chats)
     await state.finish()
     await call.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data == 'expand_cancel', state=ExpandProStates.waiting_confirm)
+@callbacks.route('expand_cancel', state=ExpandProStates.waiting_confirm)
 async def cb_expand_cancel(call: types.CallbackQuery, state: FSMContext):
     await ui_from_callback_edit(call, "Действие отменено.")
     await state.finish()
     await call.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data == 'expand_back', state=ExpandProStates.waiting_confirm)
+@callbacks.route('expand_back', state=ExpandProStates.waiting_confirm)
 async def cb_expand_back(call: types.CallbackQuery, state: FSMContext):
     await ui_from_callback_edit(call, "Сколько чатов вам нужно?")
     await ExpandProStates.waiting_chats.set()
     await call.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data == 'menu_export')
+@callbacks.route('menu_export')
 async def cb_menu_export(call: types.CallbackQuery):
     kb = types.InlineKeyboardMarkup(row_width=1)
     kb.add(
@@ -1261,19 +2055,19 @@ async def cb_menu_export(call: types.CallbackQuery):
     await call.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data == 'export_all')
+@callbacks.route('export_all')
 async def cb_export_all(call: types.CallbackQuery):
     await send_all_results(call.from_user.id)
     await ui_from_callback_edit(call, t('menu_main'), reply_markup=main_menu_keyboard())
     await call.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data == 'export_choose')
+@callbacks.route('export_choose')
 async def cb_export_choose(call: types.CallbackQuery):
     await cb_result(call)
 
 
-@dp.callback_query_handler(lambda c: c.data == 'export_alert')
+@callbacks.route('export_alert')
 async def cb_export_alert(call: types.CallbackQuery):
     link = f"https://t.me/topgraber_yved_bot"
     await ui_from_callback_edit(call, 
@@ -1283,7 +2077,7 @@ async def cb_export_alert(call: types.CallbackQuery):
     await call.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data == 'menu_help')
+@callbacks.route('menu_help')
 async def cb_menu_help(call: types.CallbackQuery):
     kb = types.InlineKeyboardMarkup(row_width=1)
     kb.add(
@@ -1297,24 +2091,24 @@ async def cb_menu_help(call: types.CallbackQuery):
     await call.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data == 'help_start')
+@callbacks.route('help_start')
 async def cb_help_start(call: types.CallbackQuery):
     await cmd_help(call.message)
     await call.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data == 'help_support')
+@callbacks.route('help_support')
 async def cb_help_support(call: types.CallbackQuery):
     await ui_from_callback_edit(call, "Свяжитесь с поддержкой: https://t.me/TopGrabberSupport")
     await call.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data == 'help_about')
+@callbacks.route('help_about')
 async def cb_help_about(call: types.CallbackQuery):
     await cb_info(call)
 
 
-@dp.callback_query_handler(lambda c: c.data == 'menu_profile')
+@callbacks.route('menu_profile')
 async def cb_menu_profile(call: types.CallbackQuery):
     data = user_data.get(str(call.from_user.id), {})
     now = int(datetime.utcnow().timestamp())
@@ -1372,14 +2166,14 @@ async def cb_menu_profile(call: types.CallbackQuery):
     await call.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data == 'profile_topup')
+@callbacks.route('profile_topup')
 async def cb_profile_topup(call: types.CallbackQuery):
     await ui_from_callback_edit(call, "Введите сумму пополнения (минимум 300 ₽):")
     await TopUpStates.waiting_amount.set()
     await call.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data == 'profile_paybalance')
+@callbacks.route('profile_paybalance')
 async def cb_profile_paybalance(call: types.CallbackQuery, state: FSMContext):
     data = get_user_data_entry(call.from_user.id)
     ref_bal = float(data.get('ref_balance', 0))
@@ -1416,7 +2210,7 @@ async def partner_transfer_amount(message: types.Message, state: FSMContext):
     await state.finish()
 
 
-@dp.callback_query_handler(lambda c: c.data == 'profile_withdraw')
+@callbacks.route('profile_withdraw')
 async def cb_profile_withdraw(call: types.CallbackQuery, state: FSMContext):
     data = get_user_data_entry(call.from_user.id)
     ref_bal = float(data.get('ref_balance', 0))
@@ -1462,7 +2256,9 @@ async def withdraw_amount(message: types.Message, state: FSMContext):
     await WithdrawStates.waiting_method.set()
 
 
-@dp.callback_query_handler(lambda c: c.data in ('wd_m_card','wd_m_yoomoney','wd_m_sbp'), state=WithdrawStates.waiting_method)
+@callbacks.route('wd_m_card', state=WithdrawStates.waiting_method)
+@callbacks.route('wd_m_yoomoney', state=WithdrawStates.waiting_method)
+@callbacks.route('wd_m_sbp', state=WithdrawStates.waiting_method)
 async def withdraw_pick_method(call: types.CallbackQuery, state: FSMContext):
     method = {"wd_m_card":"card","wd_m_yoomoney":"yoomoney","wd_m_sbp":"sbp"}[call.data]
     await state.update_data(method=method)
@@ -1518,14 +2314,14 @@ async def withdraw_destination(message: types.Message, state: FSMContext):
     await WithdrawStates.waiting_confirm.set()
 
 
-@dp.callback_query_handler(lambda c: c.data == 'wd_cancel', state='*')
+@callbacks.route('wd_cancel', state='*')
 async def withdraw_cancel(call: types.CallbackQuery, state: FSMContext):
     await state.finish()
     await ui_from_callback_edit(call, "Вывод отменён.")
     await call.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data == 'wd_confirm', state=WithdrawStates.waiting_confirm)
+@callbacks.route('wd_confirm', state=WithdrawStates.waiting_confirm)
 async def withdraw_confirm(call: types.CallbackQuery, state: FSMContext):
     st = await state.get_data()
     amount = float(st.get("amount", 0))
@@ -1542,12 +2338,13 @@ async def withdraw_confirm(call: types.CallbackQuery, state: FSMContext):
         await call.answer()
         return
 
-    payout_id, resp = create_yookassa_payout(
+    payout_id, resp = await create_yookassa_payout(
         user_id=user_id,
         amount_rub=amount,
         description=f"Вывод партнёрских средств пользователю {user_id}",
         method=method,
         destination=destination,
+        op=await action_op(state, 'payout'),
     )
 
     if not payout_id:
@@ -1558,13 +2355,13 @@ async def withdraw_confirm(call: types.CallbackQuery, state: FSMContext):
 
     # Сообщаем и запускаем поллинг статуса
     await ui_from_callback_edit(call, f"Заявка на вывод создана ✅\nID: {payout_id}\nСумма: {amount:.2f} ₽\nСтатус: ожидает подтверждения провайдером.")
-    asyncio.create_task(wait_payout_and_finalize(user_id, payout_id, amount))
+    payment_poller.add('payout', payout_id, user_id, amount=amount)
     await state.finish()
     await call.answer()
 
 
 
-@dp.callback_query_handler(lambda c: c.data == 'profile_delete_card')
+@callbacks.route('profile_delete_card')
 async def cb_profile_delete_card(call: types.CallbackQuery):
     data = user_data.get(str(call.from_user.id))
     if data:
@@ -1599,7 +2396,7 @@ async def cmd_tariff_pro(message: types.Message, state: FSMContext):
     )
 
 
-@dp.callback_query_handler(lambda c: c.data == 'tariff_pro')
+@callbacks.route('tariff_pro')
 async def cb_tariff_pro(call: types.CallbackQuery, state: FSMContext):
     await _process_tariff_pro(
         user_id=call.from_user.id,         # кто нажал кнопку
@@ -1624,7 +2421,7 @@ async def promo_entered(message: types.Message, state: FSMContext):
             "Перейдите по ссылке для оплаты тарифа PRO.",
             reply_markup=types.ReplyKeyboardRemove(),
         )
-        payment_id, url = create_pro_payment(user_id)
+        payment_id, url = await create_pro_payment(user_id, op=await action_op(state, 'pro'))
         if not payment_id:
             await ui_send_new(user_id, "Не удалось создать платёж. Попробуйте позже.")
         else:
@@ -1633,8 +2430,8 @@ async def promo_entered(message: types.Message, state: FSMContext):
             kb = types.InlineKeyboardMarkup()
             kb.add(types.InlineKeyboardButton("Оплатить сейчас", url=url))
             await ui_send_new(user_id, "Нажмите кнопку для оплаты.", reply_markup=kb)
-            asyncio.create_task(
-                wait_payment_and_activate(user_id, payment_id, data.get('chat_limit', CHAT_LIMIT))
+            payment_poller.add(
+                'pro', payment_id, user_id, amount=PRO_MONTHLY_RUB, chats=data.get('chat_limit', CHAT_LIMIT)
             )
         await state.finish()
         return
@@ -1656,6 +2453,7 @@ async def promo_entered(message: types.Message, state: FSMContext):
         expiry = int((datetime.utcnow() + timedelta(days=7)).timestamp())
         data['subscription_expiry'] = expiry
         used_promos.append(code)
+        subscription_changed(user_id)
         save_user_data(user_data)
         await ui_send_new(user_id,
             "Промокод принят! Вам предоставлено 7 дней бесплатного тарифа PRO.",
@@ -1680,7 +2478,7 @@ async def promo_entered(message: types.Message, state: FSMContext):
         "Перейдите по ссылке для оплаты тарифа PRO.",
         reply_markup=types.ReplyKeyboardRemove(),
     )
-    payment_id, url = create_pro_payment(user_id)
+    payment_id, url = await create_pro_payment(user_id, op=await action_op(state, 'pro'))
     if not payment_id:
         await ui_send_new(user_id, "Не удалось создать платёж. Попробуйте позже.")
     else:
@@ -1689,14 +2487,14 @@ async def promo_entered(message: types.Message, state: FSMContext):
         kb = types.InlineKeyboardMarkup()
         kb.add(types.InlineKeyboardButton("Оплатить сейчас", url=url))
         await ui_send_new(user_id, "Нажмите кнопку для оплаты.", reply_markup=kb)
-        asyncio.create_task(
-            wait_payment_and_activate(user_id, payment_id, data.get('chat_limit', CHAT_LIMIT))
+        payment_poller.add(
+            'pro', payment_id, user_id, amount=PRO_MONTHLY_RUB, chats=data.get('chat_limit', CHAT_LIMIT)
         )
     await state.finish()
 
 
 
-@dp.callback_query_handler(lambda c: c.data == 'result')
+@callbacks.route('result')
 async def cb_result(call: types.CallbackQuery):
     data = user_data.get(str(call.from_user.id))
     if not data or not data.get('parsers'):
@@ -1706,25 +2504,25 @@ async def cb_result(call: types.CallbackQuery):
     kb = types.InlineKeyboardMarkup(row_width=1)
     for idx, p in enumerate(data.get('parsers'), 1):
         name = p.get('name', f'Парсер {idx}')
-        kb.add(types.InlineKeyboardButton(name, callback_data=f"csv_{idx}"))
+        kb.add(types.InlineKeyboardButton(name, callback_data=callback_key('csv', idx)))
     kb.add(types.InlineKeyboardButton("🔙 Назад", callback_data="back_main"))
     await ui_from_callback_edit(call, "Выберите парсер для получения CSV:", reply_markup=kb)
     await call.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data == 'help_info')
+@callbacks.route('help_info')
 async def cb_help(call: types.CallbackQuery):
     await ui_from_callback_edit(call, HELP_TEXT)
     await call.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data == 'info')
+@callbacks.route('info')
 async def cb_info(call: types.CallbackQuery):
     await ui_from_callback_edit(call, INFO_TEXT)
     await call.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data == 'active_parsers')
+@callbacks.route('active_parsers')
 async def cb_active_parsers(call: types.CallbackQuery):
     data = user_data.get(str(call.from_user.id))
     if not data or not data.get('parsers'):
@@ -1734,15 +2532,15 @@ async def cb_active_parsers(call: types.CallbackQuery):
     kb = types.InlineKeyboardMarkup(row_width=1)
     for idx, p in enumerate(data.get('parsers'), 1):
         name = p.get('name', f'Парсер {idx}')
-        kb.add(types.InlineKeyboardButton(name, callback_data=f"edit_{idx}"))
+        kb.add(types.InlineKeyboardButton(name, callback_data=callback_key('edit', idx)))
     kb.add(types.InlineKeyboardButton("🔙 Назад", callback_data="back_main"))
     await ui_from_callback_edit(call, "Активные парсеры:", reply_markup=kb)
     await call.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith('csv_'))
-async def cb_send_csv(call: types.CallbackQuery):
-    idx = int(call.data.split('_')[1]) - 1
+@callbacks.route('csv', int)
+async def cb_send_csv(call: types.CallbackQuery, num: int):
+    idx = num - 1
     user_id = call.from_user.id
     check_subscription(user_id)
     data = user_data.get(str(user_id))
@@ -1756,24 +2554,15 @@ async def cb_send_csv(call: types.CallbackQuery):
         await call.answer()
         return
     parser = parsers[idx]
-    results = parser.get('results', [])
-    if not results:
+    if not result_archive.total(parser):
         await ui_from_callback_edit(call, "Нет сохранённых результатов для этого парсера.")
         await call.answer()
         return
     path = f"results_{user_id}_{idx + 1}.csv"
     with open(path, 'w', newline='', encoding='utf-8') as f:
         writer = csv.writer(f)
-        writer.writerow(["keyword", "chat", "sender", "datetime", "link", "text"])
-        for r in results:
-            writer.writerow([
-                r.get('keyword', ''),
-                r.get('chat', ''),
-                r.get('sender', ''),
-                r.get('datetime', ''),
-                r.get('link', ''),
-                r.get('text', '').replace('\n', ' '),
-            ])
+        writer.writerow(CSV_HEADER)
+        writer.writerows(r.as_row() for r in result_archive.iter_results(parser))
     await bot.send_document(user_id, types.InputFile(path))
     os.remove(path)
     await ui_from_callback_edit(call, t('menu_main'), reply_markup=main_menu_keyboard())
@@ -1786,6 +2575,189 @@ async def cmd_export(message: types.Message):
     await send_all_results(message.from_user.id)
 
 
+def _search_page(user_id: int, query: str, before: int | None = None):
+    rows = lead_index.search(user_id, query, before=before, limit=SEARCH_PAGE_SIZE + 1)
+    has_more = len(rows) > SEARCH_PAGE_SIZE
+    rows = rows[:SEARCH_PAGE_SIZE]
+    if not rows:
+        text = "Ничего не найдено." if before is None else "Больше совпадений нет."
+        return text, None
+    blocks = []
+    for _, dt, chat, sender, keyword, link, text in rows:
+        preview = text if len(text) <= 300 else text[:300] + '…'
+        blocks.append(
+            f"📅 {dt} • {chat}\n"
+            f"👤 {sender} • 🔑 {keyword}\n"
+            f"{preview}\n"
+            f"{link}"
+        )
+    kb = types.InlineKeyboardMarkup(row_width=1)
+    if has_more:
+        kb.add(types.InlineKeyboardButton("➡️ Дальше", callback_data=callback_key('search_more', rows[-1][0])))
+    kb.add(types.InlineKeyboardButton("🔙 Назад", callback_data="back_main"))
+    return f"🔎 Результаты по запросу «{query}»:\n\n" + "\n\n".join(blocks), kb
+
+
+@dp.message_handler(commands=['search'])
+async def cmd_search(message: types.Message):
+    """Поиск по сохранённым лидам: /search <запрос>."""
+    user_id = message.from_user.id
+    query = (message.get_args() or '').strip()
+    if not query:
+        await ui_send_new(user_id, "Введите запрос после команды, например: /search ремонт квартиры")
+        return
+    data = get_user_data_entry(user_id)
+    data['search_query'] = query
+    text, kb = _search_page(user_id, query)
+    await ui_send_new(user_id, text, reply_markup=kb)
+
+
+@callbacks.route('search_more', int)
+async def cb_search_more(call: types.CallbackQuery, before: int):
+    query = get_user_data_entry(call.from_user.id).get('search_query')
+    if not query:
+        await call.answer("Повторите поиск командой /search", show_alert=True)
+        return
+    text, kb = _search_page(call.from_user.id, query, before=before)
+    await ui_from_callback_edit(call, text, reply_markup=kb)
+
+
+def _leads_page(parser: dict, idx: int, before: int | None = None):
+    items, lo = result_archive.page(parser, before, LEADS_PAGE_SIZE)
+    kb = types.InlineKeyboardMarkup(row_width=2)
+    if not items:
+        kb.add(types.InlineKeyboardButton("🔙 Назад", callback_data=callback_key('edit', idx)))
+        return t('no_results'), kb
+    total = result_archive.total(parser)
+    hi = items[0][0] + 1
+    blocks = []
+    for _, r in items:
+        preview = r.text if len(r.text) <= 300 else r.text[:300] + '…'
+        blocks.append(
+            f"📅 {r.datetime} • {r.chat}\n"
+            f"👤 {r.sender} • 🔑 {r.keyword}\n"
+            f"{preview}\n"
+            f"{r.link}"
+        )
+    nav = []
+    if hi < total:
+        nav.append(types.InlineKeyboardButton("⬅️ Новее", callback_data=callback_key('leads', idx, min(total, hi + LEADS_PAGE_SIZE))))
+    if lo > 0:
+        nav.append(types.InlineKeyboardButton("Старее ➡️", callback_data=callback_key('leads', idx, lo)))
+    if nav:
+        kb.row(*nav)
+    kb.add(types.InlineKeyboardButton("🔙 Назад", callback_data=callback_key('edit', idx)))
+    header = (
+        f"📋 Последние лиды «{parser.get('name', f'Парсер {idx}')}» "
+        f"({total - hi + 1}–{total - lo} из {total}, в порядке поступления):"
+    )
+    return header + "\n\n" + "\n\n".join(blocks), kb
+
+
+@callbacks.route('leads', int, int, optional=1)
+async def cb_leads(call: types.CallbackQuery, num: int, before: int | None = None):
+    """Просмотр результатов парсера страницами: leads:<номер>[:<курсор>].
+
+    Порядок — по времени поступления в бот, а не по дате сообщения:
+    лиды из проверки истории попадают в конец, хотя сами сообщения старше.
+    """
+    idx = num - 1
+    parsers = user_data.get(str(call.from_user.id), {}).get('parsers', [])
+    if idx < 0 or idx >= len(parsers):
+        await call.answer("Парсер не найден", show_alert=True)
+        return
+    text, kb = _leads_page(parsers[idx], idx + 1, before)
+    await ui_from_callback_edit(call, text, reply_markup=kb)
+    await call.answer()
+
+
+_backfills_running = set()
+
+
+def backfill_keyboard(idx: int) -> types.InlineKeyboardMarkup:
+    kb = types.InlineKeyboardMarkup()
+    kb.add(types.InlineKeyboardButton("🔎 Проверить историю чатов", callback_data=callback_key('backfill', idx)))
+    kb.add(types.InlineKeyboardButton("🔙 Назад", callback_data="back_main"))
+    return kb
+
+
+async def run_backfill(user_id: int, parser: dict, idx: int):
+    """Прогнать историю чатов парсера через матчер с сообщением о прогрессе."""
+    key = parser_key(parser)
+    info = user_clients.get(user_id)
+    if key in _backfills_running or not info or 'client' not in info:
+        return
+    _backfills_running.add(key)
+    client = info['client']
+    keywords = parser.get('keywords') or []
+    exclude = [normalize_word(w) for w in parser.get('exclude_keywords', [])]
+
+    async def handle(msg):
+        return await process_message(
+            client, user_id, parser, msg, keywords, exclude,
+            notify=False, save=False, priority=BACKGROUND,
+        )
+
+    status = await ui_send_new(user_id, "⏳ Проверяю историю чатов…")
+
+    async def progress(stats):
+        if not status:
+            return
+        try:
+            await bot.edit_message_text(
+                f"⏳ Проверяю историю чатов: {stats['done']}/{stats['chats']}\n"
+                f"Просмотрено сообщений: {stats['scanned']}, найдено: {stats['found']}",
+                user_id, status.message_id,
+            )
+        except MessageNotModified:
+            pass
+
+    # Дубли отсеиваются по всем результатам окна, включая архивные.
+    since = (datetime.utcnow() - timedelta(days=BACKFILL_DAYS)).strftime('%Y-%m-%d %H:%M:%S')
+    try:
+        if not client.is_connected():
+            await client.connect()
+        stats = await backfill_parser(
+            client, parser, handle, BACKFILL_LIMIT, BACKFILL_DAYS,
+            concurrency=BACKFILL_CONCURRENCY, known=result_archive.iter_results(parser, since),
+            progress=progress,
+        )
+    except Exception:
+        logging.exception("Backfill failed for user %s", user_id)
+        await ui_send_new(user_id, "⚠️ Не удалось проверить историю чатов.")
+        return
+    finally:
+        _backfills_running.discard(key)
+        save_user_data(user_data)
+    kb = types.InlineKeyboardMarkup()
+    kb.add(types.InlineKeyboardButton("📋 Последние лиды", callback_data=callback_key('leads', idx)))
+    kb.add(types.InlineKeyboardButton("🔙 Назад", callback_data="back_main"))
+    await ui_send_new(
+        user_id,
+        f"✅ История проверена: просмотрено {stats['scanned']} сообщений, "
+        f"найдено совпадений: {stats['found']}.",
+        reply_markup=kb,
+    )
+
+
+@callbacks.route('backfill', int)
+async def cb_backfill(call: types.CallbackQuery, num: int):
+    idx = num - 1
+    user_id = call.from_user.id
+    parsers = user_data.get(str(user_id), {}).get('parsers', [])
+    if idx < 0 or idx >= len(parsers):
+        await call.answer("Парсер не найден", show_alert=True)
+        return
+    if not await wake_client(user_id):
+        await call.answer("Сначала авторизуйте аккаунт Telegram", show_alert=True)
+        return
+    if parser_key(parsers[idx]) in _backfills_running:
+        await call.answer("Проверка уже идёт", show_alert=True)
+        return
+    asyncio.create_task(run_backfill(user_id, parsers[idx], idx + 1))
+    await call.answer("Запускаю проверку истории")
+
+
 @dp.message_handler(commands=['check_payment'])
 async def cmd_check_payment(message: types.Message):
     user_id = message.from_user.id
@@ -1794,10 +2766,13 @@ async def cmd_check_payment(message: types.Message):
     if not payment_id:
         await ui_send_new(user_id, "Платёж не найден.")
         return
-    status = check_payment(payment_id)
+    status = await check_payment(payment_id)
     if status == 'succeeded':
-        expiry = int((datetime.utcnow() + timedelta(days=30)).timestamp())
-        data['subscription_expiry'] = expiry
+        # Тот же платёж может завершить и payment_poller — продлеваем один раз.
+        if mark_applied(data, payment_id):
+            expiry = int((datetime.utcnow() + timedelta(days=30)).timestamp())
+            data['subscription_expiry'] = expiry
+            subscription_changed(user_id)
         data.pop('payment_id', None)
         save_user_data(user_data)
         await ui_send_new(user_id, t('payment_success'))
@@ -1811,22 +2786,15 @@ async def send_all_results(user_id: int):
         return
     rows = []
     for parser in data.get('parsers', []):
-        for r in parser.get('results', []):
-            rows.append([
-                r.get('keyword', ''),
-                r.get('chat', ''),
-                r.get('sender', ''),
-                r.get('datetime', ''),
-                r.get('link', ''),
-                r.get('text', '').replace('\n', ' '),
-            ])
+        for r in result_archive.iter_results(parser):
+            rows.append(r.as_row())
     if not rows:
         await safe_send_message(bot, user_id, t('no_results'))
         return
     path = f"results_{user_id}_all.csv"
     with open(path, 'w', newline='', encoding='utf-8') as f:
         writer = csv.writer(f)
-        writer.writerow(["keyword", "chat", "sender", "datetime", "link", "text"])
+        writer.writerow(CSV_HEADER)
         writer.writerows(rows)
     await bot.send_document(user_id, types.InputFile(path), caption=t('csv_export_ready'))
     os.remove(path)
@@ -1839,23 +2807,14 @@ async def send_parser_results(user_id: int, idx: int):
     if idx < 0 or idx >= len(parsers):
         return
     parser = parsers[idx]
-    results = parser.get('results', [])
-    if not results:
+    if not result_archive.total(parser):
         await safe_send_message(bot, user_id, t('no_results'))
         return
     path = f"results_{user_id}_{idx + 1}.csv"
     with open(path, 'w', newline='', encoding='utf-8') as f:
         writer = csv.writer(f)
-        writer.writerow(["keyword", "chat", "sender", "datetime", "link", "text"])
-        for r in results:
-            writer.writerow([
-                r.get('keyword', ''),
-                r.get('chat', ''),
-                r.get('sender', ''),
-                r.get('datetime', ''),
-                r.get('link', ''),
-                r.get('text', '').replace('\n', ' '),
-            ])
+        writer.writerow(CSV_HEADER)
+        writer.writerows(r.as_row() for r in result_archive.iter_results(parser))
     await bot.send_document(user_id, types.InputFile(path))
     os.remove(path)
 
@@ -1863,9 +2822,9 @@ async def send_parser_results(user_id: int, idx: int):
 # specific parser. More specific callbacks such as ``edit_chats_X`` and
 # ``edit_keywords_X`` are handled separately below, so here we ensure that the
 # data matches exactly the ``edit_<number>`` pattern.
-@dp.callback_query_handler(lambda c: c.data.startswith('edit_') and c.data.count('_') == 1)
-async def cb_edit_parser(call: types.CallbackQuery):
-    idx = int(call.data.split('_')[1]) - 1
+@callbacks.route('edit', int)
+async def cb_edit_parser(call: types.CallbackQuery, num: int):
+    idx = num - 1
     parser = user_data.get(str(call.from_user.id), {}).get('parsers', [])[idx]
     text = parser_info_text(call.from_user.id, parser)
     await ui_from_callback_edit(call, 
@@ -1874,9 +2833,9 @@ async def cb_edit_parser(call: types.CallbackQuery):
     await call.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith('edit_chats_'), state='*')
-async def cb_edit_chats(call: types.CallbackQuery, state: FSMContext):
-    idx = int(call.data.split('_')[2]) - 1
+@callbacks.route('edit_chats', int, state='*')
+async def cb_edit_chats(call: types.CallbackQuery, num: int, state: FSMContext):
+    idx = num - 1
     await state.update_data(edit_idx=idx)
     await ui_from_callback_edit(call, 
         "Введите новые ссылки на чаты (через пробел или запятую):"
@@ -1885,9 +2844,9 @@ async def cb_edit_chats(call: types.CallbackQuery, state: FSMContext):
     await call.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith('edit_keywords_'), state='*')
-async def cb_edit_keywords(call: types.CallbackQuery, state: FSMContext):
-    idx = int(call.data.split('_')[2]) - 1
+@callbacks.route('edit_keywords', int, state='*')
+async def cb_edit_keywords(call: types.CallbackQuery, num: int, state: FSMContext):
+    idx = num - 1
     await state.update_data(edit_idx=idx)
     await ui_from_callback_edit(call, 
         "Введите новые ключевые слова (через запятую):"
@@ -1896,9 +2855,9 @@ async def cb_edit_keywords(call: types.CallbackQuery, state: FSMContext):
     await call.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith('edit_exclude_'), state='*')
-async def cb_edit_exclude(call: types.CallbackQuery, state: FSMContext):
-    idx = int(call.data.split('_')[2]) - 1
+@callbacks.route('edit_exclude', int, state='*')
+async def cb_edit_exclude(call: types.CallbackQuery, num: int, state: FSMContext):
+    idx = num - 1
     await state.update_data(edit_idx=idx)
     await ui_from_callback_edit(call, 
         "Введите новые исключающие слова (через запятую):"
@@ -1907,17 +2866,17 @@ async def cb_edit_exclude(call: types.CallbackQuery, state: FSMContext):
     await call.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith('edit_name_'), state='*')
-async def cb_edit_name(call: types.CallbackQuery, state: FSMContext):
-    idx = int(call.data.split('_')[2]) - 1
+@callbacks.route('edit_name', int, state='*')
+async def cb_edit_name(call: types.CallbackQuery, num: int, state: FSMContext):
+    idx = num - 1
     await state.update_data(edit_idx=idx)
     await ui_from_callback_edit(call, "Введите новое название парсера:")
     await EditParserStates.waiting_name.set()
     await call.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith('edit_tariff_'))
-async def cb_edit_tariff(call: types.CallbackQuery, state: FSMContext):
+@callbacks.route('edit_tariff', int)
+async def cb_edit_tariff(call: types.CallbackQuery, idx: int, state: FSMContext):
     await cb_tariff_pro(call, state)
 
 
@@ -1959,28 +2918,14 @@ async def cmd_add_parser(message: types.Message, state: FSMContext):
         return
 
     info = user_clients.get(user_id)
-    if not info:
-        saved = user_data.get(str(user_id))
-        api_id = saved.get('api_id') if saved else None
-        api_hash = saved.get('api_hash') if saved else None
-        if not api_id or not api_hash:
+    if not info or not info.get('client'):
+        info = await wake_client(user_id)
+        if not info:
             await login_flow(message, state)
             return
-        session_name = f"session_{user_id}"
-        client = TelegramClient(session_name, api_id, api_hash)
-        await client.connect()
-        if not await client.is_user_authorized():
-            await login_flow(message, state)
-            return
-        user_clients[user_id] = {
-            'client': client,
-            'phone': saved.get('phone') if saved else None,
-            'phone_hash': '',
-            'parsers': saved.get('parsers', []) if saved else []
-        }
-        for p in user_clients[user_id]['parsers']:
+        for p in info['parsers']:
             await start_monitor(user_id, p)
-        info = user_clients[user_id]
+        asyncio.create_task(recover_gaps(user_id))
 
     parsers = data.setdefault('parsers', [])
     parser_id = len(parsers) + 1
@@ -2020,6 +2965,7 @@ async def login_flow(message: types.Message, state: FSMContext):
         try:
             if 'task' in existing:
                 existing['task'].cancel()
+            release_scheduler(existing['client'])
             await existing['client'].disconnect()
         except Exception:
             logging.exception("Failed to disconnect previous session")
@@ -2028,8 +2974,7 @@ async def login_flow(message: types.Message, state: FSMContext):
         api_id = saved.get('api_id')
         api_hash = saved.get('api_hash')
         if api_id and api_hash:
-            session_name = f"session_{user_id}"
-            client = TelegramClient(session_name, api_id, api_hash)
+            client = TelegramClient(session_store.session(user_id), api_id, api_hash)
             await client.connect()
             if await client.is_user_authorized():
                 user_clients[user_id] = {
@@ -2040,6 +2985,7 @@ async def login_flow(message: types.Message, state: FSMContext):
                 }
                 for p in user_clients[user_id]['parsers']:
                     await start_monitor(user_id, p)
+                asyncio.create_task(recover_gaps(user_id))
                 if user_clients[user_id]['parsers']:
                     await ui_send_new(user_id, "✅ Найдены сохранённые парсеры. Мониторинг запущен.")
                     return
@@ -2072,15 +3018,16 @@ async def get_phone(message: types.Message, state: FSMContext):
     save_user_data(user_data)
 
     # Create Telethon client
-    session_name = f"session_{user_id}"
-    client = TelegramClient(session_name, api_id, api_hash)
+    client = TelegramClient(session_store.session(user_id), api_id, api_hash)
     await client.connect()
 
     try:
-        result = await client.send_code_request(phone)
+        result = await api_call(client, 'auth', client.send_code_request, phone, priority=INTERACTIVE, retry=False)
         phone_hash = result.phone_code_hash
         if not phone_hash:
             raise ValueError("Phone code hash not received from Telegram.")
+        # Ключ, под которым запрошен код, нужен и для sign_in.
+        session_store.save(user_id, client.session)
         # Store client and phone hash
         user_clients[user_id] = {
             'client': client,
@@ -2106,15 +3053,14 @@ async def get_phone(message: types.Message, state: FSMContext):
 async def _ensure_client(user_id: int, api_id: int, api_hash: str) -> TelegramClient:
     """
     Возвращает подключённый TelegramClient для пользователя.
-    Переиспользует существующий, либо создаёт новый с именем сессии session_{user_id}.
+    Переиспользует существующий, либо создаёт новый из сессии в базе.
     """
     client = None
     cached = user_clients.get(user_id)
     if cached and isinstance(cached.get("client"), TelegramClient):
         client = cached["client"]
     else:
-        session_name = f"session_{user_id}"
-        client = TelegramClient(session_name, api_id, api_hash)
+        client = TelegramClient(session_store.session(user_id), api_id, api_hash)
 
     if not client.is_connected():
         await client.connect()
@@ -2153,6 +3099,7 @@ async def get_telethon_code(message: types.Message, state: FSMContext):
     try:
         # Если уже авторизован, сразу вперёд
         if await client.is_user_authorized():
+            session_store.save(user_id, client.session)
             user_clients[user_id] = {
                 "client": client,
                 "phone": phone,
@@ -2168,9 +3115,14 @@ async def get_telethon_code(message: types.Message, state: FSMContext):
             return
 
         # Пытаемся войти по коду
-        await client.sign_in(phone=phone, code=code, phone_code_hash=phone_hash)
+        await api_call(
+            client, 'auth', client.sign_in,
+            phone=phone, code=code, phone_code_hash=phone_hash,
+            priority=INTERACTIVE, retry=False,
+        )
 
         # Успех
+        session_store.save(user_id, client.session)
         user_clients[user_id] = {
             "client": client,
             "phone": phone,
@@ -2235,9 +3187,10 @@ async def get_password(message: types.Message, state: FSMContext):
         await client.connect()
 
     try:
-        await client.sign_in(password=password)
+        await api_call(client, 'auth', client.sign_in, password=password, priority=INTERACTIVE, retry=False)
 
         # Успех — сохраняем и идём дальше
+        session_store.save(user_id, client.session)
         user_clients[user_id].update({"phone_hash": ""})
         await ui_send_new(
             user_id,
@@ -2258,27 +3211,70 @@ async def get_password(message: types.Message, state: FSMContext):
         await state.finish()
         return
 
+def chat_errors_text(errors: list) -> str:
+    lines = "\n".join(f"• {part} — {reason}" for part, reason in errors)
+    return (
+        "⚠️ Не удалось распознать чаты:\n"
+        f"{lines}\n"
+        "Проверьте доступность в аккаунте и корректность ссылок и отправьте список заново."
+    )
+
+
+def chat_skipped_text(errors: list, delayed: list) -> str:
+    lines = [f"• {part} — {reason}" for part, reason in errors]
+    lines += [f"• {part} — лимит Telegram, добавлю сам примерно через {wait} сек." for part, wait in delayed]
+    return "⚠️ Не все чаты удалось добавить сразу, распознанные сохранены:\n" + "\n".join(lines)
+
+
+def delayed_errors(delayed: list) -> list:
+    return [(part, f"лимит Telegram, повторите через {wait} сек.") for part, wait in delayed]
+
+
+async def add_chats_later(user_id: int, parser: dict, delayed: list):
+    """Дорезолвить ссылки, упёршиеся в FloodWait, и добавить их чаты в парсер."""
+    info = user_clients.get(user_id)
+    if not info or 'client' not in info:
+        return
+    ids, errors = await chat_resolver.resolve_later(info['client'], user_id, delayed)
+    if not any(p is parser for p in user_data.get(str(user_id), {}).get('parsers', [])):
+        return  # парсер удалили, пока ждали паузу
+    fresh = [i for i in ids if i not in parser['chats']]
+    limit = get_user_data_entry(user_id).get('chat_limit', CHAT_LIMIT)
+    added = fresh[:max(0, limit - len(parser['chats']))]
+    if added:
+        stop_monitor(user_id, parser)
+        track_active_time(parser)
+        parser['chats'] = parser['chats'] + added
+        parser['daily_price'] = calc_parser_daily_cost(parser)
+        cost_aggregate.update(user_id, parser)
+        save_user_data(user_data)
+        await start_monitor(user_id, parser)
+    lines = []
+    if added:
+        lines.append(f"✅ После паузы Telegram добавлено чатов: {len(added)}.")
+    if len(fresh) > len(added):
+        lines.append(f"⚠️ Не добавлено из-за лимита в {limit} чатов: {len(fresh) - len(added)}.")
+    if errors:
+        lines.append(chat_errors_text(errors))
+    if lines:
+        await ui_send_new(user_id, "\n".join(lines))
+
+
 async def _process_chats(message: types.Message, state: FSMContext, next_state):
     text = message.text.strip().replace(',', ' ')
     parts = [p for p in text.split() if p]
     user_id = message.from_user.id
-    client = user_clients[user_id]['client']
-    chat_ids = []
-
-    for part in parts:
-        try:
-            entity = await client.get_entity(part)
-            chat_ids.append(entity.id)
-        except Exception:
-            if part.lstrip("-").isdigit():
-                chat_ids.append(int(part))
-            else:
-                await ui_send_new(user_id,
-                    "⚠️ Чат не найден. Проверьте доступность в аккаунте и корректность ссылки.")
-                return None
-
+    info = await wake_client(user_id)
+    if not info:
+        await ui_send_new(user_id, "⚠️ Сессия Telegram не найдена. Войдите заново через /start.")
+        return
+    client = info['client']
+    chat_ids, errors, delayed = await chat_resolver.resolve(client, user_id, parts)
     if not chat_ids:
-        await ui_send_new(user_id, "⚠️ Пустой список. Введите хотя бы одну ссылку или ID:")
+        if errors or delayed:
+            await ui_send_new(user_id, chat_errors_text(errors + delayed_errors(delayed)))
+        else:
+            await ui_send_new(user_id, "⚠️ Пустой список. Введите хотя бы одну ссылку или ID:")
         return None
 
     limit = get_user_data_entry(user_id).get('chat_limit', CHAT_LIMIT)
@@ -2286,7 +3282,10 @@ async def _process_chats(message: types.Message, state: FSMContext, next_state):
         await ui_send_new(user_id, f"⚠️ Можно указать не более {limit} чатов.")
         return None
 
-    await state.update_data(chat_ids=chat_ids)
+    if errors or delayed:
+        # Распознанные чаты сохраняем, а не просим прислать весь список заново.
+        await ui_send_new(user_id, chat_skipped_text(errors, delayed))
+    await state.update_data(chat_ids=chat_ids, delayed_chats=delayed)
     await ui_send_new(user_id, "Отлично! Теперь введите ключевые слова для мониторинга (через запятую):")
     await next_state.set()
     return chat_ids
@@ -2343,11 +3342,20 @@ async def _process_keywords(message: types.Message, state: FSMContext):
 
     parser['daily_price'] = calc_parser_daily_cost(parser)
     parser['status'] = 'active'  # если хотите сразу стартовать
+    track_active_time(parser)
+    cost_aggregate.update(user_id, parser)
     save_user_data(user_data)
 
     await start_monitor(user_id, parser)
+    if data.get('delayed_chats'):
+        asyncio.create_task(add_chats_later(user_id, parser, data['delayed_chats']))
 
-    await ui_send_new(message.from_user.id, "✅ Мониторинг запущен! Я уведомлю вас о совпадениях.")
+    await ui_send_new(
+        message.from_user.id,
+        "✅ Мониторинг запущен! Я уведомлю вас о совпадениях.\n"
+        "Можно сразу проверить, что находится в истории чатов.",
+        reply_markup=backfill_keyboard(len(parsers)),
+    )
     await ui_send_new(message.from_user.id, t('menu_main'), reply_markup=main_menu_keyboard())
     await state.finish()
 
@@ -2369,20 +3377,17 @@ async def edit_chats_handler(message: types.Message, state: FSMContext):
     text = message.text.strip().replace(',', ' ')
     parts = [p for p in text.split() if p]
     user_id = message.from_user.id
-    client = user_clients[user_id]['client']
-    chat_ids = []
-    for part in parts:
-        try:
-            entity = await client.get_entity(part)
-            chat_ids.append(entity.id)
-        except Exception:
-            if part.lstrip("-").isdigit():
-                chat_ids.append(int(part))
-            else:
-                await ui_send_new(user_id, "⚠️ Чат не найден. Проверьте доступность и корректность ссылки.")
-                return
+    info = await wake_client(user_id)
+    if not info:
+        await ui_send_new(user_id, "⚠️ Сессия Telegram не найдена. Войдите заново через /start.")
+        return
+    client = info['client']
+    chat_ids, errors, delayed = await chat_resolver.resolve(client, user_id, parts)
     if not chat_ids:
-        await ui_send_new(user_id, "⚠️ Пустой список. Введите хотя бы одну ссылку или ID:")
+        if errors or delayed:
+            await ui_send_new(user_id, chat_errors_text(errors + delayed_errors(delayed)))
+        else:
+            await ui_send_new(user_id, "⚠️ Пустой список. Введите хотя бы одну ссылку или ID:")
         return
 
     limit = get_user_data_entry(user_id).get('chat_limit', CHAT_LIMIT)
@@ -2391,12 +3396,19 @@ async def edit_chats_handler(message: types.Message, state: FSMContext):
         return
     parser = user_data[str(user_id)]['parsers'][idx]
     stop_monitor(user_id, parser)
+    # Время до смены чатов начисляется по старой цене.
+    track_active_time(parser)
     parser['chats'] = chat_ids
     save_user_data(user_data)
     parser['daily_price'] = calc_parser_daily_cost(parser)
+    cost_aggregate.update(user_id, parser)
     await start_monitor(user_id, parser)
     await state.finish()
-    await ui_send_new(user_id, "✅ Чаты обновлены.")
+    if errors or delayed:
+        await ui_send_new(user_id, chat_skipped_text(errors, delayed))
+    if delayed:
+        asyncio.create_task(add_chats_later(user_id, parser, delayed))
+    await ui_send_new(user_id, "✅ Чаты обновлены.", reply_markup=backfill_keyboard(idx + 1))
 
 
 @dp.message_handler(state=EditParserStates.waiting_keywords)
@@ -2452,8 +3464,49 @@ if __name__ == '__main__':
     print("Bot is starting...")
 
 
-    async def on_startup(dispatcher):
-        asyncio.create_task(daily_billing_loop())
-
+    # В режиме webhook уведомления ЮKassa можно принимать на том же порту.
+    yookassa_on_bot_app = BOT_MODE == 'webhook' and YOOKASSA_WEBHOOK_PORT == WEBHOOK_PORT
 
-    executor.start_polling(dp, skip_updates=True, on_startup=on_startup)
\ No newline at end of file
+    async def on_startup(dispatcher):
+        if BOT_MODE == 'webhook':
+            # Апдейты, пришедшие во время рестарта, не сбрасываем.
+            await bot.set_webhook(
+                WEBHOOK_URL + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+                drop_pending_updates=False,
+            )
+        if BILLING_MODE == 'prorated':
+            asyncio.create_task(prorated_billing_loop())
+        else:
+            asyncio.create_task(daily_billing_loop())
+        asyncio.create_task(results_retention_loop())
+        asyncio.create_task(lead_index.rebuild_if_empty(user_data, result_archive.iter_results))
+        asyncio.create_task(restore_clients())
+        asyncio.create_task(connection_watchdog())
+        asyncio.create_task(client_supervisor())
+        asyncio.create_task(digest_loop())
+        if subscription_timers.rebuild(user_data):
+            save_user_data(user_data)
+        asyncio.create_task(subscription_timers.run())
+        if YOOKASSA_WEBHOOK_PORT and not yookassa_on_bot_app:
+            await yookassa_webhook.start(YOOKASSA_WEBHOOK_HOST, YOOKASSA_WEBHOOK_PORT)
+        asyncio.create_task(reconcile_pending_payments())
+
+    async def on_shutdown(dispatcher):
+        # Вебхук Telegram не снимаем: апдейты дождутся следующего запуска.
+        await yookassa_webhook.stop()
+        logging.info("Update latency: %s", update_latency.summary())
+        logging.info("YooKassa latency: %s, %s", payment_client.summary(), payment_client.stats)
+        await payment_client.close()
+
+
+    if BOT_MODE == 'webhook':
+        app = web.Application(middlewares=[secret_token_middleware(WEBHOOK_PATH, WEBHOOK_SECRET)])
+        if yookassa_on_bot_app:
+            yookassa_webhook.setup(app)
+        executor.set_webhook(
+            dp, WEBHOOK_PATH, on_startup=on_startup, on_shutdown=on_shutdown, web_app=app,
+        ).run_app(host=WEBHOOK_HOST, port=WEBHOOK_PORT)
+    else:
+        executor.start_polling(dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown)
\ No newline at end of file
@@ -0,0 +1,61 @@
+import asyncio
+import gc
+
+import pytest
+
+from bot.api_scheduler import AccountScheduler, _schedulers, api_call, release_scheduler
+
+
+class _Client:
+    pass
+
+
+def test_dispatcher_task_exits_when_idle():
+    async def scenario():
+        sched = AccountScheduler('test')
+
+        async def ping():
+            return 'pong'
+
+        assert await sched.call('default', ping) == 'pong'
+        await asyncio.sleep(0.01)
+        assert sched._task is None
+        assert await sched.call('default', ping) == 'pong'
+
+    asyncio.run(scenario())
+
+
+def test_idle_scheduler_does_not_outlive_client():
+    async def scenario():
+        client = _Client()
+
+        async def ping():
+            return 'pong'
+
+        assert await api_call(client, 'default', ping) == 'pong'
+        await asyncio.sleep(0.01)
+        del client
+        gc.collect()
+        assert len(_schedulers) == 0
+
+    asyncio.run(scenario())
+
+
+def test_release_fails_queued_calls():
+    async def scenario():
+        client = _Client()
+        sched = AccountScheduler('test', limits={'default': (0.001, 1)})
+        _schedulers[client] = sched
+
+        async def ping():
+            return 'pong'
+
+        await sched.call('default', ping)
+        waiting = asyncio.create_task(sched.call('default', ping))
+        await asyncio.sleep(0.01)
+        release_scheduler(client)
+        with pytest.raises(ConnectionError):
+            await waiting
+        assert sched._task is None and client not in _schedulers
+
+    asyncio.run(scenario())
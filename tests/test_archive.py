@@ -0,0 +1,30 @@
+import json
+import os
+
+from bot.archive import ResultArchive
+from bot.models import Result
+
+
+def _results(first, count):
+    return [Result('kw', 'Chat', '', f'2024-05-01 10:{i % 60:02d}:00', '', f'lead {i}') for i in range(first, first + count)]
+
+
+def test_enforce_rerun_after_crash_does_not_duplicate(tmp_path):
+    archive = ResultArchive(str(tmp_path), hot_limit=2, hot_days=0)
+    parser = {'key': 'p1', 'results': _results(0, 6)}
+    saved = {'key': 'p1', 'results': list(parser['results'])}
+    archive.enforce(parser, force=True)
+    parser['results'].extend(_results(6, 3))
+    archive.enforce(parser, force=True)
+    assert parser['archived'] == 7
+
+    # Упали до сохранения user_data: на диске прежние results и archived.
+    parser = saved
+    parser['results'].extend(_results(6, 1))
+    assert archive.enforce(parser, force=True) == 5
+    with open(tmp_path / 'p1' / 'index.json', encoding='utf-8') as f:
+        index = json.load(f)
+    assert [(seg['first_seq'], seg['count']) for seg in index] == [(0, 5)]
+    assert sorted(os.listdir(tmp_path / 'p1')) == ['index.json', 'seg_0000000000.jsonl.gz']
+    items, _ = archive.page(parser, None, 10)
+    assert [r.text for _, r in items] == [f'lead {i}' for i in range(6, -1, -1)]
@@ -0,0 +1,57 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+from bot.backfill import backfill_parser
+from bot.models import Result
+
+
+class _Client:
+    def __init__(self, messages):
+        self.messages = messages
+
+    async def get_messages(self, chat, limit, offset_id):
+        older = [m for m in self.messages if not offset_id or m.id < offset_id]
+        return older[:limit]
+
+
+def _msg(msg_id, text, minutes_ago):
+    date = (datetime.now(timezone.utc) - timedelta(minutes=minutes_ago)).replace(microsecond=0)
+    return SimpleNamespace(id=msg_id, chat_id=-100, chat=SimpleNamespace(title='Chat'), date=date, raw_text=text)
+
+
+def test_skips_stored_messages_including_legacy_results():
+    known, legacy, fresh = _msg(3, 'known', 5), _msg(2, 'legacy', 10), _msg(1, 'fresh', 15)
+    parser = {'chats': ['chat'], 'results': [
+        Result('kw', 'Chat', '', legacy.date.strftime('%Y-%m-%d %H:%M:%S'), '', 'legacy'),
+        Result('kw', 'Chat', '', known.date.strftime('%Y-%m-%d %H:%M:%S'), '', 'known', -100, 3),
+    ]}
+    handled = []
+
+    async def handle(msg):
+        handled.append(msg.id)
+        return True
+
+    stats = asyncio.run(backfill_parser(_Client([known, legacy, fresh]), parser, handle, 100, 1))
+    assert handled == [1]
+    assert stats['scanned'] == 3 and stats['found'] == 1
+
+
+def test_dedupes_against_archived_results_without_a_date_floor():
+    archived, missed, hot = _msg(3, 'archived', 5), _msg(2, 'missed', 10), _msg(1, 'hot', 15)
+    parser = {'chats': ['chat'], 'results': [
+        Result('kw', 'Chat', '', hot.date.strftime('%Y-%m-%d %H:%M:%S'), '', 'hot', -100, 1),
+    ]}
+    known = parser['results'] + [
+        Result('kw', 'Chat', '', archived.date.strftime('%Y-%m-%d %H:%M:%S'), '', 'archived', -100, 3),
+    ]
+    handled = []
+
+    async def handle(msg):
+        handled.append(msg.id)
+        return True
+
+    # Сообщение старше самого свежего архивного всё равно проверяется.
+    stats = asyncio.run(backfill_parser(_Client([archived, missed, hot]), parser, handle, 100, 1, known=known))
+    assert handled == [2]
+    assert stats['scanned'] == 3 and stats['found'] == 1
@@ -0,0 +1,51 @@
+import random
+
+from bot.billing_engine import plan_daily_debits, user_daily_cost
+
+
+def _parser_cost(parser):
+    return 15.0 * len(parser.get('chats', []))
+
+
+def _loop_reference(users):
+    """Прежний расчёт по одному пользователю: (списания, заблокированные)."""
+    debits, blocked = [], []
+    for uid, data in users.items():
+        per_day = round(user_daily_cost(data, _parser_cost), 2)
+        if per_day <= 0:
+            continue
+        bal = float(data.get('balance', 0))
+        if bal >= per_day:
+            debits.append((uid, per_day, round(bal - per_day, 2)))
+        else:
+            blocked.append(uid)
+    return debits, blocked
+
+
+def test_vectorized_plan_matches_the_per_user_loop():
+    rng = random.Random(41)
+    users = {}
+    for i in range(300):
+        parsers = [
+            {'status': rng.choice(['active', 'active', 'paused']), 'chats': list(range(rng.randint(0, 4)))}
+            for _ in range(rng.randint(0, 3))
+        ]
+        users[str(i)] = {'balance': round(rng.uniform(0, 120), 2), 'parsers': parsers}
+    # Граничные случаи: баланс ровно на сутки, пустой баланс, без парсеров.
+    users['edge'] = {'balance': 30.0, 'parsers': [{'status': 'active', 'chats': [1, 2]}]}
+    users['none'] = {'balance': None, 'parsers': [{'status': 'active', 'chats': [1]}]}
+    users['idle'] = {'balance': 0.0}
+
+    plan = plan_daily_debits(users, lambda uid: user_daily_cost(users[uid], _parser_cost))
+    debits, blocked = _loop_reference({u: {**d, 'balance': d['balance'] or 0} for u, d in users.items()})
+    assert plan.debits() == debits
+    assert plan.blocked() == blocked
+    assert ('edge', 30.0, 0.0) in plan.debits()
+    assert 'none' in plan.blocked() and 'idle' not in plan.blocked()
+    assert round(plan.total, 2) == round(sum(amount for _, amount, _ in debits), 2)
+
+
+def test_plan_does_not_touch_user_records():
+    users = {'1': {'balance': 50.0, 'parsers': [{'status': 'active', 'chats': [1]}]}}
+    plan_daily_debits(users, lambda uid: user_daily_cost(users[uid], _parser_cost))
+    assert users['1']['balance'] == 50.0
@@ -0,0 +1,95 @@
+import asyncio
+
+from bot.callbacks import CallbackRouter, callback_key
+
+
+def _router():
+    router = CallbackRouter()
+
+    @router.route('parser_pause', int)
+    async def pause(call, num):
+        return num
+
+    @router.route('leads', int, int, optional=1)
+    async def leads(call, num, before=None):
+        return num, before
+
+    @router.route('edit_name', int, state='*')
+    async def edit_name(call, num, state):
+        return num
+
+    @router.route('back_main')
+    async def back(call):
+        return None
+
+    return router, pause, leads, edit_name, back
+
+
+def test_resolve_new_format():
+    router, pause, leads, _, back = _router()
+    assert callback_key('parser_pause', 3) == 'parser_pause:3'
+    route, args = router.resolve('parser_pause:3')
+    assert route.handler is pause and args == [3]
+    assert router.resolve('leads:2:140')[1] == [2, 140]
+    assert router.resolve('leads:2')[1] == [2]
+    assert router.resolve('back_main')[0].handler is back
+    assert router.resolve('parser_pause:x') is None
+    assert router.resolve('parser_pause:1:2') is None
+    assert router.resolve('unknown:1') is None
+    assert router.stats['legacy'] == 0
+
+
+def test_resolve_legacy_format():
+    router, pause, leads, edit_name, _ = _router()
+    route, args = router.resolve('parser_pause_3')
+    assert route.handler is pause and args == [3]
+    assert router.resolve('leads_2_140')[1] == [2, 140]
+    assert router.resolve('edit_name_5')[0].handler is edit_name
+    assert router.resolve('parser_pause') is None
+    assert router.resolve('parser_pause_x') is None
+    assert router.resolve('nothing_here_1') is None
+    assert router.stats['legacy'] == 3
+
+
+class _Call:
+    def __init__(self, data):
+        self.data = data
+        self.answered = False
+
+    async def answer(self, *args, **kwargs):
+        self.answered = True
+
+
+class _State:
+    def __init__(self, current=None):
+        self.current = current
+
+    async def get_state(self):
+        return self.current
+
+
+def test_dispatch_checks_state_and_passes_it():
+    router = CallbackRouter()
+    seen = []
+
+    @router.route('parser_pause', int)
+    async def pause(call, num):
+        seen.append(('pause', num))
+
+    @router.route('edit_name', int, state='*')
+    async def edit_name(call, num, state):
+        seen.append(('edit', num, state.current))
+
+    async def scenario():
+        await router.dispatch(_Call('parser_pause:1'), _State())
+        blocked = _Call('parser_pause:2')
+        await router.dispatch(blocked, _State('Form:name'))
+        await router.dispatch(_Call('edit_name_4'), _State('Form:name'))
+        missing = _Call('nope')
+        await router.dispatch(missing, _State())
+        return blocked, missing
+
+    blocked, missing = asyncio.run(scenario())
+    assert seen == [('pause', 1), ('edit', 4, 'Form:name')]
+    assert blocked.answered and missing.answered
+    assert router.stats == {'calls': 2, 'legacy': 1, 'unknown': 1, 'wrong_state': 1}
@@ -0,0 +1,61 @@
+from bot.billing_engine import user_daily_cost
+from bot.costs import CostAggregate
+
+
+def _parser_cost(parser):
+    return 10.0 * len(parser.get('chats', []))
+
+
+def _full(users, uid):
+    return round(user_daily_cost(users[uid], _parser_cost), 2)
+
+
+def test_total_follows_pause_resume_edit_and_delete():
+    p1 = {'key': 'a', 'status': 'active', 'chats': [1, 2]}
+    p2 = {'key': 'b', 'status': 'active', 'chats': [3]}
+    users = {'1': {'parsers': [p1, p2]}}
+    costs = CostAggregate(users, _parser_cost)
+    assert costs.total(1) == 30.0
+
+    p1['status'] = 'paused'
+    costs.update(1, p1)
+    assert costs.total(1) == _full(users, '1') == 10.0
+
+    p1['status'] = 'active'
+    costs.update(1, p1)
+    p2['chats'] = [3, 4, 5]
+    costs.update(1, p2)
+    assert costs.total(1) == _full(users, '1') == 50.0
+
+    p3 = {'key': 'c', 'status': 'active', 'chats': [6]}
+    users['1']['parsers'].append(p3)
+    costs.update(1, p3)
+    assert costs.total(1) == _full(users, '1') == 60.0
+
+    users['1']['parsers'].remove(p1)
+    costs.remove(1, p1)
+    assert costs.total(1) == _full(users, '1') == 40.0
+
+
+def test_update_before_first_read_builds_the_record():
+    p1 = {'key': 'a', 'status': 'paused', 'chats': [1]}
+    users = {'1': {'parsers': [p1]}}
+    costs = CostAggregate(users, _parser_cost)
+    p1['status'] = 'active'
+    costs.update(1, p1)
+    assert costs.total(1) == 10.0
+    costs.remove(2, p1)
+    assert costs.total(2) == 0.0
+
+
+def test_block_date_is_recomputed_only_when_the_key_changes():
+    costs = CostAggregate({}, _parser_cost)
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return len(calls)
+
+    assert costs.block_date(1, (100.0, 10.0, '2024-05-01'), compute) == 1
+    assert costs.block_date(1, (100.0, 10.0, '2024-05-01'), compute) == 1
+    assert costs.block_date(1, (90.0, 10.0, '2024-05-02'), compute) == 2
@@ -0,0 +1,47 @@
+from bot import edits
+from bot.edits import TokenCache
+
+
+def test_edit_reports_only_new_words():
+    cache = TokenCache()
+    scope = ('p1', -100)
+    assert cache.update(scope, 1, 'куплю телефон', ['куплю', 'телефон']) == {'куплю', 'телефон'}
+    assert cache.unchanged(scope, 1, 'куплю телефон')
+    assert not cache.unchanged(scope, 1, 'куплю телефон срочно')
+    assert cache.update(scope, 1, 'куплю телефон срочно', ['куплю', 'телефон', 'срочно']) == {'срочно'}
+    # Другой чат того же парсера — свой кэш.
+    assert cache.update(('p1', -200), 1, 'куплю', ['куплю']) == {'куплю'}
+
+
+def test_album_caption_edit_is_tracked_per_message():
+    cache = TokenCache()
+    scope = ('p1', -100)
+    # Альбом: подпись у одного элемента, остальные без текста.
+    cache.update(scope, 10, 'продаю велосипед', ['продаю', 'велосипед'])
+    cache.update(scope, 11, '', [])
+    assert cache.update(scope, 11, 'велосипед', ['велосипед']) == {'велосипед'}
+    assert cache.update(scope, 10, 'продаю велосипед недорого', ['продаю', 'велосипед', 'недорого']) == {'недорого'}
+
+
+def test_evicted_or_expired_message_counts_as_new(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(edits.time, 'monotonic', lambda: now[0])
+    cache = TokenCache(ttl=60, per_chat=2)
+    scope = ('p1', -100)
+    for msg_id in (1, 2, 3):
+        cache.update(scope, msg_id, 'слово', ['слово'])
+    assert not cache.unchanged(scope, 1, 'слово')
+    assert cache.update(scope, 1, 'слово', ['слово']) == {'слово'}
+    now[0] += 61
+    assert not cache.unchanged(scope, 3, 'слово')
+    assert cache.update(scope, 3, 'слово', ['слово']) == {'слово'}
+
+
+def test_forget_drops_all_chats_of_a_parser():
+    cache = TokenCache()
+    cache.update(('p1', -100), 1, 'a', ['a'])
+    cache.update(('p1', -200), 1, 'a', ['a'])
+    cache.update(('p2', -100), 1, 'a', ['a'])
+    cache.forget('p1')
+    assert not cache.unchanged(('p1', -100), 1, 'a')
+    assert cache.unchanged(('p2', -100), 1, 'a')
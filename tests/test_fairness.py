@@ -0,0 +1,60 @@
+import asyncio
+from types import SimpleNamespace
+
+from bot import fairness
+from bot.fairness import DigestBuffer, TenantUsage, deliver_digest
+
+
+def test_tenant_usage_budgets_reset_each_minute(monkeypatch):
+    now = [600.0]
+    monkeypatch.setattr(fairness.time, 'monotonic', lambda: now[0])
+    usage = TenantUsage(cpu_budget=1.0, match_budget=2)
+    usage.charge_cpu(1, 0.6)
+    usage.charge_cpu(1, 0.6)
+    for _ in range(3):
+        usage.charge_match(2)
+    assert usage.over_cpu(1) and not usage.over_matches(1)
+    assert usage.over_matches(2) and not usage.over_cpu(2)
+    assert usage.weight(1) == 0.25 and usage.weight(2) == 1.0
+    assert sorted(usage.heavy()) == [(1, 1.2, 0), (2, 0.0, 3)]
+    now[0] += 60
+    assert usage.heavy() == []
+    assert usage.weight(1) == 1.0 and not usage.over_matches(2)
+
+
+def test_digest_buffer_drain_empties_it():
+    buffer = DigestBuffer()
+    buffer.add(1, 'a')
+    buffer.add(1, 'b')
+    buffer.add(2, 'c')
+    assert buffer.drain() == {1: ['a', 'b'], 2: ['c']}
+    assert buffer.drain() == {}
+
+
+def _results(count):
+    return [SimpleNamespace(keyword='kw', chat='Chat', link=f'https://t.me/c/1/{i}') for i in range(count)]
+
+
+def test_digest_falls_back_to_the_next_bot():
+    sent = []
+
+    async def send(sender, user_id, text):
+        sent.append(sender)
+        return None if sender == 'notify' else 'message'
+
+    delivered = asyncio.run(deliver_digest(7, _results(20), ('notify', None, 'main'), send))
+    assert delivered
+    assert sent == ['notify', 'main']
+
+
+def test_digest_reports_failure_when_no_bot_delivers():
+    async def send(sender, user_id, text):
+        return None
+
+    assert not asyncio.run(deliver_digest(7, _results(1), (None, 'main'), send))
+
+
+def test_digest_text_is_capped():
+    text = fairness.digest_text(_results(20), limit=3)
+    assert text.count('•') == 3
+    assert '…и ещё 17' in text
@@ -0,0 +1,115 @@
+import asyncio
+
+from bot.ingest import IngestQueue
+
+
+def _job(done, name, gate=None):
+    async def job():
+        if gate is not None:
+            await gate.wait()
+        done.append(name)
+    return job
+
+
+async def _drain(queue, done, count):
+    for _ in range(200):
+        if len(done) >= count:
+            return
+        await asyncio.sleep(0.005)
+
+
+def test_drop_oldest_evicts_from_the_deepest_tenant():
+    async def scenario():
+        queue = IngestQueue(maxsize=4, workers=1, flood_rate=100)
+        done, dropped = [], []
+        # Воркеры не успевают стартовать, пока мы не уступим цикл.
+        for name in ('a1', 'a2', 'a3'):
+            await queue.put('chat_a', _job(done, name), tenant='a', on_drop=lambda n=name: dropped.append(n))
+        await queue.put('chat_b', _job(done, 'b1'), tenant='b')
+        await queue.put('chat_b', _job(done, 'b2'), tenant='b')
+        assert queue.depth() == 4 and queue.tenant_depth('a') == 2
+        await _drain(queue, done, 4)
+        return queue, done, dropped
+
+    queue, done, dropped = asyncio.run(scenario())
+    assert dropped == ['a1']
+    assert sorted(done) == ['a2', 'a3', 'b1', 'b2']
+    assert queue.stats['dropped'] == 1
+
+
+def test_drop_oldest_prefers_a_flooding_chat():
+    async def scenario():
+        queue = IngestQueue(maxsize=5, workers=1, flood_rate=2)
+        done, dropped = [], []
+        await queue.put('quiet', _job(done, 'q1'), tenant='a', on_drop=lambda: dropped.append('q1'))
+        for i in range(1, 5):
+            await queue.put('noisy', _job(done, f'n{i}'), tenant='b', on_drop=lambda i=i: dropped.append(f'n{i}'))
+        await queue.put('quiet', _job(done, 'q2'), tenant='a')
+        await _drain(queue, done, 5)
+        return done, dropped
+
+    done, dropped = asyncio.run(scenario())
+    # Первые flood_rate сообщений чата ещё не флуд, выбрасывается третье.
+    assert dropped == ['n3']
+    assert 'q1' in done and 'q2' in done
+
+
+def test_coalesce_skips_a_queued_duplicate_only():
+    async def scenario():
+        queue = IngestQueue(maxsize=10, workers=1, policy='coalesce')
+        done = []
+        await queue.put('chat', _job(done, 'first'), key='same', tenant='a')
+        await queue.put('chat', _job(done, 'dup'), key='same', tenant='a')
+        await _drain(queue, done, 1)
+        await queue.put('chat', _job(done, 'later'), key='same', tenant='a')
+        await _drain(queue, done, 2)
+        return queue, done
+
+    queue, done = asyncio.run(scenario())
+    assert done == ['first', 'later']
+    assert queue.stats['coalesced'] == 1
+
+
+def test_block_waits_for_room_instead_of_dropping():
+    async def scenario():
+        queue = IngestQueue(maxsize=1, workers=1, policy='block')
+        done, gate = [], asyncio.Event()
+        await queue.put('chat', _job(done, 'j1', gate), tenant='a')
+        await asyncio.sleep(0.01)                 # воркер взял j1 и ждёт
+        await queue.put('chat', _job(done, 'j2'), tenant='a')
+        blocked = asyncio.create_task(queue.put('chat', _job(done, 'j3'), tenant='a'))
+        await asyncio.sleep(0.01)
+        assert not blocked.done()
+        gate.set()
+        await blocked
+        await _drain(queue, done, 3)
+        return queue, done
+
+    queue, done = asyncio.run(scenario())
+    assert done == ['j1', 'j2', 'j3']
+    assert queue.stats['dropped'] == 0
+
+
+def test_quiet_tenant_is_not_stuck_behind_a_flooding_one():
+    async def scenario():
+        queue = IngestQueue(maxsize=100, workers=1)
+        done = []
+
+        def job(name):
+            async def run():
+                await asyncio.sleep(0.002)
+                done.append(name)
+            return run
+
+        for i in range(20):
+            await queue.put('noisy', job(f'a{i}'), tenant='a')
+        await asyncio.sleep(0.01)
+        await queue.put('quiet', job('b0'), tenant='b')
+        await queue.put('quiet', job('b1'), tenant='b')
+        await _drain(queue, done, 22)
+        return done
+
+    done = asyncio.run(scenario())
+    assert len(done) == 22
+    # Тихий арендатор чередуется с шумным, а не ждёт всех его двадцати задач.
+    assert done.index('b1') < 10
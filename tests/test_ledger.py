@@ -0,0 +1,30 @@
+from bot.ledger import BillingLedger
+
+
+def test_record_is_idempotent_per_day(tmp_path):
+    ledger = BillingLedger(str(tmp_path / "db.sqlite"))
+    assert ledger.record('2024-05-01', [('1', 10.0, 90.0), ('2', 5.0, 0.0)]) == {'1', '2'}
+    assert ledger.record('2024-05-01', [('1', 10.0, 80.0)]) == set()
+    assert ledger.record('2024-05-02', [('1', 10.0, 80.0)]) == {'1'}
+    assert sorted(ledger.entries('2024-05-01')) == [('1', 10.0, 90.0), ('2', 5.0, 0.0)]
+
+
+def test_replay_applies_unsaved_debits_once(tmp_path):
+    ledger = BillingLedger(str(tmp_path / "db.sqlite"))
+    ledger.record('2024-05-01', [('1', 10.0, 90.0), ('2', 5.0, 0.0)])
+    # Упали после записи журнала: у первого списание сохранилось, у второго нет.
+    users = {'1': {'balance': 90.0, 'billed_day': '2024-05-01'}, '2': {'balance': 5.0}, '3': {'balance': 1.0}}
+    assert ledger.replay('2024-05-01', users) == 1
+    assert users['1']['balance'] == 90.0
+    assert users['2'] == {'balance': 0.0, 'billed_day': '2024-05-01'}
+    assert ledger.replay('2024-05-01', users) == 0
+    assert users['3'] == {'balance': 1.0}
+
+
+
+def test_latest_hourly_entry(tmp_path):
+    ledger = BillingLedger(str(tmp_path / "db.sqlite"))
+    ledger.record('2024-05-01T10', [('1', 1.0, 99.0)])
+    ledger.record('2024-05-01T11', [('1', 2.0, 97.0)])
+    ledger.record('2024-05-02', [('1', 24.0, 73.0)])
+    assert ledger.latest(['1', '2'], '____-__-__T__') == {'1': ('2024-05-01T11', 2.0)}
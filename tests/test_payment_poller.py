@@ -0,0 +1,151 @@
+import asyncio
+
+from bot.payment_poller import PaymentPoller
+from bot.pending import PendingPayments, mark_applied
+
+
+def _poller(tmp_path, status, **kwargs):
+    store = PendingPayments(str(tmp_path / "db.sqlite"))
+    poller = PaymentPoller(first=0.01, longest=0.05, store=store, **kwargs)
+    calls = []
+    gate = asyncio.Event()
+
+    async def check(obj_id):
+        await gate.wait()
+        return status[0]
+
+    async def complete(entry, result):
+        calls.append(result)
+
+    poller.register('topup', check, complete)
+    return poller, store, calls, gate
+
+
+def test_resolve_and_poll_race_completes_once(tmp_path):
+    async def scenario():
+        poller, store, calls, gate = _poller(tmp_path, ['succeeded'])
+        poller.add('topup', 'p1', 1, amount=100.0)
+        await asyncio.sleep(0.05)             # очередной проход уже ждёт ответа API
+        resolving = asyncio.create_task(poller.resolve('p1'))
+        await asyncio.sleep(0)
+        gate.set()
+        assert await resolving
+        await asyncio.sleep(0.05)
+        return poller, store, calls
+
+    poller, store, calls = asyncio.run(scenario())
+    assert calls == ['succeeded']
+    assert 'p1' not in poller
+    assert store.load() == []
+
+
+def test_timeout_keeps_entry_until_final_status(tmp_path):
+    async def scenario():
+        status = [None]
+        poller, store, calls, gate = _poller(tmp_path, status, ttl=0)
+        gate.set()
+        poller.add('topup', 'p1', 1, amount=100.0)
+        await asyncio.sleep(0.1)
+        assert calls == ['timeout']
+        assert 'p1' in poller
+        assert [e['id'] for e in store.load()] == ['p1']
+        status[0] = 'succeeded'
+        await asyncio.sleep(0.1)
+        return poller, store, calls
+
+    poller, store, calls = asyncio.run(scenario())
+    assert calls == ['timeout', 'succeeded']
+    assert 'p1' not in poller
+    assert store.load() == []
+
+
+def test_failed_completion_stays_pending(tmp_path):
+    async def scenario():
+        store = PendingPayments(str(tmp_path / "db.sqlite"))
+        poller = PaymentPoller(first=0.01, longest=0.02, store=store)
+        attempts = []
+
+        async def check(obj_id):
+            return 'succeeded'
+
+        async def complete(entry, result):
+            attempts.append(result)
+            if len(attempts) == 1:
+                raise RuntimeError("save failed")
+
+        poller.register('topup', check, complete)
+        poller.add('topup', 'p1', 1, amount=100.0)
+        await asyncio.sleep(0.01)
+        assert [e['id'] for e in store.load()] == ['p1']
+        await asyncio.sleep(0.1)
+        return poller, store, attempts
+
+    poller, store, attempts = asyncio.run(scenario())
+    assert attempts == ['succeeded', 'succeeded']
+    assert store.load() == []
+
+
+def test_revive_picks_up_timed_out_row_from_store(tmp_path):
+    async def scenario():
+        store = PendingPayments(str(tmp_path / "db.sqlite"))
+        store.save({'kind': 'topup', 'id': 'p1', 'user_id': 1, 'amount': 100.0, 'created': 0})
+        store.time_out('p1')
+        poller = PaymentPoller(store=store)
+        calls = []
+
+        async def check(obj_id):
+            return 'succeeded'
+
+        async def complete(entry, result):
+            calls.append((entry['amount'], entry.get('timed_out'), result))
+
+        poller.register('topup', check, complete)
+        assert not await poller.resolve('p1')
+        assert await poller.revive('p1')
+        assert not await poller.revive('missing')
+        return store, calls
+
+    store, calls = asyncio.run(scenario())
+    assert calls == [(100.0, True, 'succeeded')]
+    assert store.get('p1') is None
+
+
+def test_restart_between_credit_and_finish_credits_once(tmp_path):
+    saved = {'balance': 0.0}
+
+    def make_poller():
+        store = PendingPayments(str(tmp_path / "db.sqlite"))
+        poller = PaymentPoller(first=0.01, longest=0.02, store=store)
+        user = dict(saved)
+
+        async def check(obj_id):
+            return 'succeeded'
+
+        async def complete(entry, result):
+            if mark_applied(user, entry['id']):
+                user['balance'] += entry['amount']
+            saved.update(user)
+
+        poller.register('topup', check, complete)
+        return poller, store
+
+    async def crash():
+        poller, store = make_poller()
+        # Рестарт после сохранения баланса, но до закрытия записи в базе.
+        store.finish = lambda obj_id, status: None
+        poller.add('topup', 'p1', 1, amount=100.0)
+        await asyncio.sleep(0.05)
+        return store
+
+    async def restart():
+        poller, store = make_poller()
+        stats = await poller.restore()
+        return stats, store
+
+    assert [e['id'] for e in asyncio.run(crash()).load()] == ['p1']
+    assert saved['balance'] == 100.0
+    stats, store = asyncio.run(restart())
+    assert stats['succeeded'] == 1
+    assert saved['balance'] == 100.0
+    assert saved['applied_payments'] == ['p1']
+    assert store.load() == []
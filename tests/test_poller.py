@@ -0,0 +1,65 @@
+import asyncio
+
+from bot.poller import PollScheduler
+
+
+def _scheduler():
+    polls = []
+    gate = asyncio.Event()
+    gate.set()
+
+    async def poll(user_id, parser):
+        polls.append((user_id, parser['key']))
+        await gate.wait()
+
+    return PollScheduler(poll), polls, gate
+
+
+def test_rescheduled_parser_is_polled_once():
+    async def scenario():
+        scheduler, polls, _ = _scheduler()
+        parser = {'key': 'p1'}
+        scheduler.add(1, parser, 60, delay=0.02)
+        # Повторный add переносит срок; старая запись в куче устаревает.
+        scheduler.add(1, parser, 60, delay=0)
+        await asyncio.sleep(0.05)
+        return scheduler, polls
+
+    scheduler, polls = asyncio.run(scenario())
+    assert polls == [(1, 'p1')]
+    assert scheduler.stats['polls'] == 1 and scheduler.stats['skipped'] == 0
+
+
+def test_switch_to_live_mode_stops_polling():
+    async def scenario():
+        scheduler, polls, _ = _scheduler()
+        parser = {'key': 'p1'}
+        scheduler.add(1, parser, 60, delay=0.02)
+        scheduler.remove(parser)
+        assert parser not in scheduler
+        await asyncio.sleep(0.05)
+        assert polls == []
+        # И обратно в poll: опрашивается по новому расписанию, один раз.
+        scheduler.add(1, parser, 60, delay=0)
+        await asyncio.sleep(0.02)
+        return polls
+
+    assert asyncio.run(scenario()) == [(1, 'p1')]
+
+
+def test_poll_due_while_previous_runs_is_skipped():
+    async def scenario():
+        scheduler, polls, gate = _scheduler()
+        gate.clear()
+        parser = {'key': 'p1'}
+        scheduler.add(1, parser, 60, delay=0)
+        await asyncio.sleep(0.01)
+        scheduler.add(1, parser, 60, delay=0)
+        await asyncio.sleep(0.01)
+        gate.set()
+        await asyncio.sleep(0.01)
+        return scheduler, polls
+
+    scheduler, polls = asyncio.run(scenario())
+    assert polls == [(1, 'p1')]
+    assert scheduler.stats['skipped'] == 1 and scheduler.stats['polls'] == 1
@@ -0,0 +1,65 @@
+from bot.ledger import BillingLedger
+from bot.prorate import settle_batch, user_batch
+
+NOW = 1714568400          # 2024-05-01T13:00 UTC
+DAY = 86400
+
+
+def _cost(parser):
+    return 24.0           # 1 ₽ в час
+
+
+def _users():
+    uid = next(str(i) for i in range(1000) if user_batch(str(i), 60) == 7)
+    users = {uid: {'balance': 100.0, 'parsers': [{'status': 'active', 'active_since': NOW - 3600}]}}
+    return uid, users
+
+
+def test_same_hour_rerun_charges_once(tmp_path):
+    ledger = BillingLedger(str(tmp_path / "db.sqlite"))
+    uid, users = _users()
+    changed, blocked = settle_batch(users, 7, ledger, _cost, lambda uid: False, NOW)
+    assert changed and not blocked
+    assert users[uid]['balance'] == 99.0
+    assert users[uid]['billed_period'] == '2024-05-01T13'
+
+    changed, _ = settle_batch(users, 7, ledger, _cost, lambda uid: False, NOW + 600)
+    assert not changed
+    assert users[uid]['balance'] == 99.0
+    # Десять минут после расчёта не потеряны, а ждут следующего часа.
+    settle_batch(users, 7, ledger, _cost, lambda uid: False, NOW + 3600)
+    assert users[uid]['balance'] == 98.0
+
+
+def test_rerun_after_crash_before_save_keeps_accrual(tmp_path):
+    ledger = BillingLedger(str(tmp_path / "db.sqlite"))
+    uid, users = _users()
+    users[uid]['billed_period'] = '2024-05-01T12'
+    saved = {uid: {**users[uid], 'parsers': [dict(p) for p in users[uid]['parsers']]}}
+    settle_batch(users, 7, ledger, _cost, lambda uid: False, NOW)
+
+    # Запись в журнале есть, а user_data на диск не попали: поднимаем старые.
+    settle_batch(saved, 7, ledger, _cost, lambda uid: False, NOW + 600)
+    assert saved[uid]['balance'] == 99.0
+    assert saved[uid]['billed_period'] == '2024-05-01T13'
+    settle_batch(saved, 7, ledger, _cost, lambda uid: False, NOW + 3600)
+    assert saved[uid]['balance'] == 98.0
+    assert [row[1] for row in ledger.entries('2024-05-01T14')] == [1.0]
+
+
+def test_short_balance_blocks_and_keeps_debt(tmp_path):
+    ledger = BillingLedger(str(tmp_path / "db.sqlite"))
+    uid, users = _users()
+    users[uid]['balance'] = 0.5
+    blocked_uids = []
+
+    def block(uid):
+        blocked_uids.append(uid)
+        users[uid]['parsers'][0]['status'] = 'paused'
+        return True
+
+    _, blocked = settle_batch(users, 7, ledger, _cost, block, NOW)
+    assert blocked == [uid]
+    assert users[uid]['balance'] == 0.5
+    assert round(users[uid]['accrued'], 6) == 1.0
+    assert ledger.entries('2024-05-01T13') == []
@@ -0,0 +1,49 @@
+import asyncio
+
+from telethon.errors import FloodWaitError
+
+from bot.resolver import ChatResolver
+
+
+def _resolver(tmp_path, flood):
+    resolver = ChatResolver(str(tmp_path / "db.sqlite"))
+    calls = []
+
+    async def fetch(client, part):
+        calls.append(part)
+        if part == 'dead':
+            raise ValueError(part)
+        if flood.get(part):
+            flood[part] -= 1
+            raise FloodWaitError(request=None, capture=300)
+        return 1000 + len(calls)
+
+    resolver._fetch = fetch
+    return resolver, calls
+
+
+def test_flood_wait_is_delayed_and_other_links_are_kept(tmp_path):
+    resolver, _ = _resolver(tmp_path, {'busy': 1})
+    ids, errors, delayed = asyncio.run(resolver.resolve(None, 1, ['@good', '-100500', 'dead', 'busy']))
+    assert ids == [1001, -100500]
+    assert errors == [('dead', 'чат не найден')]
+    assert delayed == [('busy', 300)]
+
+
+def test_resolve_later_retries_after_the_wait(tmp_path, monkeypatch):
+    waits = []
+    real_sleep = asyncio.sleep
+
+    async def sleep(seconds):
+        waits.append(seconds)
+        await real_sleep(0)
+
+    monkeypatch.setattr(asyncio, 'sleep', sleep)
+    resolver, calls = _resolver(tmp_path, {'stuck': 5})
+    ids, errors = asyncio.run(resolver.resolve_later(None, 1, [('busy', 300), ('stuck', 300)], attempts=2))
+    assert ids == [1001]
+    assert errors == [('stuck', 'лимит Telegram, повторите через 300 сек.')]
+    assert waits == [301, 301]
+    # Найденная после паузы ссылка попала в кэш.
+    assert asyncio.run(resolver.resolve(None, 1, ['t.me/busy'])) == ([1001], [], [])
+    assert calls.count('busy') == 1
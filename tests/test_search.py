@@ -0,0 +1,27 @@
+from bot.models import Result
+from bot.search import LeadIndex
+
+
+def _index(path):
+    return LeadIndex(str(path), lambda w: w.rstrip('аоуыя'))
+
+
+def _lead(dt, text):
+    return Result('ремонт', 'Chat', '@user', dt, 'link', text)
+
+
+def test_search_is_scoped_to_user_and_ordered_by_message_time(tmp_path):
+    index = _index(tmp_path / "db.sqlite")
+    parser = {'key': 'p1'}
+    index.add(1, parser, _lead('2024-05-02 10:00:00', 'нужен ремонт'))
+    index.add(2, parser, _lead('2024-05-03 10:00:00', 'ремонт u1'))
+    # Найдено в истории позже, но сообщение старше.
+    index.add(1, parser, _lead('2024-05-01 10:00:00', 'ремонт ванной'))
+    index.add(1, parser, _lead('2024-05-04 10:00:00', 'ремонта кухни'))
+
+    rows = index.search(1, 'ремонт', limit=2)
+    assert [r[1] for r in rows] == ['2024-05-04 10:00:00', '2024-05-02 10:00:00']
+    rows = index.search(1, 'ремонт', before=rows[-1][0], limit=2)
+    assert [r[1] for r in rows] == ['2024-05-01 10:00:00']
+    assert index.search(1, 'u1') == []
+
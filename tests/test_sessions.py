@@ -0,0 +1,55 @@
+import os
+
+from telethon.crypto import AuthKey
+from telethon.sessions import SQLiteSession, StringSession
+
+from bot.sessions import SessionStore
+
+
+def _session_file(directory, user_id, authorized=True):
+    session = SQLiteSession(os.path.join(directory, f'session_{user_id}'))
+    if authorized:
+        session.set_dc(2, '149.154.167.51', 443)
+        session.auth_key = AuthKey(os.urandom(256))
+    session._conn.execute(
+        "INSERT INTO entities(id, hash, username, phone, name, date) VALUES (?, ?, ?, ?, ?, ?)",
+        (777, 42, 'chat_user', None, 'Chat', 0),
+    )
+    session.save()
+    blob = StringSession.save(session) if authorized else ''
+    session.close()
+    return blob
+
+
+def test_migrate_files_moves_authorized_sessions(tmp_path):
+    blob = _session_file(str(tmp_path), 1)
+    _session_file(str(tmp_path), 2, authorized=False)
+    (tmp_path / 'session_notes.session').write_text('not a session')
+    store = SessionStore(str(tmp_path / 'db.sqlite'))
+
+    assert store.migrate_files(str(tmp_path)) == 1
+    assert sorted(os.listdir(tmp_path)) == [
+        'db.sqlite', 'session_1.session.migrated', 'session_2.session', 'session_notes.session',
+    ]
+    assert store.has(1) and not store.has(2)
+    session = store.session(1)
+    assert StringSession.save(session) == blob
+    assert (777, 42, 'chat_user', None, 'Chat') in session._entities
+
+    # После рестарта сессия читается из базы, повторный перенос ничего не делает.
+    reopened = SessionStore(str(tmp_path / 'db.sqlite'))
+    assert reopened.load_all() == 1
+    assert reopened.migrate_files(str(tmp_path)) == 0
+
+
+def test_migrate_files_keeps_a_session_already_in_the_database(tmp_path):
+    _session_file(str(tmp_path), 1)
+    store = SessionStore(str(tmp_path / 'db.sqlite'))
+    current = StringSession()
+    current.set_dc(4, '149.154.167.91', 443)
+    current.auth_key = AuthKey(os.urandom(256))
+    store.save(1, current)
+
+    assert store.migrate_files(str(tmp_path)) == 0
+    assert StringSession.save(store.session(1)) == StringSession.save(current)
+    assert os.path.exists(tmp_path / 'session_1.session')
@@ -0,0 +1,19 @@
+from bot.subscriptions import SubscriptionTimers, _now
+
+
+def test_rebuild_marks_long_expired_users_instead_of_firing():
+    now = _now()
+    users = {
+        '1': {'subscription_expiry': now - 30 * 86400},
+        '2': {'subscription_expiry': now - 3600},
+        '3': {'subscription_expiry': now + 10 * 86400},
+    }
+    timers = SubscriptionTimers(fire=None)
+    assert timers.rebuild(users) == 2
+    assert users['1']['inactive_notified'] and users['1']['reminder1_sent']
+    # Истекла час назад — окончание ещё отправится, напоминания уже нет.
+    assert users['2'].get('reminder3_sent') and not users['2'].get('inactive_notified')
+    assert sorted((uid, kind) for _, uid, kind, _ in timers._heap) == [
+        ('2', 'expiry'), ('3', 'expiry'), ('3', 'reminder1'), ('3', 'reminder3'),
+    ]
+    assert timers.rebuild(users) == 0
@@ -0,0 +1,13 @@
+from bot.yookassa_client import YooKassaClient, new_operation
+
+
+def test_key_is_reused_only_for_the_same_operation(tmp_path):
+    client = YooKassaClient(str(tmp_path / "db.sqlite"))
+    first, second = new_operation('topup'), new_operation('topup')
+    assert first != second
+    key = client.idempotence_key(first)
+    # Повтор того же действия — тот же ключ; такое же новое действие — другой.
+    assert client.idempotence_key(first) == key
+    assert client.idempotence_key(second) != key
+    client._complete(first, 'p1')
+    assert client.idempotence_key(first) != key
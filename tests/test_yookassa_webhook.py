@@ -0,0 +1,69 @@
+import asyncio
+
+from aiohttp.test_utils import make_mocked_request
+
+from bot.yookassa_webhook import YooKassaWebhook
+
+
+class _Poller:
+    def __init__(self, fail=0):
+        self.fail = fail
+        self.calls = []
+
+    async def resolve(self, obj_id):
+        self.calls.append(obj_id)
+        if self.fail:
+            self.fail -= 1
+            raise RuntimeError("API недоступен")
+        return True
+
+    async def revive(self, obj_id):
+        return False
+
+
+def _notify(hook, obj_id='p1'):
+    request = make_mocked_request('POST', hook.path)
+
+    async def body():
+        return {'event': 'payment.succeeded', 'object': {'id': obj_id}}
+
+    request.json = body
+    return hook.handle(request)
+
+
+def _hook(tmp_path, poller):
+    hook = YooKassaWebhook(poller, str(tmp_path / "db.sqlite"))
+    hook.allowed = lambda request: True
+    return hook
+
+
+def test_failed_resolve_lets_retry_through(tmp_path):
+    async def scenario():
+        poller = _Poller(fail=1)
+        hook = _hook(tmp_path, poller)
+        assert (await _notify(hook)).status == 200
+        await asyncio.sleep(0.01)               # первая обработка упала
+        assert (await _notify(hook)).status == 200
+        await asyncio.sleep(0.01)
+        assert poller.calls == ['p1', 'p1']
+        assert hook.stats['duplicates'] == 0
+        assert (await _notify(hook)).status == 200   # после успеха — уже повтор
+        await asyncio.sleep(0.01)
+        assert poller.calls == ['p1', 'p1']
+        assert hook.stats['duplicates'] == 1
+
+    asyncio.run(scenario())
+
+
+def test_duplicate_while_resolving_is_skipped(tmp_path):
+    async def scenario():
+        poller = _Poller()
+        hook = _hook(tmp_path, poller)
+        await _notify(hook)
+        await _notify(hook)                     # первая ещё не обработана
+        await asyncio.sleep(0.01)
+        assert poller.calls == ['p1']
+        assert hook.stats['duplicates'] == 1
+        assert not hook._inflight
+
+    asyncio.run(scenario())